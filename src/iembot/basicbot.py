@@ -1,8 +1,6 @@
 """ Basic iembot/nwsbot implementation. """
-import copy
 import datetime
 import os
-import pickle
 import random
 import re
 import traceback
@@ -12,7 +10,7 @@ from xml.etree import ElementTree as ET
 
 from pyiem.util import utc
 from twisted.application import internet
-from twisted.internet import reactor, threads
+from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
 from twisted.python import log
 from twisted.python.logfile import DailyLogFile
@@ -21,8 +19,23 @@ from twisted.words.xish import domish, xpath
 from twisted.words.xish.xmlstream import STREAM_END_EVENT
 
 import iembot.util as botutil
+from iembot.chatlog import ChatLog
+from iembot.health import HealthRegistry
+from iembot.history import ChatLogHistory
+from iembot.journal import ChatLogJournal
+from iembot.outbound import (
+    OutboundScheduler,
+    PendingQueue,
+    StanzaTemplate,
+    stanza_priority,
+)
+from iembot.products import PRODUCT_UNAVAILABLE, ProductTextCache
+from iembot.routing import RoutingTable
+from iembot.twitterclient import TwitterClient
+from iembot.webhooks import WebhookDispatcher
 
 DATADIR = os.sep.join([os.path.dirname(__file__), "data"])
+# Legacy chatlog entry, retained so that older pickle files can be loaded
 ROOM_LOG_ENTRY = namedtuple(
     "ROOM_LOG_ENTRY",
     [
@@ -46,7 +59,10 @@ PRESENCE_MUC_STATUS = (
 class basicbot:
     """Here lies the Jabber Bot"""
 
+    # Legacy chatlog storage, only read when the journal does not exist
     PICKLEFILE = "iembot_chatlog_v2.pickle"
+    JOURNALFILE = "iembot_chatlog.journal"
+    HISTORYFILE = "iembot_history.db"
 
     def __init__(
         self, name, dbpool, memcache_client=None, xml_log_path="logs"
@@ -56,18 +72,28 @@ class basicbot:
         self.name = name
         self.dbpool = dbpool
         self.memcache_client = memcache_client
+        self.products = ProductTextCache(memcache_client)
         self.config = {}
         # Adds entries of ping requests made to the server and if we get
         # a response. If this gets to 5 items, we reconnect.
         self.outstanding_pings = []
         self.rooms = {}
-        self.chatlog = {}
+        self.chatlog = ChatLog(maxbytes=128 * 1024 * 1024)
+        self.journal = ChatLogJournal(self.JOURNALFILE)
+        # Entries that no longer fit in memory are spilled to disk
+        self.history = ChatLogHistory(self.HISTORYFILE)
+        self.chatlog.spill = self.history.add
         self.seqnum = 0
-        self.routingtable = {}
+        self.routingtable = RoutingTable()  # channel => rooms
         self.tw_users = {}  # Storage by user_id => {screen_name: ..., oauth:}
-        self.tw_routingtable = {}  # Storage by channel => [user_id, ]
-        self.webhooks_routingtable = {}
+        self.tw_routingtable = RoutingTable()  # channel => user_ids
+        self.webhooks_routingtable = RoutingTable()  # channel => urls
+        self.health = HealthRegistry()
+        self.webhooks = WebhookDispatcher(health=self.health)
+        self.twitter = TwitterClient(health=self.health)
         self.xmlstream = None
+        self.outbound = OutboundScheduler(self.write_stanza)
+        self.pending = PendingQueue()
         self.firstlogin = False
         self.syndication = {}
         self.xmllog = DailyLogFile("xmllog", xml_log_path)
@@ -82,15 +108,55 @@ class basicbot:
 
         lc2 = LoopingCall(botutil.purge_logs, self)
         lc2.start(60 * 60 * 24)
-        lc3 = LoopingCall(reactor.callInThread, self.save_chatlog)
-        lc3.start(600)  # Every 10 minutes
+        lc3 = LoopingCall(self.save_chatlog)
+        lc3.start(5, now=False)
+        lc4 = LoopingCall(self.compact_chatlog)
+        lc4.start(600, now=False)  # Every 10 minutes
 
     def save_chatlog(self):
-        """called from a thread"""
-        log.msg(f"Saving CHATLOG to {self.PICKLEFILE}")
-        with open(self.PICKLEFILE, "wb") as fh:
-            # unsure if deepcopy is necessary, but alas
-            pickle.dump(copy.deepcopy(self.chatlog), fh)
+        """Write any newly logged chatlog entries to the journal.
+
+        Evicted entries are written to the history in a background thread.
+        """
+        self.journal.flush()
+        self.history.flush()
+
+    def compact_chatlog(self):
+        """Compact the chatlog journal in a background thread."""
+        return self.journal.compact(self.chatlog)
+
+    def log_chatroom_entry(self, room, entry):
+        """Add an entry to a room's chatlog and the journal.
+
+        Args:
+          room (str): the chatroom the message was logged in.
+          entry (iembot.chatlog.ChatLogEntry): the entry.
+        """
+        # Render the JSON service fragment now, so polls do not need to
+        entry.json_fragment()
+        self.chatlog.append(room, entry)
+        self.journal.append(room, entry)
+
+    def set_product_text(self, product_text, room, entry):
+        """Fill in the product text of an entry logged without it.
+
+        Args:
+          product_text (str): the text, or None if it never showed up.
+          room (str): the chatroom the entry was logged in.
+          entry (iembot.chatlog.ChatLogEntry): the entry.
+        """
+        if product_text:
+            # Shared by the entries of every room the product went to
+            product_text = self.chatlog.share(entry.product_id, product_text)
+        else:
+            product_text = PRODUCT_UNAVAILABLE
+        if self.chatlog.update(room, entry, product_text=product_text):
+            entry.json_fragment()
+            self.journal.append(room, entry)
+            return
+        # Spilled to the history while waiting, replace the text there
+        entry.product_text = product_text
+        self.history.add(room, [entry])
 
     def authd(self, _xs=None):
         """callback when we are logged into the server!"""
@@ -101,9 +167,15 @@ class basicbot:
             self.compute_daily_caller()
             self.firstlogin = True
 
-        # Resets associated with the previous login session, perhaps
-        self.rooms = {}
+        # Resets associated with the previous login session, perhaps.  The
+        # rooms are kept so that messages for them are held until rejoined
+        for room in self.rooms.values():
+            room["joined"] = False
+            room["occupants"] = {}
         self.outstanding_pings = []
+        # Room stanzas were moved to the pending queue when the stream was
+        # lost, what remains is safe to send now that we are logged in
+        self.outbound.resume()
 
         self.load_twitter()
         self.load_chatrooms(True)
@@ -163,6 +235,42 @@ class basicbot:
             f"{self.config['bot.xmppdomain']}"
         )
         self.conference = self.config["bot.mucservice"]
+        self.outbound.room_rate = float(
+            self.config.get("bot.outbound_room_rate", self.outbound.room_rate)
+        )
+        self.outbound.room_burst = float(
+            self.config.get(
+                "bot.outbound_room_burst", self.outbound.room_burst
+            )
+        )
+        self.outbound.bytes_per_second = float(
+            self.config.get(
+                "bot.outbound_bytes_per_second", self.outbound.bytes_per_second
+            )
+        )
+        self.outbound.starvation_limit = int(
+            self.config.get(
+                "bot.outbound_starvation_limit", self.outbound.starvation_limit
+            )
+        )
+        self.twitter.set_consumer(
+            self.config.get("bot.twitter.consumerkey"),
+            self.config.get("bot.twitter.consumersecret"),
+        )
+        self.twitter.max_age = float(
+            self.config.get(
+                "bot.twitter.max_age_seconds", self.twitter.max_age
+            )
+        )
+        self.pending.maxlen = int(
+            self.config.get("bot.pending_maxlen", self.pending.maxlen)
+        )
+        self.pending.expire = float(
+            self.config.get("bot.pending_expire_seconds", self.pending.expire)
+        )
+        self.chatlog.maxbytes = int(
+            self.config.get("bot.chatlog_maxbytes", self.chatlog.maxbytes)
+        )
 
         factory = client.XMPPClientFactory(
             self.myjid, self.config["bot.password"]
@@ -181,6 +289,8 @@ class basicbot:
     def connected(self, xs):
         """connected callback"""
         log.msg("Connected")
+        # Nothing may be sent before the stream is authenticated
+        self.outbound.pause()
         self.xmlstream = xs
         self.xmlstream.rawDataInFn = self.rawDataInFn
         self.xmlstream.rawDataOutFn = self.rawDataOutFn
@@ -192,6 +302,15 @@ class basicbot:
     def disconnected(self, _xs=None):
         """disconnected callback"""
         log.msg("disconnected() was called...")
+        self.outbound.pause()
+        # Hold messages until the rooms are rejoined on the next login
+        held = self.outbound.take(lambda key: key in self.rooms)
+        if held:
+            log.msg(f"Holding {len(held)} queued stanzas until rooms rejoin")
+        for room, stanza, priority in held:
+            self.pending.add(room, stanza, priority)
+        for room in self.rooms.values():
+            room["joined"] = False
 
     def get_fortune(self):
         """Get a random value from the array"""
@@ -218,6 +337,9 @@ class basicbot:
         1. XMPP Server Ping
         2. Update presence
         """
+        self.pending.expire_stale()
+        self.outbound.expire_buckets()
+        self.chatlog.enforce_budget()
         if self.outstanding_pings:
             log.msg(f"Currently unresponded pings: {self.outstanding_pings}")
         if len(self.outstanding_pings) > 5:
@@ -269,7 +391,7 @@ class basicbot:
         else:
             p = body.addElement("p")
             p.addContent(mess)
-        self.xmlstream.send(message)
+        self.outbound.enqueue(to, message)
 
     def send_groupchat(self, room, plain, htmlstr=None):
         """Send a groupchat message to a given room
@@ -307,31 +429,73 @@ class basicbot:
             self.send_groupchat_elem(message)
         return message
 
-    def send_groupchat_elem(self, elem, to=None, secondtrip=False):
+    def send_groupchat_elem(self, elem, to=None):
         """Wrapper for sending groupchat elements"""
         if to is not None:
             elem["to"] = to
         room = jid.JID(elem["to"]).user
+        self.send_room_stanza(room, elem)
+
+    def send_groupchat_fanout(self, elem, rooms):
+        """Send a groupchat element to many rooms, serializing it once.
+
+        Args:
+          elem (domish.Element): the groupchat message to send.
+          rooms (iterable): the rooms to send the message to.
+        """
+        template = StanzaTemplate(elem)
+        priority = stanza_priority(elem)
+        for room in rooms:
+            self.send_room_stanza(
+                room,
+                template.render(f"{room}@{self.conference}"),
+                priority=priority,
+            )
+
+    def send_room_stanza(self, room, stanza, priority=None):
+        """Send a stanza addressed to a room we should be in.
+
+        Stanzas for a room that we have not joined (yet) are held in a
+        pending queue, which is flushed in order upon our self-presence.
+
+        Args:
+          room (str): the room the stanza is addressed to.
+          stanza (domish.Element or bytes): the stanza or its serialization.
+          priority (int, optional): the outbound priority class, derived
+            from the stanza when it is an element.
+        """
         if room not in self.rooms:
             botutil.email_error(
                 f"Attempted to send message to room [{room}] "
                 "we have not joined...",
                 self,
-                elem,
+                stanza,
             )
             return
         if not self.rooms[room]["joined"]:
-            if secondtrip:
-                log.msg(
-                    f"ABORT of send to room: {room}, msg: {elem}, not in room"
-                )
-                return
-            secs = random.randint(0, 10)
-            log.msg(f"delaying by {secs}s send to: {room}, not in room yet")
             # Need to prevent elem['to'] object overwriting
-            reactor.callLater(secs, self.send_groupchat_elem, elem, elem["to"])
+            if isinstance(stanza, domish.Element):
+                if priority is None:
+                    priority = stanza_priority(stanza)
+                stanza = stanza.toXml().encode("utf-8")
+            self.pending.add(room, stanza, priority)
+            return
+        self.outbound.enqueue(room, stanza, priority)
+
+    def flush_pending(self, room):
+        """Send the stanzas held while we were not in a room."""
+        held = self.pending.flush(room)
+        if held:
+            log.msg(f"Flushing {len(held)} pending stanzas to {room}")
+        for stanza, priority in held:
+            self.outbound.enqueue(room, stanza, priority)
+
+    def write_stanza(self, data):
+        """Called by the outbound scheduler to write to the XMPP stream."""
+        if self.xmlstream is None:
+            log.msg("xmlstream is None, dropping outbound stanza")
             return
-        self.xmlstream.send(elem)
+        self.xmlstream.send(data)
 
     def send_presence(self, _=None):
         """
@@ -348,16 +512,31 @@ class basicbot:
             self.xmlstream.send(presence)
 
     def tweet(self, user_id, twttxt, **kwargs):
+        """Tweet a message
+
+        Args:
+          user_id (int): the twitter user to tweet as.
+          twttxt (str): the text, already shaped by safe_twitter_text.
+          twitter_media (str, optional): URL of media to attach.
+
+        Returns:
+          twisted.internet.defer.Deferred or None
         """
-        Tweet a message
-        """
-        twttxt = botutil.safe_twitter_text(twttxt)
-        df = threads.deferToThread(
-            botutil.tweet,
-            self,
+        twuser = self.tw_users.get(user_id)
+        if twuser is None:
+            log.msg(f"tweet() called with unknown user_id: {user_id}")
+            return None
+        media = kwargs.get("twitter_media")
+        log.msg(
+            f"Tweeting {twuser['screen_name']}({user_id}) "
+            f"'{twttxt}' media:{media}"
+        )
+        df = self.twitter.tweet(
             user_id,
+            twuser["access_token"],
+            twuser["access_token_secret"],
             twttxt,
-            **kwargs,
+            media=media,
         )
         df.addCallback(botutil.tweet_cb, self, twttxt, "", "", user_id)
         df.addErrback(
@@ -440,6 +619,10 @@ class basicbot:
             if selfpres:
                 log.msg(f"MUC '{_room}' self presence left: {left}")
                 self.rooms[_room]["joined"] = not left
+                if left:
+                    self.pending.discard(_room)
+                else:
+                    self.flush_pending(_room)
 
             self.rooms[_room]["occupants"][_handle] = {
                 "jid": _jid,
@@ -0,0 +1,112 @@
+"""Simple in-memory caches."""
+from collections import OrderedDict
+
+from twisted.internet import defer
+
+
+class LRUCache:
+    """A dict-like cache that discards the least recently used items.
+
+    The cache is bounded by its number of items and optionally by the total
+    size of its values, as computed by ``sizeof``.
+    """
+
+    def __init__(self, maxsize, maxbytes=None, sizeof=len):
+        """Constructor
+
+        Args:
+          maxsize (int): the maximum number of items to retain.
+          maxbytes (int, optional): the maximum total size of the values.
+          sizeof (callable): computes the size of a value.
+        """
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+
+    def __contains__(self, key):
+        """Is the key cached, does not count as a use."""
+        return key in self._data
+
+    def __len__(self):
+        """Number of items cached."""
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Get an item, marking it as most recently used."""
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        """Add an item, evicting the least recently used if necessary."""
+        self.pop(key)
+        if self.maxbytes is not None:
+            size = self.sizeof(value)
+            if size > self.maxbytes:
+                # Would evict everything else and then itself
+                return
+            self._sizes[key] = size
+            self.nbytes += size
+        self._data[key] = value
+        while len(self._data) > self.maxsize or (
+            self.maxbytes is not None and self.nbytes > self.maxbytes
+        ):
+            oldest, _ = self._data.popitem(last=False)
+            self.nbytes -= self._sizes.pop(oldest, 0)
+
+    def pop(self, key, default=None):
+        """Remove an item."""
+        self.nbytes -= self._sizes.pop(key, 0)
+        return self._data.pop(key, default)
+
+    def clear(self):
+        """Remove everything."""
+        self._data.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+
+
+class SingleFlight:
+    """Coalesce concurrent lookups of the same key into one call."""
+
+    def __init__(self):
+        """Constructor"""
+        self._waiting = {}
+
+    def __contains__(self, key):
+        """Is a lookup of this key in flight."""
+        return key in self._waiting
+
+    def __len__(self):
+        """Number of lookups in flight."""
+        return len(self._waiting)
+
+    def run(self, key, func, *args, **kwargs):
+        """Call func unless a call for this key is already in flight.
+
+        Args:
+          key: identifies the lookup.
+          func (callable): does the lookup, may return a Deferred.
+
+        Returns:
+          twisted.internet.defer.Deferred: fires with the lookup's result.
+        """
+        df = defer.Deferred()
+        waiters = self._waiting.get(key)
+        if waiters is not None:
+            waiters.append(df)
+            return df
+        self._waiting[key] = [df]
+        call = defer.maybeDeferred(func, *args, **kwargs)
+        call.addBoth(self._done, key)
+        return df
+
+    def _done(self, res, key):
+        """Hand the result to everybody waiting on it."""
+        for df in self._waiting.pop(key):
+            df.callback(res)
@@ -0,0 +1,618 @@
+"""Storage of the recent messages logged within each chatroom."""
+import json
+import time
+import zlib
+from array import array
+
+from twisted.python import log
+
+# The number of messages we retain for each chatroom, unless configured
+DEFAULT_DEPTH = 40
+# The most messages a chatroom may be configured to retain
+MAX_DEPTH = 1000
+# The messages kept by a room when trimmed to fit the memory budget
+MIN_DEPTH = 5
+# Estimated bytes taken by an entry's objects and cached renderings, in
+# addition to its strings
+ENTRY_OVERHEAD = 400
+# The attributes of a ChatLogEntry that are persisted
+ENTRY_FIELDS = (
+    "seqnum",
+    "timestamp",
+    "log",
+    "author",
+    "product_id",
+    "product_text",
+    "txtlog",
+)
+
+
+class SharedText:
+    """Product text shared by the entries of every room it was logged to.
+
+    The text is held zlib compressed and is only inflated when read, which
+    is rare as the RSS rendering of an entry is cached.
+    """
+
+    __slots__ = ("product_id", "data", "size", "refs")
+
+    def __init__(self, product_id, text):
+        """Constructor"""
+        raw = text.encode("utf-8")
+        self.product_id = product_id
+        self.data = zlib.compress(raw)
+        self.size = len(raw)
+        # The number of logged entries holding this text
+        self.refs = 0
+
+    def __str__(self):
+        """Inflate the text."""
+        return zlib.decompress(self.data).decode("utf-8")
+
+
+class ChatLogEntry:
+    """A message that was logged within a chatroom."""
+
+    # rss_item is the cached RSS rendering, see iembot.util.rss_item_xml
+    __slots__ = tuple(f for f in ENTRY_FIELDS if f != "product_text") + (
+        "_text",
+        "_json",
+        "rss_item",
+    )
+
+    def __init__(
+        self,
+        seqnum,
+        timestamp,
+        log,
+        author,
+        product_id,
+        product_text,
+        txtlog,
+    ):
+        """Constructor"""
+        self.seqnum = seqnum
+        self.timestamp = timestamp
+        self.log = log
+        self.author = author
+        self.product_id = product_id
+        self.product_text = product_text
+        self.txtlog = txtlog
+        self._json = None
+        self.rss_item = None
+
+    @property
+    def product_text(self):
+        """The product text, inflated if it is shared."""
+        return str(self._text)
+
+    @product_text.setter
+    def product_text(self, value):
+        """Set the product text."""
+        self._text = value
+
+    @property
+    def shared_text(self):
+        """The SharedText held, or None for text held privately."""
+        return self._text if isinstance(self._text, SharedText) else None
+
+    def footprint(self):
+        """Estimate the bytes held by this entry, aside from shared text."""
+        # The JSON rendering repeats the log
+        size = (
+            ENTRY_OVERHEAD
+            + 2 * len(self.log)
+            + len(self.txtlog)
+            + len(self.product_id)
+        )
+        if self.shared_text is None:
+            size += len(self._text)
+        return size
+
+    @classmethod
+    def from_legacy(cls, entry):
+        """Convert a legacy ROOM_LOG_ENTRY namedtuple into an entry."""
+        if isinstance(entry, cls):
+            return entry
+        return cls(*entry)
+
+    def __getstate__(self):
+        """Do not pickle the cached renderings or the SharedText."""
+        return {attr: getattr(self, attr) for attr in ENTRY_FIELDS}
+
+    def __setstate__(self, state):
+        """Unpickle."""
+        if isinstance(state, tuple):
+            # default __slots__ pickling is (None, slotstate)
+            state = state[1]
+        for attr in ENTRY_FIELDS:
+            setattr(self, attr, state[attr])
+        self._json = None
+        self.rss_item = None
+
+    def json_fragment(self):
+        """Return this entry's JSON object as used by the room service.
+
+        This is rendered once and then cached.
+        """
+        if self._json is None:
+            ts = self.timestamp
+            self._json = json.dumps(
+                {
+                    "seqnum": self.seqnum,
+                    "ts": (
+                        f"{ts[:4]}-{ts[4:6]}-{ts[6:8]} "
+                        f"{ts[8:10]}:{ts[10:12]}:{ts[12:14]}"
+                    ),
+                    "author": self.author,
+                    "product_id": self.product_id,
+                    "message": self.log,
+                }
+            )
+        return self._json
+
+    def __repr__(self):
+        """Representation"""
+        return (
+            f"ChatLogEntry(seqnum={self.seqnum}, author={self.author}, "
+            f"product_id={self.product_id})"
+        )
+
+
+class RoomLog:
+    """Fixed capacity ring buffer of a chatroom's messages.
+
+    Iteration and integer indexing are newest first, which matches the
+    ordering of the python list this replaces.  Entries are appended with
+    increasing sequence numbers, so the parallel ``array`` of seqnums is
+    sorted and supports a binary search for ``since``.
+    """
+
+    __slots__ = (
+        "_entries",
+        "_seqnums",
+        "_start",
+        "_size",
+        "revision",
+        "updated",
+        "nbytes",
+        "last_read",
+        "last_logged",
+    )
+
+    def __init__(self, capacity=DEFAULT_DEPTH):
+        """Constructor"""
+        self._entries = [None] * capacity
+        self._seqnums = array("q", [0] * capacity)
+        self._start = 0  # physical offset of the oldest entry
+        self._size = 0
+        # Bumped when an entry is updated in place, as the seqnums are not
+        self.revision = 0
+        # Seconds since the epoch of the last such update
+        self.updated = 0
+        # Estimated size of the entries, see ChatLogEntry.footprint
+        self.nbytes = 0
+        # Seconds since the epoch the log was last read or appended to
+        self.last_read = 0
+        self.last_logged = 0
+
+    @property
+    def capacity(self):
+        """The maximum number of entries retained."""
+        return len(self._entries)
+
+    def __len__(self):
+        """Number of entries currently held."""
+        return self._size
+
+    def _physical(self, offset):
+        """Convert an oldest-first logical offset into a buffer index."""
+        return (self._start + offset) % len(self._entries)
+
+    def append(self, entry):
+        """Add a new (newest) entry, returning any entry that was evicted.
+
+        Args:
+          entry (ChatLogEntry): the entry to add.
+
+        Returns:
+          ChatLogEntry or None: the oldest entry, if it was pushed out.
+        """
+        evicted = None
+        self.nbytes += entry.footprint()
+        if self._size == len(self._entries):
+            evicted = self._entries[self._start]
+            self.nbytes -= evicted.footprint()
+            self._entries[self._start] = entry
+            self._seqnums[self._start] = entry.seqnum
+            self._start = self._physical(1)
+            return evicted
+        idx = self._physical(self._size)
+        self._entries[idx] = entry
+        self._seqnums[idx] = entry.seqnum
+        self._size += 1
+        return evicted
+
+    def trim(self, keep):
+        """Evict the oldest entries, keeping the newest ``keep``.
+
+        Returns:
+          list: the evicted entries, oldest first.
+        """
+        evicted = []
+        while self._size > keep:
+            entry = self._entries[self._start]
+            self._entries[self._start] = None
+            self.nbytes -= entry.footprint()
+            self._start = self._physical(1)
+            self._size -= 1
+            evicted.append(entry)
+        if evicted:
+            # The feeds no longer hold these entries
+            self.revision += 1
+            self.updated = int(time.time())
+        return evicted
+
+    def resize(self, capacity):
+        """Change the capacity, evicting the oldest entries that no longer fit.
+
+        Returns:
+          list: the evicted entries, oldest first.
+        """
+        evicted = self.trim(capacity)
+        entries = self.oldest_first()
+        self._entries = entries + [None] * (capacity - len(entries))
+        self._seqnums = array("q", [e.seqnum for e in entries])
+        self._seqnums.extend([0] * (capacity - len(entries)))
+        self._start = 0
+        return evicted
+
+    def __getitem__(self, key):
+        """Newest first indexing, slices return lists."""
+        if isinstance(key, slice):
+            return list(self)[key]
+        if key < 0:
+            key += self._size
+        if key < 0 or key >= self._size:
+            raise IndexError("RoomLog index out of range")
+        return self._entries[self._physical(self._size - 1 - key)]
+
+    def __iter__(self):
+        """Iterate newest first."""
+        entries = self._entries
+        for offset in range(self._size - 1, -1, -1):
+            yield entries[self._physical(offset)]
+
+    def oldest_first(self):
+        """Return a list of the entries, oldest first."""
+        return [
+            self._entries[self._physical(offset)]
+            for offset in range(self._size)
+        ]
+
+    def newest_seqnum(self):
+        """Return the newest seqnum or None when empty."""
+        if self._size == 0:
+            return None
+        return self._seqnums[self._physical(self._size - 1)]
+
+    def _bisect(self, seqnum):
+        """Return the logical offset of the first entry > seqnum."""
+        lo, hi = 0, self._size
+        seqnums = self._seqnums
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if seqnums[self._physical(mid)] <= seqnum:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, seqnum):
+        """Return the entry with this seqnum, or None."""
+        offset = self._bisect(seqnum) - 1
+        if offset < 0:
+            return None
+        entry = self._entries[self._physical(offset)]
+        return entry if entry.seqnum == seqnum else None
+
+    def since(self, seqnum):
+        """Return a list of the entries newer than seqnum, oldest first.
+
+        Args:
+          seqnum (int): the last seqnum the caller has seen.
+        """
+        newest = self.newest_seqnum()
+        if newest is None or newest <= seqnum:
+            return []
+        return [
+            self._entries[self._physical(offset)]
+            for offset in range(self._bisect(seqnum), self._size)
+        ]
+
+
+class ChatLog:
+    """The collection of RoomLogs, keyed by chatroom name."""
+
+    def __init__(self, depth=DEFAULT_DEPTH, maxbytes=None):
+        """Constructor
+
+        Args:
+          depth (int): the messages retained by rooms without a configured
+            depth, see set_depth.
+          maxbytes (int, optional): the memory budget, see enforce_budget.
+        """
+        self.depth = depth
+        self.maxbytes = maxbytes
+        self._rooms = {}
+        # room -> configured depth
+        self.depths = {}
+        # product_id -> SharedText held by logged entries
+        self.texts = {}
+        # compressed bytes of the SharedText held
+        self.text_bytes = 0
+        # Called with (room, entries) evicted, see iembot.history
+        self.spill = None
+        self.budget_evicted = 0
+        # Callables interested in new entries, keyed by room
+        self._listeners = {}
+
+    def __contains__(self, room):
+        """Do we have a log for this room."""
+        return room in self._rooms
+
+    def __getitem__(self, room):
+        """Get the RoomLog for a room, which is marked as read."""
+        roomlog = self._rooms[room]
+        roomlog.last_read = time.time()
+        return roomlog
+
+    def __iter__(self):
+        """Iterate over the room names."""
+        return iter(self._rooms)
+
+    def __len__(self):
+        """The number of rooms with logs."""
+        return len(self._rooms)
+
+    def get(self, room, default=None):
+        """Get the RoomLog for a room, if it exists, marking it as read."""
+        roomlog = self._rooms.get(room)
+        if roomlog is None:
+            return default
+        roomlog.last_read = time.time()
+        return roomlog
+
+    def keys(self):
+        """Room names."""
+        return self._rooms.keys()
+
+    def items(self):
+        """Room names and their RoomLogs."""
+        return self._rooms.items()
+
+    def room(self, room):
+        """Get the RoomLog for a room, creating it if necessary."""
+        roomlog = self._rooms.get(room)
+        if roomlog is None:
+            roomlog = RoomLog(self.depths.get(room, self.depth))
+            self._rooms[room] = roomlog
+        return roomlog
+
+    def set_depth(self, room, depth):
+        """Set the number of messages a room retains.
+
+        Args:
+          room (str): the room.
+          depth (int or None): None for the default depth.
+        """
+        if depth is None:
+            self.depths.pop(room, None)
+            depth = self.depth
+        else:
+            depth = max(1, min(MAX_DEPTH, int(depth)))
+            self.depths[room] = depth
+        roomlog = self._rooms.get(room)
+        if roomlog is None or roomlog.capacity == depth:
+            return
+        self._evicted(room, roomlog.resize(depth))
+
+    def share(self, product_id, text):
+        """Return the SharedText for a product, for logging to entries.
+
+        Args:
+          product_id (str): the product.
+          text (str): its text, only compressed if it is not held already.
+
+        Returns:
+          SharedText
+        """
+        shared = self.texts.get(product_id)
+        if shared is None:
+            shared = SharedText(product_id, text)
+        return shared
+
+    def _acquire(self, entry):
+        """Count the entry's reference to its shared text."""
+        shared = entry.shared_text
+        if shared is None:
+            return
+        # Entries replayed from disk are merged with the text held
+        held = self.texts.setdefault(shared.product_id, shared)
+        if held is shared and held.refs == 0:
+            self.text_bytes += len(held.data)
+        entry.product_text = held
+        held.refs += 1
+
+    def _release(self, entry):
+        """Drop the entry's reference to its shared text."""
+        shared = entry.shared_text
+        if shared is None:
+            return
+        shared.refs -= 1
+        if shared.refs <= 0 and self.texts.get(shared.product_id) is shared:
+            del self.texts[shared.product_id]
+            self.text_bytes -= len(shared.data)
+
+    def _evicted(self, room, entries):
+        """Release the text of evicted entries and spill them."""
+        if not entries:
+            return
+        for entry in entries:
+            self._release(entry)
+        if self.spill is not None:
+            self.spill(room, entries)
+
+    def append(self, room, entry):
+        """Log an entry to a room.
+
+        Returns:
+          ChatLogEntry or None: the entry that was evicted, if any.
+        """
+        self._acquire(entry)
+        roomlog = self.room(room)
+        roomlog.last_logged = time.time()
+        evicted = roomlog.append(entry)
+        if evicted is not None:
+            self._evicted(room, [evicted])
+        for func in list(self._listeners.get(room, ())):
+            try:
+                func(entry)
+            except Exception as exp:
+                log.err(exp)
+        return evicted
+
+    def update(self, room, entry, **fields):
+        """Change fields of an entry that was already logged.
+
+        Args:
+          room (str): the room the entry was logged to.
+          entry (ChatLogEntry): the entry.
+          fields: the new values of ENTRY_FIELDS, other than seqnum, the
+            product_text may be a SharedText.
+
+        Returns:
+          bool: False if the entry is no longer held by the room.
+        """
+        roomlog = self._rooms.get(room)
+        if roomlog is None or roomlog.find(entry.seqnum) is not entry:
+            return False
+        self._release(entry)
+        roomlog.nbytes -= entry.footprint()
+        for attr, value in fields.items():
+            setattr(entry, attr, value)
+        roomlog.nbytes += entry.footprint()
+        self._acquire(entry)
+        # Drop the cached renderings
+        entry._json = None
+        entry.rss_item = None
+        roomlog.revision += 1
+        roomlog.updated = int(time.time())
+        return True
+
+    def add_listener(self, room, func):
+        """Call func(entry) whenever an entry is logged to room."""
+        self._listeners.setdefault(room, set()).add(func)
+
+    def remove_listener(self, room, func):
+        """Remove a listener added by add_listener."""
+        listeners = self._listeners.get(room)
+        if listeners is None:
+            return
+        listeners.discard(func)
+        if not listeners:
+            del self._listeners[room]
+
+    def listener_count(self):
+        """The number of listeners currently registered."""
+        return sum(len(funcs) for funcs in self._listeners.values())
+
+    def load(self, room, entries):
+        """Replace a room's log with the provided entries (newest first)."""
+        old = self._rooms.get(room)
+        if old is not None:
+            for entry in old:
+                self._release(entry)
+        roomlog = RoomLog(self.depths.get(room, self.depth))
+        for entry in reversed(entries[: roomlog.capacity]):
+            entry = ChatLogEntry.from_legacy(entry)
+            self._acquire(entry)
+            roomlog.append(entry)
+        self._rooms[room] = roomlog
+        return roomlog
+
+    def newest_seqnum(self):
+        """The largest seqnum found over all rooms."""
+        seqnums = [
+            seqnum
+            for seqnum in (rl.newest_seqnum() for rl in self._rooms.values())
+            if seqnum is not None
+        ]
+        return max(seqnums) if seqnums else 0
+
+    @property
+    def nbytes(self):
+        """Estimated bytes held by the entries and their shared text."""
+        return self.text_bytes + sum(rl.nbytes for rl in self._rooms.values())
+
+    def enforce_budget(self):
+        """Trim rooms until the chatlog fits within maxbytes.
+
+        The rooms read least recently, and then the ones logged to least
+        recently, are trimmed to MIN_DEPTH first.  Trimming goes on to 90%
+        of the budget, so that this is not needed again right away.
+
+        Returns:
+          int: the number of entries evicted.
+        """
+        if self.maxbytes is None:
+            return 0
+        nbytes = self.nbytes
+        if nbytes <= self.maxbytes:
+            return 0
+        target = self.maxbytes * 0.9
+        evicted = 0
+        rooms = sorted(
+            self._rooms.items(),
+            key=lambda item: (item[1].last_read, item[1].last_logged),
+        )
+        for room, roomlog in rooms:
+            if nbytes <= target:
+                break
+            before = roomlog.nbytes + self.text_bytes
+            entries = roomlog.trim(MIN_DEPTH)
+            self._evicted(room, entries)
+            evicted += len(entries)
+            nbytes -= before - (roomlog.nbytes + self.text_bytes)
+        self.budget_evicted += evicted
+        log.msg(
+            f"Chatlog over budget, evicted {evicted} entries, now {nbytes} "
+            f"of {self.maxbytes} bytes"
+        )
+        return evicted
+
+    def stats(self):
+        """Return metrics about the memory held."""
+        return {
+            "chatlog.rooms": len(self._rooms),
+            "chatlog.entries": sum(len(rl) for rl in self._rooms.values()),
+            "chatlog.bytes": self.nbytes,
+            "chatlog.maxbytes": self.maxbytes,
+            "chatlog.budget_evicted": self.budget_evicted,
+            "chatlog.texts": len(self.texts),
+            "chatlog.texts_bytes": self.text_bytes,
+            "chatlog.texts_raw_bytes": sum(
+                shared.size for shared in self.texts.values()
+            ),
+            "chatlog.texts_refs": sum(
+                shared.refs for shared in self.texts.values()
+            ),
+        }
+
+    def snapshot(self):
+        """Return a picklable dict of room to list of entries, newest first.
+
+        The entries are not copied, an update made while a snapshot is
+        being written out is also journaled, so it is not lost.
+        """
+        return {rm: list(rl) for rm, rl in list(self._rooms.items())}
@@ -0,0 +1,168 @@
+"""Health tracking and circuit breakers for outbound endpoints."""
+from twisted.internet import reactor
+from twisted.python import log
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """The health of one destination, a webhook URL or a twitter account.
+
+    The breaker opens after ``threshold`` consecutive failures and then
+    lets a single probe through every ``probe_interval`` seconds, doubling
+    the interval each time a probe fails.  A successful probe closes it.
+    """
+
+    __slots__ = (
+        "state",
+        "failures",
+        "successes",
+        "total_failures",
+        "opened_at",
+        "next_probe",
+        "interval",
+        "latency",
+        "last_error",
+    )
+
+    def __init__(self):
+        """Constructor"""
+        self.state = CLOSED
+        self.failures = 0
+        self.successes = 0
+        self.total_failures = 0
+        self.opened_at = None
+        self.next_probe = None
+        self.interval = None
+        # Exponentially weighted moving average in seconds
+        self.latency = None
+        self.last_error = None
+
+    def as_dict(self):
+        """Return the state for the JSON service."""
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "successes": self.successes,
+            "failures": self.total_failures,
+            "opened_at": self.opened_at,
+            "next_probe": self.next_probe,
+            "latency": self.latency,
+            "last_error": self.last_error,
+        }
+
+
+class HealthRegistry:
+    """I hold the circuit breakers of outbound destinations."""
+
+    def __init__(
+        self, clock=None, threshold=5, probe_interval=60, max_interval=3600
+    ):
+        """Constructor
+
+        Args:
+          clock (IReactorTime): defaults to the reactor.
+          threshold (int): consecutive failures that open a breaker.
+          probe_interval (float): seconds before the first probe.
+          max_interval (float): the longest time between probes.
+        """
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+        self.max_interval = max_interval
+        self._breakers = {}
+        self.short_circuited = 0
+
+    def get(self, key):
+        """Return the breaker for a destination, or None."""
+        return self._breakers.get(key)
+
+    def allow(self, key):
+        """May we send to this destination now.
+
+        An open breaker allows one probe once its interval has passed.
+        """
+        breaker = self._breakers.get(key)
+        if breaker is None or breaker.state == CLOSED:
+            return True
+        if (
+            breaker.state == OPEN
+            and self.clock.seconds() >= breaker.next_probe
+        ):
+            log.msg(f"Probing {key} to see if it has recovered")
+            breaker.state = HALF_OPEN
+            return True
+        self.short_circuited += 1
+        return False
+
+    def success(self, key, latency=None):
+        """Record a successful delivery."""
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker()
+            self._breakers[key] = breaker
+        if breaker.state != CLOSED:
+            log.msg(f"Circuit for {key} closed")
+        breaker.state = CLOSED
+        breaker.failures = 0
+        breaker.successes += 1
+        breaker.opened_at = None
+        breaker.next_probe = None
+        breaker.interval = None
+        if latency is not None:
+            if breaker.latency is None:
+                breaker.latency = latency
+            else:
+                breaker.latency = 0.8 * breaker.latency + 0.2 * latency
+
+    def failure(self, key, error=None):
+        """Record a failed delivery."""
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker()
+            self._breakers[key] = breaker
+        now = self.clock.seconds()
+        breaker.failures += 1
+        breaker.total_failures += 1
+        breaker.last_error = None if error is None else str(error)[:200]
+        if breaker.state == HALF_OPEN:
+            breaker.interval = min(self.max_interval, breaker.interval * 2)
+        elif breaker.state == CLOSED and breaker.failures >= self.threshold:
+            log.msg(f"Circuit for {key} opened after {breaker.failures}")
+            breaker.opened_at = now
+            breaker.interval = self.probe_interval
+        else:
+            return
+        breaker.state = OPEN
+        breaker.next_probe = now + breaker.interval
+
+    def inconclusive(self, key):
+        """Record an attempt that says nothing about the health.
+
+        A probe that could not tell, being rate limited say, returns the
+        breaker to open without backing off, so the next send probes again.
+        """
+        breaker = self._breakers.get(key)
+        if breaker is not None and breaker.state == HALF_OPEN:
+            breaker.state = OPEN
+
+    def forget(self, key):
+        """Drop the breaker of a destination."""
+        self._breakers.pop(key, None)
+
+    def snapshot(self):
+        """Return the state of every breaker for the JSON service."""
+        counts = {CLOSED: 0, OPEN: 0, HALF_OPEN: 0}
+        breakers = {}
+        for key, breaker in self._breakers.items():
+            counts[breaker.state] += 1
+            breakers[key] = breaker.as_dict()
+        return {
+            "counts": counts,
+            "short_circuited": self.short_circuited,
+            "breakers": breakers,
+        }
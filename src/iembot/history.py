@@ -0,0 +1,227 @@
+"""On-disk history of the chatlog entries that no longer fit in memory.
+
+Entries evicted from the in-memory chatlog are spilled to a SQLite
+database, keyed by room and seqnum, from which older pages of a room are
+served.  All database work happens in the threadpool, each thread having
+its own connection.  Shared product text is stored once, like the journal
+does, see iembot.chatlog.SharedText.
+"""
+import sqlite3
+import threading
+
+from twisted.internet import threads
+from twisted.python import log
+
+from iembot.chatlog import ChatLogEntry
+from iembot.products import PENDING_TEXT
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    room TEXT NOT NULL,
+    seqnum INTEGER NOT NULL,
+    timestamp TEXT NOT NULL,
+    log TEXT,
+    author TEXT,
+    product_id TEXT,
+    product_text TEXT,
+    txtlog TEXT,
+    PRIMARY KEY (room, seqnum)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_timestamp_idx ON entries(timestamp);
+CREATE TABLE IF NOT EXISTS texts (
+    product_id TEXT PRIMARY KEY,
+    product_text TEXT
+);
+"""
+# The most entries served in one page
+MAX_LIMIT = 500
+
+
+class ChatLogHistory:
+    """I spill evicted chatlog entries to SQLite and page through them."""
+
+    def __init__(self, path):
+        """Constructor
+
+        Args:
+          path (str): the filename of the database.
+        """
+        self.path = path
+        self._local = threading.local()
+        # (room, entry) evicted, but not written yet
+        self._pending = []
+        # Those being written by the flush in progress
+        self._writing = []
+        self._flushing = None
+        self.spilled = 0
+        self.queries = 0
+
+    def _connection(self):
+        """Return this thread's connection, called from a thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            # Let readers carry on while we write
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def add(self, room, entries):
+        """Queue evicted entries for writing at the next flush.
+
+        Args:
+          room (str): the room the entries were logged to.
+          entries (list): the ChatLogEntry instances.
+        """
+        for entry in entries:
+            self._pending.append((room, entry))
+
+    def flush(self):
+        """Write the queued entries in a background thread.
+
+        Returns:
+          twisted.internet.defer.Deferred or None if there is nothing to do
+        """
+        if not self._pending or self._flushing is not None:
+            return None
+        pending = self._pending
+        self._pending = []
+        self._writing = pending
+        df = threads.deferToThread(self._write, pending)
+        self._flushing = df
+        df.addCallback(self._flushed, pending)
+        df.addErrback(self._flush_failed, pending)
+        return df
+
+    def _write(self, pending):
+        """Called from a thread to write entries."""
+        entries = []
+        texts = {}
+        for room, entry in pending:
+            shared = entry.shared_text
+            text = None
+            if shared is None:
+                text = entry.product_text
+            elif shared.product_id not in texts:
+                texts[shared.product_id] = str(shared)
+            entries.append(
+                (
+                    room,
+                    entry.seqnum,
+                    entry.timestamp,
+                    entry.log,
+                    entry.author,
+                    entry.product_id,
+                    text,
+                    entry.txtlog,
+                    PENDING_TEXT,
+                    PENDING_TEXT,
+                )
+            )
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO texts VALUES (?, ?)", texts.items()
+            )
+            # Entries replayed from the journal may be spilled again, but
+            # only the text of an entry spilled before it arrived changes
+            conn.executemany(
+                "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (room, seqnum) DO UPDATE "
+                "SET product_text = excluded.product_text "
+                "WHERE entries.product_text = ? "
+                "AND excluded.product_text IS NOT ?",
+                entries,
+            )
+
+    def _flushed(self, _res, pending):
+        """The entries are on disk."""
+        self._flushing = None
+        self._writing = []
+        self.spilled += len(pending)
+
+    def _flush_failed(self, err, pending):
+        """Put the entries back, to try again at the next flush."""
+        self._flushing = None
+        self._writing = []
+        self._pending[:0] = pending
+        log.err(err)
+
+    def before(self, room, seqnum, limit):
+        """Get the entries of a room older than seqnum.
+
+        Args:
+          room (str): the room.
+          seqnum (int): the entries returned have smaller seqnums.
+          limit (int): the most entries to return, the newest of them.
+
+        Returns:
+          twisted.internet.defer.Deferred: fires with a list of entries,
+            oldest first.
+        """
+        limit = max(1, min(MAX_LIMIT, limit))
+        self.queries += 1
+        # Also those still on their way to disk
+        pending = {
+            entry.seqnum: entry
+            for rm, entry in self._writing + self._pending
+            if rm == room and entry.seqnum < seqnum
+        }
+        df = threads.deferToThread(self._query, room, seqnum, limit)
+        df.addCallback(self._merge, pending, limit)
+        return df
+
+    def _query(self, room, seqnum, limit):
+        """Called from a thread to read entries, newest first."""
+        cursor = self._connection().execute(
+            "SELECT e.seqnum, e.timestamp, e.log, e.author, e.product_id, "
+            "COALESCE(e.product_text, t.product_text, ''), e.txtlog "
+            "FROM entries e LEFT JOIN texts t "
+            "ON e.product_text IS NULL AND e.product_id = t.product_id "
+            "WHERE e.room = ? AND e.seqnum < ? "
+            "ORDER BY e.seqnum DESC LIMIT ?",
+            (room, seqnum, limit),
+        )
+        return [ChatLogEntry(*row) for row in cursor.fetchall()]
+
+    @staticmethod
+    def _merge(entries, pending, limit):
+        """Combine the entries read with those pending, oldest first."""
+        for entry in entries:
+            pending.setdefault(entry.seqnum, entry)
+        return [pending[seqnum] for seqnum in sorted(pending)[-limit:]]
+
+    def prune(self, timestamp):
+        """Delete the entries logged before timestamp in a thread.
+
+        Args:
+          timestamp (str): %Y%m%d%H%M%S in UTC, like the entries.
+
+        Returns:
+          twisted.internet.defer.Deferred
+        """
+        df = threads.deferToThread(self._prune, timestamp)
+        df.addErrback(log.err)
+        return df
+
+    def _prune(self, timestamp):
+        """Called from a thread to delete old entries and orphaned text."""
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(
+                "DELETE FROM entries WHERE timestamp < ?", (timestamp,)
+            )
+            conn.execute(
+                "DELETE FROM texts WHERE product_id NOT IN "
+                "(SELECT product_id FROM entries WHERE product_text IS NULL)"
+            )
+        log.msg(f"Pruned {cursor.rowcount} entries from {self.path}")
+
+    def stats(self):
+        """Return metrics about the history."""
+        return {
+            "history.pending": len(self._pending),
+            "history.spilled": self.spilled,
+            "history.queries": self.queries,
+        }
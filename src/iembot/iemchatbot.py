@@ -2,13 +2,19 @@
 import datetime
 import re
 
-from twisted.internet import reactor
 from twisted.mail.smtp import SMTPSenderFactory
 from twisted.python import log
 from twisted.words.protocols.jabber import jid
 from twisted.words.xish import xpath
 
+import iembot.util as botutil
 from iembot import basicbot
+from iembot.chatlog import ChatLogEntry
+from iembot.products import (
+    PENDING_TEXT,
+    PRODUCT_UNAVAILABLE,
+    pop_inline_text,
+)
 from iembot.webhooks import route as webhooks_route
 
 # http://stackoverflow.com/questions/7016602
@@ -59,7 +65,6 @@ class JabberClient(basicbot.basicbot):
         if a is None or not a:
             return
 
-        roomlog = self.chatlog.setdefault(room, [])
         ts = datetime.datetime.utcnow()
 
         product_id = ""
@@ -71,60 +76,32 @@ class JabberClient(basicbot.basicbot):
         if html is not None:
             log_entry = html[0].toXml()
 
-        if len(roomlog) > 40:
-            roomlog.pop()
-
-        def writelog(product_text=None):
-            """Actually do what we want to do"""
-            if product_text is None or product_text == "":
-                product_text = "Sorry, product text is unavailable."
-            roomlog.insert(
-                0,
-                basicbot.ROOM_LOG_ENTRY(
-                    seqnum=self.next_seqnum(),
-                    timestamp=ts.strftime("%Y%m%d%H%M%S"),
-                    log=log_entry,
-                    author=res,
-                    product_id=product_id,
-                    product_text=product_text,
-                    txtlog=body,
-                ),
+        product_text = PRODUCT_UNAVAILABLE
+        if product_id != "":
+            # Logged to another room already, or cached ready to share
+            product_text = self.chatlog.texts.get(product_id)
+            if product_text is None:
+                text = self.products.cached(product_id)
+                if text == "":
+                    product_text = PRODUCT_UNAVAILABLE
+                elif text is not None:
+                    product_text = self.chatlog.share(product_id, text)
+        entry = ChatLogEntry(
+            seqnum=self.next_seqnum(),
+            timestamp=ts.strftime("%Y%m%d%H%M%S"),
+            log=log_entry,
+            author=res,
+            product_id=product_id,
+            product_text=product_text or PENDING_TEXT,
+            txtlog=body,
+        )
+        self.log_chatroom_entry(room, entry)
+        if product_text is None:
+            # Fill in the text once memcache has it
+            self.products.get(product_id).addCallback(
+                self.set_product_text, room, entry
             )
 
-        if product_id == "":
-            writelog()
-            return
-
-        def got_data(res, trip):
-            """got a response!"""
-            (_flag, data) = res
-            if data is None:
-                if trip < 5:
-                    reactor.callLater(10, memcache_fetch, trip)
-                else:
-                    writelog()
-                return
-            if trip > 1:
-                log.msg(f"memcache lookup of {product_id} succeeded")
-            # log.msg("Got a response! res: %s" % (res, ))
-            writelog(data.decode("ascii", "ignore"))
-
-        def no_data(mixed):
-            """got no data"""
-            log.err(mixed)
-            writelog()
-
-        def memcache_fetch(trip):
-            """fetch please"""
-            trip += 1
-            if trip > 1:
-                log.msg(f"memcache_fetch(trip={trip}, product_id={product_id}")
-            defer = self.memcache_client.get(product_id.encode("utf-8"))
-            defer.addCallback(got_data, trip)
-            defer.addErrback(no_data)
-
-        memcache_fetch(0)
-
     def processMessagePC(self, elem):
         # log.msg("processMessagePC() called from %s...." % (elem['from'],))
         _from = jid.JID(elem["from"])
@@ -151,53 +128,44 @@ class JabberClient(basicbot.basicbot):
             return
 
         if elem.x and elem.x.hasAttribute("channels"):
-            channels = elem.x["channels"].split(",")
+            channels = elem.x["channels"]
         else:
             # The body string contains
-            channel = bstring.split(":", 1)[0]
-            channels = [channel]
+            channels = bstring.split(":", 1)[0]
             # Send to chatroom, clip body of channel notation
             # elem.body.children[0] = meat
 
+        if elem.x:
+            # Seed the cache, so logging the echoes needs no memcache trip
+            product_text = pop_inline_text(elem.x)
+            if product_text and elem.x.hasAttribute("product_id"):
+                self.products.put(elem.x["product_id"], product_text)
+
         # Always send to botstalk
         elem["to"] = f"botstalk@{self.config['bot.mucservice']}"
         elem["type"] = "groupchat"
         self.send_groupchat_elem(elem)
 
-        alertedRooms = []
-        alertedPages = []
-        for channel in channels:
-            for room in self.routingtable.get(channel, []):
-                if room in alertedRooms:
-                    continue
-                alertedRooms.append(room)
-                elem["to"] = f"{room}@{self.config['bot.mucservice']}"
-                self.send_groupchat_elem(elem)
-            for user_id in self.tw_routingtable.get(channel, []):
+        self.send_groupchat_fanout(elem, self.routingtable.fanout(channels))
+        # Require the x.twitter attribute to be set to prevent
+        # confusion with some ingestors still sending tweets themself
+        if elem.x and elem.x.hasAttribute("twitter"):
+            lat = long = None
+            if elem.x.hasAttribute("lat") and elem.x.hasAttribute("long"):
+                lat = elem.x["lat"]
+                long = elem.x["long"]
+            # Shape the text once, not for each user
+            twttxt = botutil.safe_twitter_text(elem.x["twitter"])
+            for user_id in self.tw_routingtable.fanout(channels):
                 if user_id not in self.tw_users:
                     log.msg(
                         f"Failed to tweet due to no access_tokens {user_id}"
                     )
                     continue
-                # Require the x.twitter attribute to be set to prevent
-                # confusion with some ingestors still sending tweets themself
-                if not elem.x.hasAttribute("twitter"):
-                    continue
-                if user_id in alertedPages:
-                    continue
-                alertedPages.append(user_id)
-                lat = long = None
-                if (
-                    elem.x
-                    and elem.x.hasAttribute("lat")
-                    and elem.x.hasAttribute("long")
-                ):
-                    lat = elem.x["lat"]
-                    long = elem.x["long"]
                 # Finally, actually tweet, this is in basicbot
                 self.tweet(
                     user_id,
-                    elem.x["twitter"],
+                    twttxt,
                     twitter_media=elem.x.getAttribute("twitter_media"),
                     latitude=lat,
                     longitude=long,
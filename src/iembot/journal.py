@@ -0,0 +1,216 @@
+"""Append-only on-disk journal of chatlog entries.
+
+Each logged entry is written to the journal once, as a line of JSON.  Text
+shared between entries, see iembot.chatlog.SharedText, is only written with
+the first entry holding it and later entries refer to it.  The
+journal is periodically compacted in a background thread by writing out a
+snapshot of the in-memory chatlog and swapping it into place, so that the
+file does not grow without bound.  On startup, the journal is replayed to
+rebuild the chatlog.
+"""
+import json
+import os
+
+from twisted.internet import threads
+from twisted.python import log
+
+from iembot.chatlog import ENTRY_FIELDS, ChatLogEntry, SharedText
+
+
+def entry_to_record(room, entry, written=None):
+    """Convert a chatlog entry into a journal line.
+
+    Args:
+      room (str): the room the entry was logged to.
+      entry (ChatLogEntry): the entry.
+      written (set, optional): product_ids of the shared text already in
+        the journal, which is then left out of the line.  Updated.
+    """
+    rec = {"room": room}
+    shared = entry.shared_text
+    for attr in ENTRY_FIELDS:
+        if attr == "product_text" and shared is not None:
+            rec["shared"] = True
+            if written is not None and shared.product_id in written:
+                continue
+        rec[attr] = getattr(entry, attr)
+    if shared is not None and written is not None:
+        written.add(shared.product_id)
+    return json.dumps(rec) + "\n"
+
+
+def record_to_entry(line, texts=None):
+    """Convert a journal line into a (room, ChatLogEntry) tuple.
+
+    Args:
+      line (str): the journal line.
+      texts (dict, optional): product_id -> SharedText read so far, which
+        resolves lines referring to shared text.  Updated.
+    """
+    rec = json.loads(line)
+    room = rec.pop("room")
+    if rec.pop("shared", False):
+        if texts is None:
+            texts = {}
+        product_id = rec["product_id"]
+        if "product_text" in rec:
+            texts[product_id] = SharedText(product_id, rec["product_text"])
+        # KeyError for a reference to text we never saw, a corrupt line
+        rec["product_text"] = texts[product_id]
+    return room, ChatLogEntry(**rec)
+
+
+class ChatLogJournal:
+    """I write chatlog entries to an append-only file."""
+
+    def __init__(self, path):
+        """Constructor
+
+        Args:
+          path (str): the filename of the journal.
+        """
+        self.path = path
+        self._fh = None
+        # Lines that have not been written to disk yet
+        self._pending = []
+        # Lines logged while a compaction is running, None if not running
+        self._compacting = None
+        # product_ids of the shared text found in the journal file
+        self._written = set()
+
+    def append(self, room, entry):
+        """Queue an entry for writing at the next flush.
+
+        Appending an entry that was already journaled records an update.
+        """
+        if self._compacting is not None:
+            # The line will also land in the compacted journal, which may
+            # not have the text, so it is written out in full
+            line = entry_to_record(room, entry)
+            shared = entry.shared_text
+            if shared is not None:
+                self._written.add(shared.product_id)
+            self._compacting.append(line)
+        else:
+            line = entry_to_record(room, entry, self._written)
+        self._pending.append(line)
+
+    def flush(self):
+        """Write any pending lines to disk."""
+        if not self._pending:
+            return
+        lines = self._pending
+        self._pending = []
+        try:
+            if self._fh is None:
+                self._fh = open(self.path, "a", encoding="utf-8")
+            self._fh.writelines(lines)
+            self._fh.flush()
+        except Exception as exp:
+            log.err(exp)
+            # The lines holding text may have been lost with the rest
+            self._written = set()
+
+    def close(self):
+        """Flush and close the journal."""
+        self.flush()
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def replay(self, chatlog):
+        """Load the journal into the provided chatlog.
+
+        An entry with the seqnum of one already held is an update, which
+        replaces the fields of that entry.  Other entries that are not newer
+        than what the room already holds are skipped, so replaying on top of
+        an existing chatlog is harmless.
+
+        Returns:
+          int: the number of entries loaded.
+        """
+        if not os.path.isfile(self.path):
+            return 0
+        loaded = 0
+        texts = {}
+        with open(self.path, encoding="utf-8") as fh:
+            for linenum, line in enumerate(fh, start=1):
+                try:
+                    room, entry = record_to_entry(line, texts)
+                except Exception as exp:
+                    # Likely a partial line from an unclean shutdown
+                    log.msg(f"Skipping {self.path}:{linenum} {exp}")
+                    continue
+                roomlog = chatlog.get(room)
+                if roomlog is not None:
+                    newest = roomlog.newest_seqnum()
+                    if newest is not None and entry.seqnum <= newest:
+                        current = roomlog.find(entry.seqnum)
+                        if current is not None:
+                            fields = {
+                                attr: getattr(entry, attr)
+                                for attr in ENTRY_FIELDS
+                                if attr != "seqnum"
+                            }
+                            if entry.shared_text is not None:
+                                fields["product_text"] = entry.shared_text
+                            chatlog.update(room, current, **fields)
+                        continue
+                chatlog.append(room, entry)
+                loaded += 1
+        # Further lines may refer to the text in this file
+        self._written.update(texts)
+        return loaded
+
+    def compact(self, chatlog):
+        """Rewrite the journal from the chatlog in a background thread.
+
+        Returns:
+          twisted.internet.defer.Deferred
+        """
+        if self._compacting is not None:
+            log.msg("Journal compaction is already running, skipping")
+            return None
+        snapshot = chatlog.snapshot()
+        self._compacting = []
+        self._written = set()
+        tmpfn = f"{self.path}.tmp"
+        df = threads.deferToThread(self._write_snapshot, tmpfn, snapshot)
+        df.addCallback(self._swap, tmpfn)
+        df.addErrback(self._compact_failed)
+        return df
+
+    @staticmethod
+    def _write_snapshot(tmpfn, snapshot):
+        """Called from a thread to write the snapshot, oldest entry first.
+
+        Returns:
+          set: the product_ids of the shared text written.
+        """
+        written = set()
+        with open(tmpfn, "w", encoding="utf-8") as fh:
+            for room, entries in snapshot.items():
+                for entry in reversed(entries):
+                    fh.write(entry_to_record(room, entry, written))
+        return written
+
+    def _swap(self, written, tmpfn):
+        """Move the compacted journal into place."""
+        lines = self._compacting
+        self._compacting = None
+        # Along with the text of the lines logged meanwhile, in full
+        self._written |= written
+        with open(tmpfn, "a", encoding="utf-8") as fh:
+            fh.writelines(lines)
+        # Anything pending is either in the snapshot or in lines
+        self._pending = []
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        os.replace(tmpfn, self.path)
+        log.msg(f"Compacted chatlog journal {self.path}")
+
+    def _compact_failed(self, err):
+        """Compaction failed, we keep appending to the current journal."""
+        self._compacting = None
+        log.err(err)
@@ -0,0 +1,530 @@
+"""Outbound stanza handling."""
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.python import log
+from twisted.words.xish.domish import escapeToXml
+
+# Priority classes of outbound stanzas, lower values are sent first
+URGENT = 0
+NORMAL = 1
+LOW = 2
+PRIORITY_NAMES = ("urgent", "normal", "low")
+
+# Product PILs (the first three characters of the AFOS id) that are time
+# critical and jump ahead of routine products
+URGENT_PILS = frozenset(
+    ["TOR", "SVR", "FFW", "SMW", "EWW", "SQW", "DSW", "TSU", "SVS", "FFS"]
+)
+
+
+def stanza_priority(elem):
+    """Return the priority class of a message element.
+
+    Messages carrying a ``nwschat:nwsbot`` x element are products, those
+    with an urgent PIL in their product_id or channels are urgent.  Any
+    other message (timestamps, fortunes, command replies) is low priority.
+
+    Args:
+      elem (domish.Element): the message to classify.
+
+    Returns:
+      int
+    """
+    x = next(elem.elements("nwschat:nwsbot", "x"), None)
+    if x is None:
+        return LOW
+    # 202307101200-KDMX-WFUS53-TORDMX with an optional -BBB suffix
+    parts = x.getAttribute("product_id", "").split("-")
+    if len(parts) > 3 and parts[3][:3] in URGENT_PILS:
+        return URGENT
+    for channel in x.getAttribute("channels", "").split(","):
+        if channel[:3] in URGENT_PILS:
+            return URGENT
+    return NORMAL
+
+
+class StanzaTemplate:
+    """A stanza serialized once, with its 'to' attribute spliced in later.
+
+    Sending the same element to many rooms would otherwise serialize the
+    entire element, including its large XHTML body, for each room.
+    """
+
+    PLACEHOLDER = "__IEMBOT_STANZA_TO__"
+
+    def __init__(self, elem):
+        """Constructor
+
+        Args:
+          elem (domish.Element): the stanza to serialize.
+        """
+        original = elem.attributes.get("to")
+        elem["to"] = self.PLACEHOLDER
+        try:
+            xml = elem.toXml()
+        finally:
+            if original is None:
+                del elem.attributes["to"]
+            else:
+                elem["to"] = original
+        # The root element's attributes are serialized before any content
+        head, _, tail = xml.partition(f" to='{self.PLACEHOLDER}'")
+        self._head = head.encode("utf-8")
+        self._tail = tail.encode("utf-8")
+
+    def render(self, to):
+        """Return the serialized stanza addressed to the given JID.
+
+        Args:
+          to (str): the JID to address the stanza to.
+
+        Returns:
+          bytes
+        """
+        return b"".join(
+            [
+                self._head,
+                f" to='{escapeToXml(to, 1)}'".encode("utf-8"),
+                self._tail,
+            ]
+        )
+
+
+class TokenBucket:
+    """Token bucket rate limiter."""
+
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate, capacity, now):
+        """Constructor
+
+        Args:
+          rate (float): tokens added per second.
+          capacity (float): maximum number of tokens held.
+          now (float): current clock time.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = now
+
+    def refill(self, now):
+        """Add the tokens accumulated since we last looked."""
+        if now > self.stamp:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.stamp) * self.rate
+            )
+        self.stamp = now
+
+    def consume(self, amount, now):
+        """Take tokens if available, a full bucket allows an oversize take.
+
+        Returns:
+          bool: were the tokens taken.
+        """
+        self.refill(now)
+        if self.tokens < min(amount, self.capacity):
+            return False
+        self.tokens -= amount
+        return True
+
+    def delay(self, amount, now):
+        """Seconds until the amount could be consumed."""
+        self.refill(now)
+        needed = min(amount, self.capacity) - self.tokens
+        return max(0.0, needed / self.rate)
+
+
+class Lane:
+    """Queued stanzas of one priority class."""
+
+    __slots__ = ("queues", "ready", "skipped", "sent")
+
+    def __init__(self):
+        """Constructor"""
+        self.queues = {}
+        # Destinations with queued stanzas, in round-robin order
+        self.ready = deque()
+        # Times this lane had stanzas waiting while another lane was served
+        self.skipped = 0
+        self.sent = 0
+
+    def depth(self):
+        """Number of stanzas queued."""
+        return sum(len(q) for q in self.queues.values())
+
+
+class PendingQueue:
+    """Stanzas held for rooms that we have not joined yet.
+
+    Each room holds at most ``maxlen`` stanzas, the oldest being dropped
+    when full, and stanzas older than ``expire`` seconds are discarded
+    rather than sent once the room is joined.
+    """
+
+    def __init__(self, clock=None, maxlen=500, expire=600):
+        """Constructor
+
+        Args:
+          clock (IReactorTime): defaults to the reactor.
+          maxlen (int): stanzas held per room.
+          expire (float): seconds a stanza may be held.
+        """
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        self.maxlen = maxlen
+        self.expire = expire
+        self._queues = {}
+        self.queued = 0
+        self.flushed = 0
+        self.expired = 0
+        self.dropped = 0
+
+    def __contains__(self, key):
+        """Are stanzas held for this room."""
+        return key in self._queues
+
+    def __len__(self):
+        """Number of stanzas held."""
+        return sum(len(q) for q in self._queues.values())
+
+    def add(self, key, stanza, priority):
+        """Hold a stanza until the room is joined.
+
+        Args:
+          key (str): the room.
+          stanza (bytes): the serialized stanza.
+          priority (int): its outbound priority class.
+        """
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = deque()
+            self._queues[key] = queue
+        if len(queue) >= self.maxlen:
+            queue.popleft()
+            self.dropped += 1
+            log.msg(f"Pending queue for {key} is full, dropped oldest")
+        queue.append((self.clock.seconds(), stanza, priority))
+        self.queued += 1
+
+    def _unexpired(self, queue):
+        """Drop the expired head of a queue."""
+        cutoff = self.clock.seconds() - self.expire
+        while queue and queue[0][0] < cutoff:
+            queue.popleft()
+            self.expired += 1
+
+    def flush(self, key):
+        """Remove and return the unexpired stanzas held for a room.
+
+        Returns:
+          list: (stanza, priority) tuples, oldest first.
+        """
+        queue = self._queues.pop(key, None)
+        if queue is None:
+            return []
+        self._unexpired(queue)
+        self.flushed += len(queue)
+        return [(stanza, priority) for _, stanza, priority in queue]
+
+    def discard(self, key):
+        """Forget any stanzas held for a room."""
+        queue = self._queues.pop(key, None)
+        if queue:
+            log.msg(f"Discarding {len(queue)} pending stanzas for {key}")
+
+    def expire_stale(self):
+        """Drop expired stanzas of rooms that never got joined."""
+        for key in list(self._queues):
+            queue = self._queues[key]
+            self._unexpired(queue)
+            if not queue:
+                del self._queues[key]
+
+    def stats(self):
+        """Return metrics about the held stanzas."""
+        return {
+            "pending.depth": len(self),
+            "pending.rooms": len(self._queues),
+            "pending.queued": self.queued,
+            "pending.flushed": self.flushed,
+            "pending.expired": self.expired,
+            "pending.dropped": self.dropped,
+        }
+
+
+class OutboundScheduler:
+    """I meter stanzas out to the XMPP server.
+
+    Stanzas are queued per priority class (lane) and per destination (a room
+    or a private chat JID).  Each destination has a token bucket limiting its
+    message rate, shared by all lanes.  The highest priority lane with
+    sendable stanzas is served first, its destinations drained round-robin,
+    subject to a global bytes per second budget.  A lower lane passed over
+    ``starvation_limit`` times in a row is served once, so routine traffic
+    still trickles out during a flood of warnings.  When nothing is queued
+    and tokens are available, stanzas are written immediately.
+
+    While paused, between losing the stream and logging in again, stanzas
+    are queued and nothing is written.
+    """
+
+    def __init__(
+        self,
+        write,
+        clock=None,
+        room_rate=5.0,
+        room_burst=20,
+        bytes_per_second=1000000,
+        max_queue=50000,
+        starvation_limit=8,
+    ):
+        """Constructor
+
+        Args:
+          write (callable): called with the bytes of each stanza to send.
+          clock (IReactorTime): defaults to the reactor.
+          room_rate (float): stanzas per second per destination.
+          room_burst (int): stanzas a destination may burst.
+          bytes_per_second (int): global rate of bytes sent.
+          max_queue (int): stanzas queued before new ones are dropped.
+          starvation_limit (int): times a lane may be passed over.
+        """
+        if clock is None:
+            clock = reactor
+        self.write = write
+        self.clock = clock
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.max_queue = max_queue
+        self.starvation_limit = starvation_limit
+        self._bytes = TokenBucket(
+            bytes_per_second, bytes_per_second, clock.seconds()
+        )
+        self._lanes = [Lane() for _ in PRIORITY_NAMES]
+        self._buckets = {}
+        self._call = None
+        self.paused = False
+        self.depth = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.delayed = 0
+        self.dropped = 0
+
+    @property
+    def bytes_per_second(self):
+        """The global bytes per second budget."""
+        return self._bytes.rate
+
+    @bytes_per_second.setter
+    def bytes_per_second(self, value):
+        """Change the global budget."""
+        self._bytes.rate = value
+        self._bytes.capacity = value
+        self._bytes.tokens = min(self._bytes.tokens, value)
+
+    def _bucket(self, key, now):
+        """Get the token bucket for a destination."""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.room_rate, self.room_burst, now)
+            self._buckets[key] = bucket
+        return bucket
+
+    def enqueue(self, key, stanza, priority=None):
+        """Queue a stanza for sending.
+
+        Args:
+          key (str): the destination, used for per-destination limits.
+          stanza (domish.Element, str or bytes): what to send.
+          priority (int, optional): the priority class, derived from the
+            stanza if it is an element and NORMAL otherwise.
+
+        Returns:
+          bool: False if the stanza was dropped due to a full queue.
+        """
+        if priority is None:
+            priority = NORMAL
+            if not isinstance(stanza, (bytes, str)):
+                priority = stanza_priority(stanza)
+        if not isinstance(stanza, bytes):
+            if not isinstance(stanza, str):
+                stanza = stanza.toXml()
+            stanza = stanza.encode("utf-8")
+        lane = self._lanes[priority]
+        now = self.clock.seconds()
+        if self.depth == 0 and not self.paused:
+            bucket = self._bucket(key, now)
+            if bucket.consume(1, now):
+                if self._bytes.consume(len(stanza), now):
+                    self.sent += 1
+                    lane.sent += 1
+                    self.write(stanza)
+                    return True
+                bucket.tokens += 1
+        if self.depth >= self.max_queue:
+            self.dropped += 1
+            log.msg(f"Outbound queue full, dropping stanza to {key}")
+            return False
+        queue = lane.queues.get(key)
+        if queue is None:
+            queue = deque()
+            lane.queues[key] = queue
+            lane.ready.append(key)
+        queue.append(stanza)
+        self.depth += 1
+        self.delayed += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        self._schedule(0)
+        return True
+
+    def pause(self):
+        """Stop writing, as there is no stream to write to."""
+        self.paused = True
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def resume(self):
+        """Start writing again, sending what was queued meanwhile."""
+        self.paused = False
+        if self.depth:
+            self._schedule(0)
+
+    def take(self, match):
+        """Remove and return the queued stanzas of some destinations.
+
+        Args:
+          match (callable): called with each destination, returning True
+            for those whose stanzas are to be taken.
+
+        Returns:
+          list: (key, stanza, priority) tuples, by priority and then
+          oldest first for each destination.
+        """
+        res = []
+        for priority, lane in enumerate(self._lanes):
+            for key in [key for key in lane.ready if match(key)]:
+                lane.ready.remove(key)
+                queue = lane.queues.pop(key)
+                self.depth -= len(queue)
+                res.extend((key, stanza, priority) for stanza in queue)
+        return res
+
+    def expire_buckets(self):
+        """Forget the buckets of idle destinations, which are full again."""
+        now = self.clock.seconds()
+        queued = {key for lane in self._lanes for key in lane.queues}
+        for key in list(self._buckets):
+            if key in queued:
+                continue
+            bucket = self._buckets[key]
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._buckets[key]
+
+    def _schedule(self, delay):
+        """Ensure a drain happens within delay seconds."""
+        if self.paused:
+            return
+        if self._call is not None and self._call.active():
+            if self._call.getTime() <= self.clock.seconds() + delay:
+                return
+            self._call.cancel()
+        self._call = self.clock.callLater(delay, self._drain)
+
+    def _pick_lane(self, blocked):
+        """Return the lane to serve next, or None."""
+        waiting = [
+            lane for lane in self._lanes if lane.ready and lane not in blocked
+        ]
+        if not waiting:
+            return None
+        chosen = waiting[0]
+        for lane in waiting[1:]:
+            if lane.skipped >= self.starvation_limit:
+                chosen = lane
+                break
+        for lane in waiting:
+            if lane is chosen:
+                lane.skipped = 0
+            else:
+                lane.skipped += 1
+        return chosen
+
+    def _send_one(self, lane, now):
+        """Send one stanza from the lane.
+
+        Returns:
+          (bool, float): was a stanza sent, else the seconds to wait and
+          None if the wait is due to the global budget.
+        """
+        wait = None
+        for _ in range(len(lane.ready)):
+            key = lane.ready.popleft()
+            queue = lane.queues[key]
+            bucket = self._bucket(key, now)
+            if not bucket.consume(1, now):
+                delay = bucket.delay(1, now)
+                wait = delay if wait is None else min(wait, delay)
+                lane.ready.append(key)
+                continue
+            if not self._bytes.consume(len(queue[0]), now):
+                bucket.tokens += 1
+                lane.ready.appendleft(key)
+                return False, None
+            self.write(queue.popleft())
+            self.depth -= 1
+            self.sent += 1
+            lane.sent += 1
+            if queue:
+                lane.ready.append(key)
+            else:
+                del lane.queues[key]
+            return True, None
+        return False, wait
+
+    def _drain(self):
+        """Send what the rate limits allow, then reschedule."""
+        self._call = None
+        now = self.clock.seconds()
+        wait = None
+        # Lanes whose destinations are all waiting on their buckets
+        blocked = []
+        while True:
+            lane = self._pick_lane(blocked)
+            if lane is None:
+                break
+            sent, delay = self._send_one(lane, now)
+            if sent:
+                continue
+            if delay is None:
+                # Out of global budget, nothing else can go either
+                key = lane.ready[0]
+                wait = self._bytes.delay(len(lane.queues[key][0]), now)
+                break
+            wait = delay if wait is None else min(wait, delay)
+            blocked.append(lane)
+        if self.depth:
+            # a small floor prevents spinning on float rounding
+            self._schedule(max(wait or 0, 0.01))
+
+    def stats(self):
+        """Return metrics about the queue."""
+        res = {
+            "outbound.depth": self.depth,
+            "outbound.max_depth": self.max_depth,
+            "outbound.destinations_queued": len(
+                {key for lane in self._lanes for key in lane.queues}
+            ),
+            "outbound.buckets": len(self._buckets),
+            "outbound.sent": self.sent,
+            "outbound.delayed": self.delayed,
+            "outbound.dropped": self.dropped,
+        }
+        for name, lane in zip(PRIORITY_NAMES, self._lanes):
+            res[f"outbound.{name}.depth"] = lane.depth()
+            res[f"outbound.{name}.sent"] = lane.sent
+        return res
@@ -0,0 +1,248 @@
+"""Product text lookups."""
+import base64
+import binascii
+import zlib
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+from iembot.cache import LRUCache
+
+# Logged when there is no product text to be had
+PRODUCT_UNAVAILABLE = "Sorry, product text is unavailable."
+# Logged in place of the product text until it shows up in memcache
+PENDING_TEXT = "Product text is not available yet, check back shortly."
+# Seconds between the memcache sweeps looking for a product's text, the
+# text usually lands shortly after the product is routed
+SWEEP_INTERVALS = (0, 1, 2, 5, 10, 10, 15)
+# The largest inline product text that we will inflate
+INLINE_MAXBYTES = 1024 * 1024
+# Seconds a product given up on is not looked for again
+MISSING_TTL = 600
+
+
+def pop_inline_text(x):
+    """Remove and decode product text inlined in the nwschat:nwsbot element.
+
+    The ingestor may send the text along as
+    ``<product_text encoding="zlib+base64">...</product_text>``, saving us
+    the trip to memcache.  The child is removed either way, so it is not
+    fanned out to the rooms.
+
+    Args:
+      x (domish.Element): the nwschat:nwsbot element.
+
+    Returns:
+      str or None: the product text.
+    """
+    child = None
+    for node in x.elements():
+        if node.name == "product_text":
+            child = node
+            break
+    if child is None:
+        return None
+    x.children.remove(child)
+    if child.getAttribute("encoding") != "zlib+base64":
+        log.msg(
+            f"Unknown product_text encoding {child.getAttribute('encoding')}"
+        )
+        return None
+    try:
+        inflater = zlib.decompressobj()
+        data = inflater.decompress(
+            base64.b64decode(str(child)), INLINE_MAXBYTES
+        )
+        if inflater.unconsumed_tail:
+            log.msg("Inline product_text is too large, ignoring")
+            return None
+    except (binascii.Error, zlib.error) as exp:
+        log.msg(f"Failed to decode inline product_text: {exp}")
+        return None
+    return data.decode("ascii", "ignore")
+
+
+class PendingProduct:
+    """A product_id whose text we are waiting on."""
+
+    __slots__ = ("waiters", "sweeps", "due")
+
+    def __init__(self, due):
+        """Constructor"""
+        self.waiters = []
+        self.sweeps = 0
+        self.due = due
+
+
+class ProductTextCache:
+    """I look up product text by product_id, caching it in-process.
+
+    A product routed to many rooms is echoed back to us from each of them.
+    Products whose text is not cached are held in a pending registry, which
+    a sweeper drains with one multi-key memcache request for all of the
+    products that are due.  A product that is still missing is swept again
+    on the schedule of SWEEP_INTERVALS and is then given up on.  Found text
+    is kept in a byte-bounded LRU, and products given up on are remembered
+    for ``missing_ttl`` seconds, so the echoes of such a product from
+    other rooms do not start sweeping for it all over again.
+    """
+
+    def __init__(
+        self,
+        memcache_client,
+        clock=None,
+        maxbytes=64 * 1024 * 1024,
+        intervals=SWEEP_INTERVALS,
+        missing_ttl=MISSING_TTL,
+    ):
+        """Constructor
+
+        Args:
+          memcache_client (txyam.client.YamClient): None disables lookups.
+          clock (IReactorTime): defaults to the reactor.
+          maxbytes (int): the size of text to cache.
+          intervals (tuple): seconds before each sweep for a product.
+          missing_ttl (float): seconds to remember a product given up on.
+        """
+        if clock is None:
+            clock = reactor
+        self.memcache_client = memcache_client
+        self.clock = clock
+        self.intervals = intervals
+        self.missing_ttl = missing_ttl
+        self._cache = LRUCache(100000, maxbytes=maxbytes)
+        # product_id -> clock time until which it is not looked for
+        self._missing = LRUCache(10000)
+        self._pending = {}
+        self._call = None
+        self._sweeping = False
+        self.hits = 0
+        self.coalesced = 0
+        self.sweeps = 0
+        self.fetched = 0
+        self.misses = 0
+
+    def __contains__(self, product_id):
+        """Is the text cached."""
+        return product_id in self._cache
+
+    def cached(self, product_id):
+        """Return the cached text, "" if recently given up on, or None."""
+        text = self._cache.get(product_id)
+        if text is None:
+            until = self._missing.get(product_id)
+            if until is None:
+                return None
+            if until <= self.clock.seconds():
+                self._missing.pop(product_id)
+                return None
+            text = ""
+        self.hits += 1
+        return text
+
+    def put(self, product_id, text):
+        """Cache text that we got some other way."""
+        self._missing.pop(product_id)
+        self._cache[product_id] = text
+
+    def get(self, product_id):
+        """Get the text of a product.
+
+        Returns:
+          twisted.internet.defer.Deferred: fires with the text or None.
+        """
+        text = self.cached(product_id)
+        if text is not None:
+            return defer.succeed(text or None)
+        if self.memcache_client is None:
+            return defer.succeed(None)
+        df = defer.Deferred()
+        pending = self._pending.get(product_id)
+        if pending is None:
+            pending = PendingProduct(self.clock.seconds() + self.intervals[0])
+            self._pending[product_id] = pending
+            self._schedule()
+        else:
+            self.coalesced += 1
+        pending.waiters.append(df)
+        return df
+
+    def _schedule(self):
+        """Arrange for the next sweep, when the first product is due."""
+        if self._sweeping or not self._pending:
+            return
+        due = min(pending.due for pending in self._pending.values())
+        delay = max(0, due - self.clock.seconds())
+        if self._call is not None and self._call.active():
+            if self._call.getTime() <= self.clock.seconds() + delay:
+                return
+            self._call.cancel()
+        self._call = self.clock.callLater(delay, self._sweep)
+
+    def _sweep(self):
+        """Look up every product that is due with one request."""
+        self._call = None
+        now = self.clock.seconds()
+        due = [pid for pid, pend in self._pending.items() if pend.due <= now]
+        if not due:
+            self._schedule()
+            return
+        self.sweeps += 1
+        self._sweeping = True
+        df = self.memcache_client.getMultiple(
+            [pid.encode("utf-8") for pid in due]
+        )
+        df.addCallback(self._swept, due)
+        df.addErrback(self._sweep_failed, due)
+
+    def _swept(self, res, due):
+        """Hand out the text that was found, sweep the rest again later."""
+        self._sweeping = False
+        now = self.clock.seconds()
+        for product_id in due:
+            pending = self._pending.get(product_id)
+            if pending is None:
+                continue
+            _flag, data = (res or {}).get(
+                product_id.encode("utf-8"), (0, None)
+            )
+            if data is not None:
+                self.fetched += 1
+                text = data.decode("ascii", "ignore")
+                self._cache[product_id] = text
+                self._resolve(product_id, text)
+                continue
+            pending.sweeps += 1
+            if pending.sweeps >= len(self.intervals):
+                log.msg(f"Gave up looking for {product_id} text in memcache")
+                self.misses += 1
+                self._missing[product_id] = now + self.missing_ttl
+                self._resolve(product_id, None)
+                continue
+            pending.due = now + self.intervals[pending.sweeps]
+        self._schedule()
+
+    def _sweep_failed(self, err, due):
+        """The request failed, treat it as finding nothing."""
+        log.err(err)
+        self._swept({}, due)
+
+    def _resolve(self, product_id, text):
+        """Fire the waiters of a product."""
+        pending = self._pending.pop(product_id)
+        for df in pending.waiters:
+            df.callback(text)
+
+    def stats(self):
+        """Return metrics about lookups."""
+        return {
+            "products.cached": len(self._cache),
+            "products.cached_bytes": self._cache.nbytes,
+            "products.pending": len(self._pending),
+            "products.missing": len(self._missing),
+            "products.hits": self.hits,
+            "products.coalesced": self.coalesced,
+            "products.sweeps": self.sweeps,
+            "products.fetched": self.fetched,
+            "products.misses": self.misses,
+        }
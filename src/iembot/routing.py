@@ -0,0 +1,166 @@
+"""Channel subscription routing."""
+from iembot.cache import LRUCache
+
+# A subscription to a channel ending with this matches by prefix
+WILDCARD = "*"
+
+
+def valid_channel(channel):
+    """Is the channel one that may be subscribed to.
+
+    A wildcard is only supported at the end of a channel and after a
+    non-empty prefix, a bare ``*`` would subscribe to every message.
+
+    Args:
+      channel (str): the channel.
+
+    Returns:
+      bool
+    """
+    pos = channel.find(WILDCARD)
+    return pos == -1 or pos == len(channel) - 1 > 0
+
+
+class TrieNode:
+    """A node within the prefix subscription trie."""
+
+    __slots__ = ("children", "subscribers")
+
+    def __init__(self):
+        """Constructor"""
+        self.children = {}
+        self.subscribers = {}
+
+
+class RoutingTable:
+    """Subscriptions of rooms, twitter users or webhooks to channels.
+
+    The forward (channel -> subscribers) and reverse (subscriber ->
+    channels) indices have set semantics, they are dicts used as insertion
+    ordered sets.  The deduplicated fanout of a message's channels is
+    memoized, keyed by the channels attribute string, and is invalidated
+    whenever a subscription changes.
+
+    A channel ending with ``*``, like ``SVR*``, is a prefix subscription.
+    These are held in a trie, so matching a channel costs its length and
+    not the number of prefix subscriptions.
+    """
+
+    def __init__(self, cachesize=10000):
+        """Constructor
+
+        Args:
+          cachesize (int): number of channel strings to memoize fanout for.
+        """
+        self._channels = {}
+        self._subscribers = {}
+        self._fanout = LRUCache(cachesize)
+        self._trie = TrieNode()
+
+    def __contains__(self, channel):
+        """Does this channel have any subscribers."""
+        return channel in self._channels
+
+    def __len__(self):
+        """Number of channels with subscribers."""
+        return len(self._channels)
+
+    def keys(self):
+        """Channels with subscribers."""
+        return self._channels.keys()
+
+    def get(self, channel, default=()):
+        """Return the subscribers of a channel."""
+        subs = self._channels.get(channel)
+        if subs is None:
+            return default
+        return tuple(subs)
+
+    def add(self, channel, subscriber):
+        """Subscribe to a channel.
+
+        Returns:
+          bool: False if the subscription already existed.
+        """
+        subs = self._channels.setdefault(channel, {})
+        if subscriber in subs:
+            return False
+        subs[subscriber] = None
+        self._subscribers.setdefault(subscriber, {})[channel] = None
+        if channel.endswith(WILDCARD):
+            node = self._trie
+            for char in channel[:-1]:
+                node = node.children.setdefault(char, TrieNode())
+            node.subscribers[subscriber] = None
+        self._fanout.clear()
+        return True
+
+    def remove(self, channel, subscriber):
+        """Unsubscribe from a channel.
+
+        Returns:
+          bool: False if there was no such subscription.
+        """
+        subs = self._channels.get(channel)
+        if subs is None or subscriber not in subs:
+            return False
+        del subs[subscriber]
+        if not subs:
+            del self._channels[channel]
+        chans = self._subscribers[subscriber]
+        del chans[channel]
+        if not chans:
+            del self._subscribers[subscriber]
+        if channel.endswith(WILDCARD):
+            self._trie_remove(channel[:-1], subscriber)
+        self._fanout.clear()
+        return True
+
+    def _trie_remove(self, prefix, subscriber):
+        """Remove a prefix subscription, pruning any emptied nodes."""
+        path = [self._trie]
+        for char in prefix:
+            path.append(path[-1].children[char])
+        path[-1].subscribers.pop(subscriber, None)
+        for char, parent, node in zip(
+            reversed(prefix), reversed(path[:-1]), reversed(path[1:])
+        ):
+            if node.children or node.subscribers:
+                break
+            del parent.children[char]
+
+    def match(self, channel):
+        """Return the subscribers of a channel, including prefix matches."""
+        subs = dict(self._channels.get(channel, {}))
+        node = self._trie
+        subs.update(node.subscribers)
+        for char in channel:
+            node = node.children.get(char)
+            if node is None:
+                break
+            subs.update(node.subscribers)
+        return subs
+
+    def channels_for(self, subscriber):
+        """Return the channels a subscriber is subscribed to."""
+        return list(self._subscribers.get(subscriber, ()))
+
+    def fanout(self, channels):
+        """Return the deduplicated subscribers for a message's channels.
+
+        Args:
+          channels (str or list): comma delimited channels or a list.
+
+        Returns:
+          tuple: subscribers, in channel and then subscription order.
+        """
+        if not isinstance(channels, str):
+            channels = ",".join(channels)
+        res = self._fanout.get(channels)
+        if res is None:
+            subs = {}
+            for channel in channels.split(","):
+                subs.update(self.match(channel))
+            res = tuple(subs)
+            self._fanout[channels] = res
+        return res
@@ -0,0 +1,706 @@
+"""Asynchronous Twitter client on Twisted's HTTP stack.
+
+Requests are signed with OAuth1 HMAC-SHA1 in-process, see
+https://developer.twitter.com/en/docs/authentication/oauth-1-0a , and are
+sent through a persistent connection pool, so posting a tweet neither
+blocks the reactor nor occupies a thread.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import os
+import time
+from collections import deque
+from io import BytesIO
+from urllib.parse import quote
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+from twisted.web.client import (
+    Agent,
+    FileBodyProducer,
+    HTTPConnectionPool,
+    readBody,
+)
+from twisted.web.http_headers import Headers
+
+from iembot.cache import LRUCache, SingleFlight
+from iembot.health import HealthRegistry
+
+TWEET_API = "https://api.twitter.com/2/tweets"
+MEDIA_API = "https://upload.twitter.com/1.1/media/upload.json"
+# The v2 problem detail of a duplicate tweet, which has no error code
+DUPLICATE_DETAIL = "duplicate content"
+
+
+class TwitterError(Exception):
+    """An error returned by the Twitter API.
+
+    The argument is the API's errors payload, typically a list of dicts
+    with ``code`` and ``message`` keys, which is what
+    ``iembot.util.twittererror_exp_to_code`` parses.
+    """
+
+
+class RateLimitError(TwitterError):
+    """The API responded with HTTP 429, Too Many Requests."""
+
+    def __init__(self, headers, data):
+        """Constructor
+
+        Args:
+          headers (Headers): the response headers, holding the reset time.
+          data: the response payload.
+        """
+        super().__init__(data)
+        self.headers = headers
+
+
+class MediaError(Exception):
+    """The media to attach to a tweet could not be fetched."""
+
+
+def percent_encode(value):
+    """Percent encode a value per RFC 3986, as OAuth1 requires."""
+    return quote(str(value), safe="~")
+
+
+class OAuth1Signer:
+    """OAuth1 HMAC-SHA1 signing for one access token.
+
+    The encoded credentials and the HMAC key are computed once, so an
+    instance should be reused for all requests made on behalf of a user.
+    """
+
+    __slots__ = ("consumer_key", "token", "_key", "_base_params")
+
+    def __init__(self, consumer_key, consumer_secret, token, token_secret):
+        """Constructor
+
+        Args:
+          consumer_key (str): the application's consumer key.
+          consumer_secret (str): the application's consumer secret.
+          token (str): the user's access token.
+          token_secret (str): the user's access token secret.
+        """
+        self.consumer_key = consumer_key
+        self.token = token
+        self._key = (
+            f"{percent_encode(consumer_secret)}&{percent_encode(token_secret)}"
+        ).encode("ascii")
+        self._base_params = [
+            ("oauth_consumer_key", consumer_key),
+            ("oauth_signature_method", "HMAC-SHA1"),
+            ("oauth_token", token),
+            ("oauth_version", "1.0"),
+        ]
+
+    def sign(self, method, url, params, nonce, timestamp):
+        """Compute the request signature.
+
+        Args:
+          method (str): the HTTP method.
+          url (str): the URL without any query string.
+          params (list): (key, value) query and form parameters.
+          nonce (str): the oauth_nonce.
+          timestamp (int): the oauth_timestamp.
+
+        Returns:
+          (str, list): the signature and the oauth parameters signed.
+        """
+        oauth = self._base_params + [
+            ("oauth_nonce", nonce),
+            ("oauth_timestamp", str(timestamp)),
+        ]
+        encoded = sorted(
+            (percent_encode(k), percent_encode(v)) for k, v in oauth + params
+        )
+        paramstr = "&".join(f"{k}={v}" for k, v in encoded)
+        base = "&".join(
+            [method.upper(), percent_encode(url), percent_encode(paramstr)]
+        )
+        digest = hmac.new(self._key, base.encode("ascii"), hashlib.sha1)
+        return base64.b64encode(digest.digest()).decode("ascii"), oauth
+
+    def authorization(self, method, url, params=None, nonce=None, ts=None):
+        """Return the Authorization header value for a request.
+
+        Args:
+          method (str): the HTTP method.
+          url (str): the URL without any query string.
+          params (list, optional): (key, value) query and form parameters.
+          nonce (str, optional): defaults to a random value.
+          ts (int, optional): defaults to the current time.
+
+        Returns:
+          str
+        """
+        if nonce is None:
+            nonce = binascii.hexlify(os.urandom(16)).decode("ascii")
+        if ts is None:
+            ts = int(time.time())
+        signature, oauth = self.sign(method, url, params or [], nonce, ts)
+        oauth.append(("oauth_signature", signature))
+        return "OAuth " + ", ".join(
+            f'{percent_encode(k)}="{percent_encode(v)}"'
+            for k, v in sorted(oauth)
+        )
+
+
+def parse_response(body):
+    """Parse an API response, raising TwitterError for any errors.
+
+    Args:
+      body (bytes): the response body.
+
+    Returns:
+      dict
+    """
+    try:
+        data = json.loads(body.decode("utf-8"))
+    except ValueError:
+        raise TwitterError({"message": f"Unparsable response {body[:100]}"})
+    if isinstance(data, dict):
+        if "error" in data:
+            raise TwitterError(data["error"])
+        if "errors" in data:
+            raise TwitterError(data["errors"])
+    return data
+
+
+def status_error(code, body):
+    """Build the TwitterError of a response with a non-2xx status.
+
+    v1.1 endpoints answer with ``errors`` or ``error``, while v2 answers
+    with a problem object of ``title``, ``detail`` and ``status``.  A v2
+    duplicate tweet is given v1.1's code 187, so it is handled alike.
+
+    Args:
+      code (int): the HTTP status.
+      body (bytes): the response body.
+
+    Returns:
+      TwitterError
+    """
+    try:
+        data = json.loads(body.decode("utf-8"))
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        errors = data.get("errors")
+        if isinstance(errors, list) and errors:
+            return TwitterError(
+                [
+                    dict(err, status=code) if isinstance(err, dict) else err
+                    for err in errors
+                ]
+            )
+        if isinstance(data.get("error"), str):
+            return TwitterError(data["error"])
+        detail = data.get("detail") or data.get("title")
+    else:
+        detail = body[:100]
+    error = {"status": code, "message": f"HTTP {code} {detail}"}
+    if isinstance(detail, str) and DUPLICATE_DETAIL in detail:
+        error["code"] = 187
+    return TwitterError([error])
+
+
+def multipart_body(name, content):
+    """Build a multipart/form-data body holding a single file.
+
+    Returns:
+      (bytes, str): the body and its content type.
+    """
+    boundary = binascii.hexlify(os.urandom(16)).decode("ascii")
+    body = b"".join(
+        [
+            f"--{boundary}\r\n".encode("ascii"),
+            f'Content-Disposition: form-data; name="{name}"\r\n'.encode(
+                "ascii"
+            ),
+            b"Content-Type: application/octet-stream\r\n\r\n",
+            content,
+            f"\r\n--{boundary}--\r\n".encode("ascii"),
+        ]
+    )
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+class TweetJob:
+    """A tweet waiting in a user's queue."""
+
+    __slots__ = (
+        "signer",
+        "text",
+        "media",
+        "media_id",
+        "created",
+        "started",
+        "attempts",
+        "deferred",
+    )
+
+    def __init__(self, signer, text, media, created):
+        """Constructor"""
+        self.signer = signer
+        self.text = text
+        self.media = media
+        self.media_id = None
+        self.created = created
+        self.started = None
+        self.attempts = 0
+        self.deferred = defer.Deferred()
+
+    @property
+    def params(self):
+        """The v2 API request payload."""
+        params = {"text": self.text}
+        if self.media_id is not None:
+            # string required
+            params["media"] = {"media_ids": [f"{self.media_id}"]}
+        return params
+
+    def set_media_id(self, media_id):
+        """Remember the uploaded media, so retries do not upload again."""
+        self.media_id = media_id
+
+    def strip_media(self):
+        """Send the tweet without its media."""
+        self.media = None
+        self.media_id = None
+
+
+class UserQueue:
+    """The tweets queued for a user and the state of their rate limits."""
+
+    __slots__ = ("jobs", "busy", "not_before", "failures", "call")
+
+    def __init__(self):
+        """Constructor"""
+        self.jobs = deque()
+        # Is a tweet in flight, we send one at a time per user
+        self.busy = False
+        # Clock time before which nothing should be sent
+        self.not_before = 0
+        # Consecutive failures, for the exponential backoff
+        self.failures = 0
+        # The pending wakeup call, if any
+        self.call = None
+
+
+class TwitterClient:
+    """I post tweets on behalf of users.
+
+    Each user has a queue that is sent one tweet at a time.  When the rate
+    limit headers say a user's quota is exhausted, their queue waits until
+    the reset time.  Failures are retried with an exponential backoff, and
+    tweets that have waited longer than ``max_age`` seconds are dropped
+    rather than posted late.
+    """
+
+    def __init__(self, clock=None, pool=None, agent=None, health=None):
+        """Constructor
+
+        Args:
+          clock (IReactorTime): defaults to the reactor.
+          pool (HTTPConnectionPool, optional): persistent connections.
+          agent (IAgent, optional): defaults to an Agent using the pool.
+          health (HealthRegistry, optional): circuit breakers by account.
+        """
+        if clock is None:
+            clock = reactor
+        if health is None:
+            health = HealthRegistry(clock)
+        if agent is None:
+            if pool is None:
+                pool = HTTPConnectionPool(clock, persistent=True)
+                pool.maxPersistentPerHost = 10
+            agent = Agent(clock, pool=pool)
+        self.clock = clock
+        self.agent = agent
+        self.health = health
+        self.consumer_key = None
+        self.consumer_secret = None
+        self._signers = {}
+        self._queues = {}
+        self.max_age = 1800
+        self.max_queue = 100
+        self.max_attempts = 4
+        self.backoff = 10
+        self.backoff_max = 900
+        # Seconds to wait for a request's response, including its body
+        self.timeout = 60
+        self.queued = 0
+        self.sent = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.dropped = 0
+        # Media bytes by URL, for the window a product fans out in
+        self.media_cache = LRUCache(100, maxbytes=32 * 1024 * 1024)
+        self._media_flight = SingleFlight()
+        self.media_downloads = 0
+        self.media_hits = 0
+
+    def set_consumer(self, consumer_key, consumer_secret):
+        """Set the application's credentials."""
+        if (consumer_key, consumer_secret) != (
+            self.consumer_key,
+            self.consumer_secret,
+        ):
+            self._signers.clear()
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+
+    def signer(self, user_id, token, token_secret):
+        """Get the cached signer for a user, replacing it if stale."""
+        signer = self._signers.get(user_id)
+        if signer is None or signer.token != token:
+            signer = OAuth1Signer(
+                self.consumer_key, self.consumer_secret, token, token_secret
+            )
+            self._signers[user_id] = signer
+        return signer
+
+    def forget(self, user_id):
+        """Drop the cached signer and health of a user."""
+        self._signers.pop(user_id, None)
+        self.health.forget(f"twitter:{user_id}")
+
+    def request(self, signer, method, url, body=None, content_type=None):
+        """Make a signed request and parse the response.
+
+        Returns:
+          twisted.internet.defer.Deferred: fires with (headers, data).
+        """
+        headers = Headers(
+            {"Authorization": [signer.authorization(method, url)]}
+        )
+        producer = None
+        if body is not None:
+            headers.addRawHeader("Content-Type", content_type)
+            producer = FileBodyProducer(BytesIO(body))
+        df = self.agent.request(
+            method.encode("ascii"), url.encode("ascii"), headers, producer
+        )
+
+        def _read(response):
+            """Read the body, keeping the response headers."""
+            bdf = readBody(response)
+            bdf.addCallback(_parse, response)
+            return bdf
+
+        def _parse(body, response):
+            """Parse the body, raising for errors."""
+            if response.code == 429:
+                raise RateLimitError(response.headers, body[:200])
+            if not 200 <= response.code < 300:
+                raise status_error(response.code, body)
+            return response.headers, parse_response(body)
+
+        df.addCallback(_read)
+        df.addTimeout(self.timeout, self.clock)
+        return df
+
+    def fetch_media(self, url):
+        """Get the media to attach to a tweet.
+
+        The media is downloaded once and shared by the tweets of every
+        account it is sent to, concurrent requests for the same URL waiting
+        on the one download.
+
+        Returns:
+          twisted.internet.defer.Deferred: fires with the bytes.
+        """
+        content = self.media_cache.get(url)
+        if content is not None:
+            self.media_hits += 1
+            return defer.succeed(content)
+        return self._media_flight.run(url, self._download_media, url)
+
+    def _download_media(self, url):
+        """Download media into the cache."""
+        self.media_downloads += 1
+        df = self.agent.request(b"GET", url.encode("ascii"))
+
+        def _read(response):
+            """Only cache what was successfully fetched."""
+            if response.code != 200:
+                raise IOError(f"HTTP {response.code} fetching {url}")
+            return readBody(response)
+
+        def _store(content):
+            """Cache the bytes."""
+            self.media_cache[url] = content
+            return content
+
+        df.addCallback(_read)
+        df.addTimeout(self.timeout, self.clock)
+        df.addCallback(_store)
+        return df
+
+    def upload_media(self, signer, url):
+        """Download media and upload it to Twitter.
+
+        Returns:
+          twisted.internet.defer.Deferred: fires with the media_id string.
+        """
+        df = self.fetch_media(url)
+
+        def _fetch_failed(err):
+            """Tell a failed fetch apart from a failed upload."""
+            raise MediaError(f"Fetching {url} failed: {err.value!r}")
+
+        def _upload(content):
+            """Post the downloaded content."""
+            body, content_type = multipart_body("media", content)
+            return self.request(signer, "POST", MEDIA_API, body, content_type)
+
+        df.addCallbacks(_upload, _fetch_failed)
+        df.addCallback(lambda res: res[1]["media_id_string"])
+        return df
+
+    def post_tweet(self, signer, params):
+        """Post a tweet with the v2 API.
+
+        Returns:
+          twisted.internet.defer.Deferred: fires with (headers, data).
+        """
+        return self.request(
+            signer,
+            "POST",
+            TWEET_API,
+            json.dumps(params).encode("utf-8"),
+            "application/json",
+        )
+
+    def tweet(self, user_id, token, token_secret, text, media=None):
+        """Queue a message to tweet, with optional media.
+
+        Args:
+          user_id (int): the twitter user.
+          token (str): the user's access token.
+          token_secret (str): the user's access token secret.
+          text (str): the text to tweet, already shaped to fit.
+          media (str, optional): URL of media to attach.
+
+        Returns:
+          twisted.internet.defer.Deferred: fires with the API response or
+          None when the tweet is abandoned.
+        """
+        job = TweetJob(
+            self.signer(user_id, token, token_secret),
+            text,
+            media,
+            self.clock.seconds(),
+        )
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = UserQueue()
+            self._queues[user_id] = queue
+        if len(queue.jobs) >= self.max_queue:
+            self._abandon(queue.jobs.popleft(), f"{user_id} queue full")
+        queue.jobs.append(job)
+        self.queued += 1
+        self._process(user_id)
+        return job.deferred
+
+    def _abandon(self, job, reason):
+        """Give up on a tweet."""
+        self.dropped += 1
+        log.msg(f"Dropping tweet '{job.text}', {reason}")
+        job.deferred.callback(None)
+
+    def _process(self, user_id):
+        """Send the user's next tweet, if allowed."""
+        queue = self._queues.get(user_id)
+        if queue is None or queue.busy or queue.call is not None:
+            return
+        now = self.clock.seconds()
+        while queue.jobs and now - queue.jobs[0].created > self.max_age:
+            self._abandon(queue.jobs.popleft(), "it is stale")
+        if not queue.jobs:
+            # Keep the rate limit state of a user still waiting on a reset
+            if queue.not_before <= now:
+                del self._queues[user_id]
+            return
+        if queue.not_before > now:
+            queue.call = self.clock.callLater(
+                queue.not_before - now, self._wakeup, user_id
+            )
+            return
+        if not self.health.allow(f"twitter:{user_id}"):
+            while queue.jobs:
+                self._abandon(queue.jobs.popleft(), "its circuit is open")
+            del self._queues[user_id]
+            return
+        job = queue.jobs.popleft()
+        queue.busy = True
+        job.attempts += 1
+        job.started = now
+        if job.media is not None and job.media_id is None:
+            df = self.upload_media(job.signer, job.media)
+            df.addCallback(job.set_media_id)
+            df.addCallback(lambda _: self.post_tweet(job.signer, job.params))
+        else:
+            df = self.post_tweet(job.signer, job.params)
+        df.addCallbacks(
+            self._sent,
+            self._failed,
+            callbackArgs=(user_id, job),
+            errbackArgs=(user_id, job),
+        )
+
+    def _wakeup(self, user_id):
+        """The user's quota or backoff has passed."""
+        queue = self._queues.get(user_id)
+        if queue is not None:
+            queue.call = None
+            self._process(user_id)
+
+    def _limit(self, queue, headers, exhausted=False):
+        """Honour the rate limit headers of a response.
+
+        Args:
+          queue (UserQueue): the user's queue.
+          headers (Headers): the response headers.
+          exhausted (bool): the response was a 429, so a missing remaining
+            header counts as zero.
+        """
+        for prefix in ["x-rate-limit", "x-user-limit-24hour"]:
+            default = "0" if exhausted else None
+            remaining = headers.getRawHeaders(f"{prefix}-remaining", [default])
+            reset = headers.getRawHeaders(f"{prefix}-reset", [None])
+            if remaining[0] is None or reset[0] is None:
+                continue
+            try:
+                if int(remaining[0]) > 0:
+                    continue
+                # The reset is epoch seconds, convert to our clock
+                wait = max(0, int(reset[0]) - time.time())
+            except ValueError:
+                continue
+            log.msg(f"Rate limit {prefix} exhausted, waiting {wait:.0f}s")
+            self.rate_limited += 1
+            queue.not_before = max(
+                queue.not_before, self.clock.seconds() + wait
+            )
+
+    def _finish(self, user_id, queue):
+        """The attempt is over, move along."""
+        queue.busy = False
+        self._process(user_id)
+
+    def _sent(self, res, user_id, job):
+        """The tweet was posted."""
+        headers, data = res
+        queue = self._queues[user_id]
+        queue.failures = 0
+        self._limit(queue, headers)
+        hh = "x-app-limit-24hour-remaining"
+        log.msg(
+            f"x-rate-limit-remaining "
+            f"{headers.getRawHeaders('x-rate-limit-remaining', [None])[0]} "
+            f"+ {hh} {headers.getRawHeaders(hh, [None])[0]}"
+        )
+        self.sent += 1
+        self.health.success(
+            f"twitter:{user_id}", self.clock.seconds() - job.started
+        )
+        job.deferred.callback(data)
+        self._finish(user_id, queue)
+
+    def _failed(self, err, user_id, job):
+        """Decide if and how to try again."""
+        queue = self._queues[user_id]
+        key = f"twitter:{user_id}"
+        exp = err.value
+        if isinstance(exp, RateLimitError):
+            self._limit(queue, exp.headers, True)
+            if queue.not_before <= self.clock.seconds():
+                # No usable reset header, wait as long as we ever would
+                queue.not_before = self.clock.seconds() + self.backoff_max
+            # Probe again once the limit resets
+            self.health.inconclusive(key)
+            queue.jobs.appendleft(job)
+            self._finish(user_id, queue)
+            return
+        if isinstance(exp, MediaError):
+            # Not the account's fault, send the tweet without the media
+            log.msg(f"{exp}, stripping media")
+            self.health.inconclusive(key)
+            job.strip_media()
+            queue.jobs.appendleft(job)
+            self._finish(user_id, queue)
+            return
+        if isinstance(exp, TwitterError):
+            if _errcode(exp) in [185, 187]:
+                # 185: Over quota
+                # 187: duplicate tweet
+                # Either way the account is reachable
+                self.health.success(key)
+                job.deferred.callback(None)
+                self._finish(user_id, queue)
+                return
+            if str(exp).startswith("media type unrecognized"):
+                # The media content hit some error, send it without it
+                log.msg(f"Sending '{job.media}' fail, stripping")
+                self.health.inconclusive(key)
+                job.strip_media()
+                queue.jobs.appendleft(job)
+                self._finish(user_id, queue)
+                return
+            status = _errstatus(exp)
+            if status is not None and 400 <= status < 500:
+                # Client errors, a revoked token say, do not go away by
+                # trying again and do not mean Twitter is unreachable
+                log.msg(f"Tweet for {user_id} refused with HTTP {status}")
+                self.health.inconclusive(key)
+                job.deferred.errback(err)
+                self._finish(user_id, queue)
+                return
+        log.err(err)
+        self.health.failure(key, exp)
+        if job.attempts >= self.max_attempts:
+            job.deferred.errback(err)
+            self._finish(user_id, queue)
+            return
+        delay = min(self.backoff_max, self.backoff * 2**queue.failures)
+        queue.failures += 1
+        queue.not_before = self.clock.seconds() + delay
+        self.retries += 1
+        queue.jobs.appendleft(job)
+        self._finish(user_id, queue)
+
+    def stats(self):
+        """Return metrics about the tweet queues."""
+        return {
+            "twitter.depth": sum(len(q.jobs) for q in self._queues.values()),
+            "twitter.users_queued": len(self._queues),
+            "twitter.queued": self.queued,
+            "twitter.sent": self.sent,
+            "twitter.retries": self.retries,
+            "twitter.rate_limited": self.rate_limited,
+            "twitter.dropped": self.dropped,
+            "twitter.media_downloads": self.media_downloads,
+            "twitter.media_hits": self.media_hits,
+            "twitter.media_cache_bytes": self.media_cache.nbytes,
+        }
+
+
+def _errcode(exp):
+    """Return the first error code of a TwitterError, if any."""
+    errors = exp.args[0] if exp.args else None
+    if isinstance(errors, list) and errors and isinstance(errors[0], dict):
+        return errors[0].get("code")
+    return None
+
+
+def _errstatus(exp):
+    """Return the HTTP status of a TwitterError, if any."""
+    errors = exp.args[0] if exp.args else None
+    if isinstance(errors, list) and errors and isinstance(errors[0], dict):
+        return errors[0].get("status")
+    return None
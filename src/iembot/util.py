@@ -1,6 +1,5 @@
 """Utility functions for IEMBot"""
 # pylint: disable=protected-access
-import copy
 import datetime
 import glob
 import json
@@ -9,7 +8,6 @@ import pickle
 import pwd
 import re
 import socket
-import time
 import traceback
 from email.mime.text import MIMEText
 from html import unescape
@@ -17,93 +15,20 @@ from io import BytesIO
 
 # Third Party
 import pytz
-import twitter
+from feedgen.entry import FeedEntry
+from lxml import etree
 from pyiem.reference import TWEET_CHARS
 from pyiem.util import utc
-from requests_oauthlib import OAuth1
 from twisted.internet import reactor
 from twisted.mail import smtp
 from twisted.python import log
 from twisted.words.xish import domish
-from twitter.error import TwitterError
 
 # local
 import iembot
-
-TWEET_API = "https://api.twitter.com/2/tweets"
-
-
-def tweet(bot, user_id, twttxt, **kwargs):
-    """Blocking tweet method."""
-    if user_id not in bot.tw_users:
-        log.msg(f"tweet() called with unknown user_id: {user_id}")
-        return None
-    api = twitter.Api(
-        consumer_key=bot.config["bot.twitter.consumerkey"],
-        consumer_secret=bot.config["bot.twitter.consumersecret"],
-        access_token_key=bot.tw_users[user_id]["access_token"],
-        access_token_secret=bot.tw_users[user_id]["access_token_secret"],
-    )
-    # Le Sigh, api.__auth is private
-    auth = OAuth1(
-        bot.config["bot.twitter.consumerkey"],
-        bot.config["bot.twitter.consumersecret"],
-        bot.tw_users[user_id]["access_token"],
-        bot.tw_users[user_id]["access_token_secret"],
-    )
-    log.msg(
-        f"Tweeting {bot.tw_users[user_id]['screen_name']}({user_id}) "
-        f"'{twttxt}' media:{kwargs.get('twitter_media')}"
-    )
-    media = kwargs.get("twitter_media")
-    media_id = None
-
-    def _helper(params):
-        """Wrap common stuff"""
-        resp = api._session.post(TWEET_API, auth=auth, json=params)
-        hh = "x-app-limit-24hour-remaining"
-        log.msg(
-            f"x-rate-limit-limit {resp.headers.get('x-rate-limit-limit')} + "
-            f"{hh} {resp.headers.get(hh)}"
-        )
-        return api._ParseAndCheckTwitter(resp.content.decode("utf-8"))
-
-    res = None
-    try:
-        params = {
-            "text": twttxt,
-        }
-        # If we have media, we have some work to do!
-        if media is not None:
-            media_id = api.UploadMediaSimple(media)
-            # string required
-            params["media"] = {"media_ids": [f"{media_id}"]}
-            res = _helper(params)
-    except TwitterError as exp:
-        errcode = twittererror_exp_to_code(exp)
-        if errcode in [185, 187]:
-            # 185: Over quota
-            # 187: duplicate tweet
-            return None
-
-        # Something bad happened with submitting this to twitter
-        if str(exp).startswith("media type unrecognized"):
-            # The media content hit some error, just send it without it
-            log.msg(f"Sending '{kwargs.get('twitter_media')}' fail, stripping")
-            params.pop("media", None)
-            res = _helper(params)
-        else:
-            log.err(exp)
-            # Since this called from a thread, sleeping should not jam us up
-            time.sleep(10)
-            res = _helper(params)
-    except Exception as exp:
-        log.err(exp)
-        # Since this called from a thread, sleeping should not jam us up
-        time.sleep(10)
-        params.pop("media", None)
-        res = _helper(params)
-    return res
+from iembot.chatlog import MAX_DEPTH
+from iembot.routing import RoutingTable, valid_channel
+from iembot.webhooks import BATCH_FORMATS, BatchConfig
 
 
 def channels_room_list(bot, room):
@@ -111,10 +36,7 @@ def channels_room_list(bot, room):
     Send a listing of channels that the room is subscribed to...
     @param room to list
     """
-    channels = []
-    for channel in bot.routingtable.keys():
-        if room in bot.routingtable[channel]:
-            channels.append(channel)
+    channels = bot.routingtable.channels_for(room)
 
     # Need to add a space in the channels listing so that the string does
     # not get so long that it causes chat clients to bail
@@ -145,10 +67,15 @@ def channels_room_add(txn, bot, room, channel):
         return
     # Allow channels to be comma delimited
     for ch in channel.split(","):
-        if ch not in bot.routingtable:
-            bot.routingtable[ch] = []
+        if not valid_channel(ch):
+            bot.send_groupchat(
+                room,
+                f"Error adding subscription '{ch}', a * wildcard is only "
+                "supported at the end of a channel, after a prefix",
+            )
+            continue
         # If we are already subscribed, let em know!
-        if room in bot.routingtable[ch]:
+        if room in bot.routingtable.get(ch):
             bot.send_groupchat(
                 room,
                 "Error adding subscription, your room is already subscribed "
@@ -168,7 +95,7 @@ def channels_room_add(txn, bot, room, channel):
             )
 
         # Add to routing table
-        bot.routingtable[ch].append(room)
+        bot.routingtable.add(ch, room)
         # Add to database
         txn.execute(
             f"INSERT into {bot.name}_room_subscriptions "
@@ -198,12 +125,12 @@ def channels_room_del(txn, bot, room, channel):
             bot.send_groupchat(room, f"Unknown channel: '{ch}'")
             continue
 
-        if room not in bot.routingtable[ch]:
+        if room not in bot.routingtable.get(ch):
             bot.send_groupchat(room, f"Room not subscribed to channel: '{ch}'")
             continue
 
         # Remove from routing table
-        bot.routingtable[ch].remove(room)
+        bot.routingtable.remove(ch, room)
         # Remove from database
         txn.execute(
             f"DELETE from {bot.name}_room_subscriptions WHERE "
@@ -226,6 +153,10 @@ def purge_logs(bot):
         if ts < basets:
             log.msg(f"Purging logfile {fn}")
             os.remove(fn)
+    history_ts = utc() - datetime.timedelta(
+        days=int(bot.config.get("bot.history_days", 7))
+    )
+    bot.history.prune(f"{history_ts:%Y%m%d%H%M%S}")
 
 
 def email_error(exp, bot, message=""):
@@ -316,6 +247,7 @@ def disable_twitter_user(bot, user_id, errcode=0):
         log.msg(f"Skipping disabling of twitter for {user_id} ({screen_name})")
         return False
     bot.tw_users.pop(user_id, None)
+    bot.twitter.forget(user_id)
     log.msg(
         f"Removing twitter access token for user: {user_id} ({screen_name}) "
         f"errcode: {errcode}"
@@ -402,20 +334,19 @@ def load_chatrooms_from_db(txn, bot, always_join):
       always_join (boolean): do we force joining each room, regardless
     """
     # Load up the routingtable for bot products
-    rt = {}
+    rt = RoutingTable()
     txn.execute(
         f"SELECT roomname, channel from {bot.name}_room_subscriptions "
         "WHERE roomname is not null and channel is not null"
     )
-    rooms = []
+    rooms = set()
     for row in txn.fetchall():
         rm = row["roomname"]
-        channel = row["channel"]
-        if channel not in rt:
-            rt[channel] = []
-        rt[channel].append(rm)
-        if rm not in rooms:
-            rooms.append(rm)
+        if not valid_channel(row["channel"]):
+            log.msg(f"Ignoring {rm} subscription to {row['channel']}")
+            continue
+        rt.add(row["channel"], rm)
+        rooms.add(rm)
     bot.routingtable = rt
     log.msg(
         f"... loaded {txn.rowcount} channel subscriptions for "
@@ -440,8 +371,9 @@ def load_chatrooms_from_db(txn, bot, always_join):
     )
 
     # Load up a list of chatrooms
+    # The optional chatlog_depth column sets the messages a room retains
     txn.execute(
-        f"SELECT roomname, twitter from {bot.name}_rooms "
+        f"SELECT * from {bot.name}_rooms "
         "WHERE roomname is not null ORDER by roomname ASC"
     )
     oldrooms = list(bot.rooms.keys())
@@ -456,6 +388,7 @@ def load_chatrooms_from_db(txn, bot, always_join):
                 "joined": False,
             }
         bot.rooms[rm]["twitter"] = row["twitter"]
+        bot.chatlog.set_depth(rm, row.get("chatlog_depth"))
 
         if always_join or rm not in oldrooms:
             presence = domish.Element(("jabber:client", "presence"))
@@ -482,6 +415,11 @@ def load_chatrooms_from_db(txn, bot, always_join):
         bot.xmlstream.send(presence)
 
         del bot.rooms[rm]
+        bot.pending.discard(rm)
+    # Rooms only known from the journal fall back to the default depth
+    for rm in list(bot.chatlog.keys()):
+        if rm not in bot.rooms:
+            bot.chatlog.set_depth(rm, None)
     log.msg(
         f"... loaded {txn.rowcount} chatrooms, joined {joined} of them, "
         f"left {len(oldrooms)} of them"
@@ -489,21 +427,43 @@ def load_chatrooms_from_db(txn, bot, always_join):
 
 
 def load_webhooks_from_db(txn, bot):
-    """Load twitter config from database"""
+    """Load webhook config from database
+
+    Batching is opt-in, with the optional batch_window_seconds, batch_size
+    and batch_format columns of a webhook's rows.
+    """
     txn.execute(
-        f"SELECT channel, url from {bot.name}_webhooks "
+        f"SELECT * from {bot.name}_webhooks "
         "WHERE channel is not null and url is not null"
     )
-    table = {}
+    table = RoutingTable()
+    batching = {}
     for row in txn.fetchall():
         url = row["url"]
         channel = row["channel"]
         if url == "" or channel == "":
             continue
-        res = table.setdefault(channel, [])
-        res.append(url)
+        if not valid_channel(channel):
+            log.msg(f"Ignoring webhook {url} subscription to {channel}")
+            continue
+        table.add(channel, url)
+        window = row.get("batch_window_seconds")
+        size = row.get("batch_size")
+        if url in batching or (not window and not size):
+            continue
+        fmt = row.get("batch_format") or "array"
+        if fmt not in BATCH_FORMATS:
+            log.msg(f"Unknown batch_format {fmt} for {url}, using array")
+            fmt = "array"
+        batching[url] = BatchConfig(
+            window=float(window or 10), size=int(size or 50), fmt=fmt
+        )
     bot.webhooks_routingtable = table
-    log.msg(f"load_webhooks_from_db(): {txn.rowcount} subs found")
+    bot.webhooks.set_batching(batching)
+    log.msg(
+        f"load_webhooks_from_db(): {txn.rowcount} subs found, "
+        f"{len(batching)} webhooks batched"
+    )
 
 
 def load_twitter_from_db(txn, bot):
@@ -515,12 +475,15 @@ def load_twitter_from_db(txn, bot):
         "WHERE s.user_id is not null and s.channel is not null "
         "and o.access_token is not null and not o.disabled"
     )
-    twrt = {}
+    twrt = RoutingTable()
     for row in txn.fetchall():
-        user_id = row["user_id"]
-        channel = row["channel"]
-        d = twrt.setdefault(channel, [])
-        d.append(user_id)
+        if not valid_channel(row["channel"]):
+            log.msg(
+                f"Ignoring twitter {row['user_id']} subscription to "
+                f"{row['channel']}"
+            )
+            continue
+        twrt.add(row["channel"], row["user_id"])
     bot.tw_routingtable = twrt
     log.msg(f"load_twitter_from_db(): {txn.rowcount} subs found")
 
@@ -545,22 +508,37 @@ def load_twitter_from_db(txn, bot):
 
 
 def load_chatlog(bot):
-    """load up our pickled chatlog"""
+    """load up our chatlog journal, or the legacy pickle"""
+    if os.path.isfile(bot.journal.path):
+        # Room depths are not known until the database is loaded, so hold
+        # on to everything for now, see load_chatrooms_from_db
+        depth = bot.chatlog.depth
+        bot.chatlog.depth = MAX_DEPTH
+        try:
+            loaded = bot.journal.replay(bot.chatlog)
+            bot.seqnum = max(bot.seqnum, bot.chatlog.newest_seqnum())
+            log.msg(
+                f"Replayed {loaded} entries from {bot.journal.path}, "
+                f"seqnum: {bot.seqnum}"
+            )
+        except Exception as exp:
+            log.err(exp)
+        finally:
+            bot.chatlog.depth = depth
+        return
     if not os.path.isfile(bot.PICKLEFILE):
         log.msg(f"pickfile not found: {bot.PICKLEFILE}")
         return
     try:
         with open(bot.PICKLEFILE, "rb") as fh:
             oldlog = pickle.load(fh)
-        for rm in oldlog:
-            rmlog = oldlog[rm]
-            bot.chatlog[rm] = copy.deepcopy(rmlog)
-            if not rmlog:
-                continue
-            # First message in list is the newest :/
-            seq = rmlog[0].seqnum
-            if seq is not None and int(seq) > bot.seqnum:
-                bot.seqnum = int(seq)
+        # The pickle holds lists of entries, with the newest first
+        for rm, rmlog in oldlog.items():
+            for entry in bot.chatlog.load(rm, rmlog).oldest_first():
+                bot.journal.append(rm, entry)
+        # Migrate the pickle into the journal
+        bot.journal.flush()
+        bot.seqnum = max(bot.seqnum, bot.chatlog.newest_seqnum())
         log.msg(
             f"Loaded CHATLOG pickle: {bot.PICKLEFILE}, seqnum: {bot.seqnum}"
         )
@@ -656,11 +634,14 @@ def add_entry_to_rss(entry, rss):
     """Convert a txt Jabber room message to a RSS feed entry
 
     Args:
-      entry(iembot.basicbot.CHAT_LOG_ENTRY): entry
-
-    Returns:
-      PyRSSGen.RSSItem
+      entry(iembot.chatlog.ChatLogEntry): entry
+      rss(feedgen.feed.FeedGenerator): feed to append the entry to
     """
+    _populate_rss_entry(entry, rss.add_entry(order="append"))
+
+
+def _populate_rss_entry(entry, fe):
+    """Fill out the feedgen.entry.FeedEntry for the chatlog entry."""
     ts = datetime.datetime.strptime(entry.timestamp, "%Y%m%d%H%M%S")
     txt = entry.txtlog
     m = re.search(r"https?://", txt)
@@ -672,7 +653,6 @@ def add_entry_to_rss(entry, rss):
     ltxt = txt[urlpos:].replace("&amp;", "&").strip()
     if ltxt == "":
         ltxt = "https://mesonet.agron.iastate.edu/projects/iembot/"
-    fe = rss.add_entry(order="append")
     fe.title(txt[:urlpos].strip())
     fe.link(link=dict(href=ltxt))
     txt = remove_control_characters(entry.product_text)
@@ -680,6 +660,24 @@ def add_entry_to_rss(entry, rss):
     fe.pubDate(ts.strftime("%a, %d %b %Y %H:%M:%S GMT"))
 
 
+def rss_item_xml(entry):
+    """Return the RSS <item> XML for the chatlog entry.
+
+    The rendering is cached on the entry, so it is only done once.
+
+    Args:
+      entry(iembot.chatlog.ChatLogEntry): entry
+
+    Returns:
+      bytes
+    """
+    if entry.rss_item is None:
+        fe = FeedEntry()
+        _populate_rss_entry(entry, fe)
+        entry.rss_item = etree.tostring(fe.rss_entry(), encoding="UTF-8")
+    return entry.rss_item
+
+
 def daily_timestamp(bot):
     """Send a timestamp to each room we are in.
 
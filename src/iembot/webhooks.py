@@ -1,56 +1,396 @@
 """Send content to various webhooks."""
 import json
+from collections import deque
 from io import BytesIO
+from urllib.parse import urlsplit
 
 from twisted.internet import reactor
 from twisted.python import log
-from twisted.web.client import Agent, FileBodyProducer, readBody
+from twisted.web.client import (
+    Agent,
+    FileBodyProducer,
+    HTTPConnectionPool,
+    readBody,
+)
 from twisted.web.http_headers import Headers
 
+from iembot.health import CLOSED, HealthRegistry
+
 
 def route(bot, channels, elem):
     """Route messages found in provided elem.
 
     Args:
       bot: iembot instance.
-      channels (list): channels for this message.
+      channels (str or list): channels for this message.
       elem: xish element.
     """
-    # {'DMX': [url, url, ...]}
-    subs = [
-        bot.webhooks_routingtable[channel]
-        for channel in channels
-        if channel in bot.webhooks_routingtable
-    ]
-    if not subs:
+    hooks = bot.webhooks_routingtable.fanout(channels)
+    if not hooks:
         return
     data = {"text": str(elem.body)}
-    postdata = json.dumps(data).encode("utf-8", "ignore")
-    for hooks in subs:
-        for hook in hooks:
-            log.msg(hook)
-            bp = FileBodyProducer(BytesIO(postdata))
-            defer = Agent(reactor).request(
-                method=b"POST",
-                uri=hook.encode("ascii"),
-                headers=Headers({"Content-type": ["application/json"]}),
-                bodyProducer=bp,
+    postdata = None
+    for hook in hooks:
+        if bot.webhooks.add_to_batch(hook, data):
+            continue
+        if postdata is None:
+            postdata = json.dumps(data).encode("utf-8", "ignore")
+        bot.webhooks.deliver(hook, postdata)
+
+
+# Batch payload formats
+BATCH_FORMATS = ("array", "text")
+
+
+def batch_payload(fmt, items):
+    """Build the body of a batched POST.
+
+    Args:
+      fmt (str): ``array`` for a JSON list of the messages, or ``text`` for
+        a single message with the texts joined by newlines, which chat
+        services like Slack accept.
+      items (list): the message dicts.
+
+    Returns:
+      bytes
+    """
+    if fmt == "text":
+        data = {"text": "\n".join(item["text"] for item in items)}
+    else:
+        data = items
+    return json.dumps(data).encode("utf-8", "ignore")
+
+
+class BatchConfig:
+    """How messages to a webhook are batched."""
+
+    __slots__ = ("window", "size", "fmt")
+
+    def __init__(self, window=10, size=50, fmt="array"):
+        """Constructor
+
+        Args:
+          window (float): seconds to gather messages for.
+          size (int): messages that cause the batch to be sent right away.
+          fmt (str): the payload format, see batch_payload.
+        """
+        self.window = window
+        self.size = size
+        self.fmt = fmt
+
+    def __eq__(self, other):
+        """Compare the settings."""
+        return isinstance(other, BatchConfig) and (
+            self.window,
+            self.size,
+            self.fmt,
+        ) == (other.window, other.size, other.fmt)
+
+    def __repr__(self):
+        """Representation."""
+        return (
+            f"BatchConfig(window={self.window}, size={self.size}, "
+            f"fmt={self.fmt!r})"
+        )
+
+
+class Batch:
+    """Messages gathered for a webhook."""
+
+    __slots__ = ("items", "call")
+
+    def __init__(self):
+        """Constructor"""
+        self.items = []
+        self.call = None
+
+
+class Delivery:
+    """A webhook POST waiting to be made."""
+
+    __slots__ = ("url", "uri", "host", "body", "attempts", "created")
+
+    def __init__(self, url, uri, host, body, created):
+        """Constructor"""
+        self.url = url
+        # The url encoded for the request
+        self.uri = uri
+        self.host = host
+        self.body = body
+        self.attempts = 0
+        self.created = created
+
+
+class WebhookDispatcher:
+    """I POST to webhooks through a shared connection pool.
+
+    Deliveries are queued per host and each host has at most
+    ``per_host`` requests in flight, so a slow endpoint only holds up
+    itself.  Requests time out, and connection failures, timeouts and
+    HTTP 429 or 5xx responses are retried with an exponential backoff.
+    """
+
+    def __init__(
+        self,
+        clock=None,
+        agent=None,
+        per_host=4,
+        max_queue=10000,
+        connect_timeout=10,
+        response_timeout=30,
+        max_attempts=4,
+        backoff=5,
+        backoff_max=300,
+        health=None,
+    ):
+        """Constructor
+
+        Args:
+          clock (IReactorTime): defaults to the reactor.
+          agent (IAgent, optional): defaults to a pooled Agent.
+          per_host (int): requests in flight per host.
+          max_queue (int): deliveries queued before new ones are dropped.
+          connect_timeout (float): seconds to wait for a connection.
+          response_timeout (float): seconds to wait for the response.
+          max_attempts (int): attempts made for a delivery.
+          backoff (float): seconds before the first retry, then doubling.
+          backoff_max (float): the longest retry delay.
+          health (HealthRegistry, optional): circuit breakers by webhook.
+        """
+        if clock is None:
+            clock = reactor
+        if health is None:
+            health = HealthRegistry(clock)
+        if agent is None:
+            pool = HTTPConnectionPool(clock, persistent=True)
+            pool.maxPersistentPerHost = per_host
+            agent = Agent(clock, connectTimeout=connect_timeout, pool=pool)
+        self.clock = clock
+        self.agent = agent
+        self.health = health
+        self.per_host = per_host
+        self.max_queue = max_queue
+        self.response_timeout = response_timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self._queues = {}
+        self._inflight = {}
+        # url -> BatchConfig for webhooks that opted in to batching
+        self.batching = {}
+        self._batches = {}
+        self.batched = 0
+        self.depth = 0
+        self.delivered = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.short_circuited = 0
+        # Seconds taken by the most recent successful deliveries
+        self.latencies = deque(maxlen=1000)
+
+    def deliver(self, url, body):
+        """Queue a JSON payload to POST to a webhook.
+
+        Args:
+          url (str): the webhook.
+          body (bytes): the JSON payload.
+
+        Returns:
+          bool: False if the delivery was dropped due to a full queue, an
+            open circuit or a bad url.
+        """
+        try:
+            uri = url.encode("ascii")
+        except UnicodeEncodeError:
+            self.dropped += 1
+            log.msg(f"Webhook url {url!r} is not ASCII, dropping delivery")
+            return False
+        if self.depth >= self.max_queue:
+            self.dropped += 1
+            log.msg(f"Webhook queue full, dropping delivery to {url}")
+            return False
+        if not self.health.allow(f"webhook:{url}"):
+            self.short_circuited += 1
+            return False
+        job = Delivery(
+            url, uri, urlsplit(url).netloc, body, self.clock.seconds()
+        )
+        self._enqueue(job)
+        return True
+
+    def set_batching(self, configs):
+        """Replace the batching configuration.
+
+        Batches gathered for webhooks whose configuration went away or
+        changed are sent now.
+
+        Args:
+          configs (dict): url -> BatchConfig.
+        """
+        for url in list(self._batches):
+            if configs.get(url) != self.batching.get(url):
+                self.flush_batch(url)
+        self.batching = configs
+
+    def add_to_batch(self, url, data):
+        """Add a message to the webhook's batch, if it batches.
+
+        Args:
+          url (str): the webhook.
+          data (dict): the message.
+
+        Returns:
+          bool: False if the webhook does not batch.
+        """
+        config = self.batching.get(url)
+        if config is None:
+            return False
+        batch = self._batches.get(url)
+        if batch is None:
+            batch = Batch()
+            self._batches[url] = batch
+            batch.call = self.clock.callLater(
+                config.window, self.flush_batch, url
             )
-            defer.addCallback(_cb)
-            defer.addErrback(_eb)
+        batch.items.append(data)
+        self.batched += 1
+        if len(batch.items) >= config.size:
+            self.flush_batch(url)
+        return True
+
+    def flush_batch(self, url):
+        """Send the messages gathered for a webhook."""
+        batch = self._batches.pop(url, None)
+        if batch is None:
+            return
+        if batch.call is not None and batch.call.active():
+            batch.call.cancel()
+        config = self.batching.get(url) or BatchConfig()
+        self.deliver(url, batch_payload(config.fmt, batch.items))
 
+    def _enqueue(self, job):
+        """Add a delivery to its host's queue."""
+        queue = self._queues.get(job.host)
+        if queue is None:
+            queue = deque()
+            self._queues[job.host] = queue
+        queue.append(job)
+        self.depth += 1
+        self._process(job.host)
 
-def _eb(*args):
-    """errback."""
-    log.msg(str(args))
+    def _process(self, host):
+        """Start deliveries to the host, up to its concurrency limit."""
+        queue = self._queues.get(host)
+        while queue and self._inflight.get(host, 0) < self.per_host:
+            self._send(queue.popleft())
+            self.depth -= 1
+        if queue is not None and not queue:
+            del self._queues[host]
 
+    def _send(self, job):
+        """Make the request."""
+        self._inflight[job.host] = self._inflight.get(job.host, 0) + 1
+        job.attempts += 1
+        start = self.clock.seconds()
+        df = self.agent.request(
+            b"POST",
+            job.uri,
+            Headers({"Content-type": ["application/json"]}),
+            FileBodyProducer(BytesIO(job.body)),
+        )
+        df.addCallback(self._read)
+        df.addTimeout(self.response_timeout, self.clock)
+        df.addCallbacks(
+            self._done,
+            self._failed,
+            callbackArgs=(job, start),
+            errbackArgs=(job,),
+        )
+        df.addErrback(log.err)
 
-def _cb(*args):
-    d = readBody(args[0])
-    d.addCallback(_cbBody)
-    return d
+    @staticmethod
+    def _read(response):
+        """Read the body, so the connection may return to the pool."""
+        df = readBody(response)
+        df.addCallback(lambda body: (response.code, body))
+        return df
+
+    def _finish(self, job):
+        """The request is over, start the next one for the host."""
+        count = self._inflight[job.host] - 1
+        if count:
+            self._inflight[job.host] = count
+        else:
+            del self._inflight[job.host]
+        self._process(job.host)
+
+    def _done(self, res, job, start):
+        """Got a response."""
+        code, body = res
+        self._finish(job)
+        key = f"webhook:{job.url}"
+        if 200 <= code < 300:
+            latency = self.clock.seconds() - start
+            self.delivered += 1
+            self.latencies.append(latency)
+            self.health.success(key, latency)
+            return
+        self.health.failure(key, f"HTTP {code}")
+        retry = code == 429 or code >= 500
+        self._give_up_or_retry(job, f"HTTP {code} {body[:100]}", retry)
+
+    def _failed(self, err, job):
+        """The request did not complete."""
+        self._finish(job)
+        self.health.failure(f"webhook:{job.url}", err.getErrorMessage())
+        self._give_up_or_retry(job, err.getErrorMessage(), True)
+
+    def _give_up_or_retry(self, job, reason, retry):
+        """Schedule another attempt with backoff, if warranted."""
+        breaker = self.health.get(f"webhook:{job.url}")
+        if breaker is not None and breaker.state != CLOSED:
+            # No point in retrying against an open circuit
+            retry = False
+        if not retry or job.attempts >= self.max_attempts:
+            self.failed += 1
+            log.msg(
+                f"Webhook {job.url} failed after {job.attempts} attempts: "
+                f"{reason}"
+            )
+            return
+        delay = min(self.backoff_max, self.backoff * 2 ** (job.attempts - 1))
+        self.retried += 1
+        log.msg(f"Webhook {job.url} retry in {delay}s: {reason}")
+        self.clock.callLater(delay, self._retry, job)
 
+    def _retry(self, job):
+        """Queue the delivery again, unless its circuit opened meanwhile."""
+        if not self.health.allow(f"webhook:{job.url}"):
+            self.short_circuited += 1
+            self.failed += 1
+            log.msg(f"Webhook {job.url} circuit is open, not retrying")
+            return
+        self._enqueue(job)
 
-def _cbBody(body):
-    """deferred deferred."""
-    log.msg(body)
+    def stats(self):
+        """Return metrics about deliveries."""
+        res = {
+            "webhooks.depth": self.depth,
+            "webhooks.inflight": sum(self._inflight.values()),
+            "webhooks.delivered": self.delivered,
+            "webhooks.failed": self.failed,
+            "webhooks.retried": self.retried,
+            "webhooks.dropped": self.dropped,
+            "webhooks.short_circuited": self.short_circuited,
+            "webhooks.batched": self.batched,
+            "webhooks.batches_open": len(self._batches),
+        }
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            count = len(latencies)
+            res["webhooks.latency.mean"] = sum(latencies) / count
+            res["webhooks.latency.p50"] = latencies[count // 2]
+            res["webhooks.latency.p95"] = latencies[int(count * 0.95)]
+            res["webhooks.latency.max"] = latencies[-1]
+        return res
@@ -1,19 +1,149 @@
 """Our web services"""
+import calendar
 import datetime
+import gzip
 import json
 import re
 
 from feedgen.feed import FeedGenerator
 from pyiem.util import utc
 from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 from twisted.python import log
-from twisted.web import resource
+from twisted.web import http, resource, server
 
 # Local
 import iembot.util as botutil
+from iembot.cache import LRUCache
+from iembot.history import MAX_LIMIT
 
-XML_CACHE = {}
-XML_CACHE_EXPIRES = {}
+
+def _footprint(cached):
+    """The bytes a CachedResponse may hold, see CachedResponse.footprint."""
+    return cached.footprint()
+
+
+# room -> CachedResponse of the RSS xml
+XML_CACHE = LRUCache(1000, maxbytes=32 * 1024 * 1024, sizeof=_footprint)
+# (room, seqnum) -> CachedResponse of the room JSON
+JSON_CACHE = LRUCache(5000, maxbytes=32 * 1024 * 1024, sizeof=_footprint)
+RSS_TAIL = b"</channel></rss>"
+EMPTY_MESSAGES = json.dumps({"messages": []})
+# Responses smaller than this are not worth compressing
+GZIP_MIN_BYTES = 1024
+# The entries in a page of room history, unless a limit is given
+HISTORY_LIMIT = 50
+
+
+class CachedResponse:
+    """A rendered response, its validators and its gzipped variant."""
+
+    __slots__ = ("validator", "body", "etag", "modified", "_gzipped")
+
+    def __init__(self, validator, body, etag, modified):
+        """Constructor
+
+        Args:
+          validator: value that changes when the response needs rebuilding.
+          body (bytes): the response.
+          etag (bytes): the HTTP entity tag.
+          modified (int): seconds since the epoch of the last change or
+            None when unknown.
+        """
+        self.validator = validator
+        self.body = body
+        self.etag = etag
+        self.modified = modified
+        self._gzipped = None
+
+    def footprint(self):
+        """Return the bytes held, counting the gzipped body to come.
+
+        The gzipped body is built lazily, so the full body is budgeted for
+        it as an upper bound.
+        """
+        if len(self.body) < GZIP_MIN_BYTES:
+            return len(self.body)
+        return 2 * len(self.body)
+
+    def gzipped(self):
+        """Return the gzipped body, which is only compressed once."""
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, mtime=0)
+        return self._gzipped
+
+
+def entry_epoch(entry):
+    """Return the chatlog entry's timestamp in seconds since the epoch."""
+    ts = datetime.datetime.strptime(entry.timestamp, "%Y%m%d%H%M%S")
+    return calendar.timegm(ts.timetuple())
+
+
+def roomlog_modified(roomlog):
+    """Return when a room's log last changed, or None when unknown.
+
+    Args:
+      roomlog (iembot.chatlog.RoomLog): the room's log.
+
+    Returns:
+      int or None: seconds since the epoch.
+    """
+    if len(roomlog) == 0:
+        return roomlog.updated or None
+    return max(entry_epoch(roomlog[0]), roomlog.updated)
+
+
+def write_cached(request, cached, content_type):
+    """Answer a request with a CachedResponse.
+
+    Conditional requests are answered with a 304 and clients accepting
+    gzip are sent the compressed body, which has an ETag of its own.
+
+    Returns:
+      bytes
+    """
+    body = cached.body
+    etag = cached.etag
+    accept = request.getHeader("accept-encoding") or ""
+    gzipped = len(body) >= GZIP_MIN_BYTES and "gzip" in accept
+    if gzipped:
+        etag = etag[:-1] + b'-gzip"'
+    request.setHeader("Vary", "Accept-Encoding")
+    if request.setETag(etag) == http.CACHED:
+        return b""
+    if cached.modified is None:
+        # Nothing logged yet, answer without a Last-Modified
+        pass
+    elif request.getHeader("if-none-match") is None:
+        # If-None-Match takes precedence over If-Modified-Since
+        if request.setLastModified(cached.modified) == http.CACHED:
+            return b""
+    else:
+        request.lastModified = cached.modified
+    if gzipped:
+        body = cached.gzipped()
+        request.setHeader("Content-Encoding", "gzip")
+    request.setHeader("Content-Length", f"{len(body)}")
+    request.setHeader("Content-Type", content_type)
+    return body
+
+
+def messages_json(entries):
+    """Assemble the JSON messages response from the entries' fragments.
+
+    Args:
+      entries (list): ChatLogEntry objects, oldest first.
+
+    Returns:
+      str
+    """
+    if not entries:
+        return EMPTY_MESSAGES
+    return (
+        '{"messages": ['
+        + ", ".join(entry.json_fragment() for entry in entries)
+        + "]}"
+    )
 
 
 def wfo_rss(iembot, rm):
@@ -22,15 +152,23 @@ def wfo_rss(iembot, rm):
         rm = f"{rm[-3:]}chat"
     elif len(rm) == 3:
         rm = f"k{rm}chat"
-    if rm not in XML_CACHE:
-        XML_CACHE[rm] = ""
-        XML_CACHE_EXPIRES[rm] = -2
-    if rm not in iembot.chatlog:
+    cached = wfo_rss_cached(iembot, rm)
+    if cached is None:
         return ""
-    # should not be empty given the caller
-    lastID = iembot.chatlog[rm][0].seqnum
-    if lastID == XML_CACHE_EXPIRES[rm]:
-        return XML_CACHE[rm]
+    return cached.body
+
+
+def wfo_rss_cached(iembot, rm):
+    """Return the CachedResponse of the room's RSS or None."""
+    if rm not in iembot.chatlog:
+        return None
+    roomlog = iembot.chatlog[rm]
+    lastID = roomlog.newest_seqnum()
+    # Entries updated in place, once their product text arrives, bump this
+    rev = roomlog.revision
+    cached = XML_CACHE.get(rm)
+    if cached is not None and cached.validator == (lastID, rev):
+        return cached
 
     rss = FeedGenerator()
     rss.generator("iembot")
@@ -38,13 +176,24 @@ def wfo_rss(iembot, rm):
     rss.link(href=f"https://weather.im/iembot-rss/room/{rm}.xml", rel="self")
     rss.description(f"{rm} IEMBot RSS Feed")
     rss.lastBuildDate(f"{utc():%a, %d %b %Y %H:%M:%S} GMT")
-
-    for entry in iembot.chatlog[rm]:
-        botutil.add_entry_to_rss(entry, rss)
-
-    XML_CACHE[rm] = rss.rss_str()
-    XML_CACHE_EXPIRES[rm] = lastID
-    return rss.rss_str()
+    # Splice the cached item renderings into the otherwise empty channel
+    xml = rss.rss_str()
+    xml = b"".join(
+        [
+            xml[: -len(RSS_TAIL)],
+            *[botutil.rss_item_xml(entry) for entry in roomlog],
+            RSS_TAIL,
+        ]
+    )
+
+    cached = CachedResponse(
+        (lastID, rev),
+        xml,
+        f'"{rm}-{lastID}-{rev}"'.encode("utf-8"),
+        roomlog_modified(roomlog),
+    )
+    XML_CACHE[rm] = cached
+    return cached
 
 
 class RSSService(resource.Resource):
@@ -78,7 +227,7 @@ class RSSService(resource.Resource):
                 rm = f"{rm[-3:]}chat"
             elif len(rm) == 3:
                 rm = f"k{rm}chat"
-        if not self.iembot.chatlog.get(rm, []):
+        if not self.iembot.chatlog.get(rm):
             rss = FeedGenerator()
             rss.generator("iembot")
             rss.title("IEMBot RSS Feed")
@@ -101,7 +250,9 @@ class RSSService(resource.Resource):
             )
             xml = rss.rss_str()
         else:
-            xml = wfo_rss(self.iembot, rm)
+            return write_cached(
+                request, wfo_rss_cached(self.iembot, rm), "text/xml"
+            )
         request.setHeader("Content-Length", f"{len(xml)}")
         request.setHeader("Content-Type", "text/xml")
         request.setResponseCode(200)
@@ -141,42 +292,265 @@ class RoomChannel(resource.Resource):
             return (f"{request.args['callback'][0]}({j});").encode("utf-8")
         return j.encode("utf-8")
 
-    def render(self, request):
-        """Process the request that we got, it should look something like:
-        /room/dmxchat?seqnum=1
-        """
+    def parse(self, request, path):
+        """Return the (room, seqnum) requested or (None, None) if bad."""
         uri = request.uri.decode("utf-8")
-        tokens = re.findall("/room/([a-z_0-9]+)", uri.lower())
+        tokens = re.findall(f"/{path}/([a-z_0-9]+)", uri.lower())
         if not tokens:
             log.msg(f"Bad URI: {uri} len(tokens) is 0")
-            return self.wrap(request, json.dumps("ERROR"))
+            return None, None
 
         room = tokens[0]
         seqnum = request.args.get(b"seqnum")
         if seqnum is None or len(seqnum) != 1:
             log.msg(f"Bad URI: {request.uri} seqnum problem")
+            return None, None
+        return room, int(seqnum[0])
+
+    def render(self, request):
+        """Process the request that we got, it should look something like:
+        /room/dmxchat?seqnum=1
+
+        or, for a page of older messages, /room/dmxchat?before=100&limit=50
+        """
+        if b"before" in request.args:
+            return self.render_history(request)
+        room, seqnum = self.parse(request, "room")
+        if room is None:
             return self.wrap(request, json.dumps("ERROR"))
-        seqnum = int(seqnum[0])
 
-        r = dict(messages=[])
         if room not in self.iembot.chatlog:
             log.msg(f"No CHATLOG |{room}|")
             return self.wrap(request, json.dumps("ERROR"))
-        for entry in self.iembot.chatlog[room][::-1]:
-            if entry.seqnum <= seqnum:
-                continue
-            ts = datetime.datetime.strptime(entry.timestamp, "%Y%m%d%H%M%S")
-            r["messages"].append(
-                {
-                    "seqnum": entry.seqnum,
-                    "ts": ts.strftime("%Y-%m-%d %H:%M:%S"),
-                    "author": entry.author,
-                    "product_id": entry.product_id,
-                    "message": entry.log,
-                }
+        roomlog = self.iembot.chatlog[room]
+        if "callback" in request.args:
+            return self.wrap(request, messages_json(roomlog.since(seqnum)))
+        newest = roomlog.newest_seqnum()
+        rev = roomlog.revision
+        cached = JSON_CACHE.get((room, seqnum))
+        if cached is None or cached.validator != (newest, rev):
+            cached = CachedResponse(
+                (newest, rev),
+                messages_json(roomlog.since(seqnum)).encode("utf-8"),
+                f'"{room}-{seqnum}-{newest}-{rev}"'.encode("utf-8"),
+                roomlog_modified(roomlog),
             )
+            JSON_CACHE[(room, seqnum)] = cached
+        return write_cached(request, cached, "application/json")
 
-        return self.wrap(request, json.dumps(r))
+    def render_history(self, request):
+        """Answer with the newest entries older than the before seqnum.
+
+        The page is taken from the in-memory chatlog and, when that runs
+        out, from the on-disk history.
+        """
+        tokens = re.findall("/room/([a-z_0-9]+)", request.uri.decode().lower())
+        try:
+            before = int(request.args[b"before"][0])
+            limit = int(request.args.get(b"limit", [HISTORY_LIMIT])[0])
+        except ValueError:
+            tokens = None
+        if not tokens:
+            log.msg(f"Bad URI: {request.uri}")
+            return self.wrap(request, json.dumps("ERROR"))
+        room = tokens[0]
+        limit = max(1, min(MAX_LIMIT, limit))
+        roomlog = self.iembot.chatlog.get(room)
+        entries = []
+        if roomlog is not None:
+            entries = [e for e in roomlog.oldest_first() if e.seqnum < before]
+            entries = entries[-limit:]
+        if len(entries) == limit:
+            return self.wrap(request, messages_json(entries))
+        if entries:
+            before = entries[0].seqnum
+
+        lost = []
+
+        def answer(older):
+            """Write out the page."""
+            if lost:
+                return
+            page = (older + entries)[-limit:]
+            request.write(self.wrap(request, messages_json(page)))
+            request.finish()
+
+        def failed(err):
+            """The history could not be read."""
+            log.err(err)
+            if lost:
+                return
+            request.write(self.wrap(request, json.dumps("ERROR")))
+            request.finish()
+
+        request.notifyFinish().addErrback(lost.append)
+        df = self.iembot.history.before(room, before, limit - len(entries))
+        df.addCallbacks(answer, failed)
+        return server.NOT_DONE_YET
+
+
+class WaitChannel(RoomChannel):
+    """Long-poll variant of RoomChannel.
+
+    /wait/dmxchat?seqnum=1&timeout=30 answers at once if the room has
+    entries newer than seqnum, otherwise the request is parked until an
+    entry is logged to the room or the timeout passes.
+    """
+
+    DEFAULT_TIMEOUT = 30
+    MAX_TIMEOUT = 60
+
+    def render(self, request):
+        """Answer now or park the request."""
+        room, seqnum = self.parse(request, "wait")
+        if room is None:
+            return self.wrap(request, json.dumps("ERROR"))
+        if room not in self.iembot.chatlog and room not in self.iembot.rooms:
+            log.msg(f"No CHATLOG |{room}|")
+            return self.wrap(request, json.dumps("ERROR"))
+        roomlog = self.iembot.chatlog.get(room)
+        entries = [] if roomlog is None else roomlog.since(seqnum)
+        if entries:
+            return self.wrap(request, messages_json(entries))
+
+        timeout = self.DEFAULT_TIMEOUT
+        if request.args.get(b"timeout"):
+            try:
+                timeout = float(request.args[b"timeout"][0])
+            except ValueError:
+                pass
+        timeout = max(0, min(timeout, self.MAX_TIMEOUT))
+        chatlog = self.iembot.chatlog
+
+        def finish(_entry=None):
+            """Write out the response."""
+            if delayed.active():
+                delayed.cancel()
+            chatlog.remove_listener(room, finish)
+            roomlog = chatlog.get(room)
+            entries = [] if roomlog is None else roomlog.since(seqnum)
+            request.write(self.wrap(request, messages_json(entries)))
+            request.finish()
+
+        def lost(_err):
+            """Client went away."""
+            if delayed.active():
+                delayed.cancel()
+            chatlog.remove_listener(room, finish)
+
+        delayed = reactor.callLater(timeout, finish)
+        chatlog.add_listener(room, finish)
+        request.notifyFinish().addErrback(lost)
+        return server.NOT_DONE_YET
+
+
+class StreamChannel(RoomChannel):
+    """Server-Sent Events stream of a room's entries.
+
+    /stream/dmxchat?seqnum=1 first sends any entries newer than seqnum (or
+    the Last-Event-ID header) and then each entry as it is logged.
+    """
+
+    KEEPALIVE = 15
+
+    def __init__(self, iembot):
+        """Constructor"""
+        RoomChannel.__init__(self, iembot)
+        self.streams = set()
+        self.keepalive = LoopingCall(self.send_keepalive)
+
+    def send_keepalive(self):
+        """Keep idle streams from being closed by proxies."""
+        for request in list(self.streams):
+            request.write(b": keepalive\n\n")
+
+    def render(self, request):
+        """Start the stream."""
+        last_id = request.getHeader("last-event-id")
+        if last_id is not None and b"seqnum" not in request.args:
+            request.args[b"seqnum"] = [last_id.encode("ascii", "ignore")]
+        room, seqnum = self.parse(request, "stream")
+        if room is None:
+            return self.wrap(request, json.dumps("ERROR"))
+        if room not in self.iembot.chatlog and room not in self.iembot.rooms:
+            log.msg(f"No CHATLOG |{room}|")
+            return self.wrap(request, json.dumps("ERROR"))
+        request.setHeader("Content-Type", "text/event-stream")
+        request.setHeader("Cache-Control", "no-cache")
+        # Hint for the client to reconnect after 5 seconds
+        request.write(b"retry: 5000\n\n")
+        chatlog = self.iembot.chatlog
+
+        def send(entry):
+            """Write an entry as an event."""
+            event = f"id: {entry.seqnum}\ndata: {entry.json_fragment()}\n\n"
+            request.write(event.encode("utf-8"))
+
+        def lost(_res):
+            """Stream is closed."""
+            chatlog.remove_listener(room, send)
+            self.streams.discard(request)
+            if not self.streams and self.keepalive.running:
+                self.keepalive.stop()
+
+        roomlog = chatlog.get(room)
+        if roomlog is not None:
+            for entry in roomlog.since(seqnum):
+                send(entry)
+        chatlog.add_listener(room, send)
+        self.streams.add(request)
+        if not self.keepalive.running:
+            self.keepalive.start(self.KEEPALIVE, now=False)
+        request.notifyFinish().addBoth(lost)
+        return server.NOT_DONE_YET
+
+
+class RoomsChannel(RoomChannel):
+    """Batched variant of RoomChannel for clients following many rooms.
+
+    The rooms and last seen seqnums are provided either as a query string
+    /rooms?rooms=dmxchat:12,botstalk:40 or as a POSTed JSON object of
+    {"dmxchat": 12, "botstalk": 40}.  The response is a JSON object of
+    {"rooms": {"dmxchat": {"messages": [...]}, ...}}.
+    """
+
+    MAX_ROOMS = 100
+
+    def parse_rooms(self, request):
+        """Return a dict of room to seqnum or None if the request is bad."""
+        wanted = {}
+        try:
+            if request.method == b"POST":
+                body = json.loads(request.content.read().decode("utf-8"))
+                for room, seqnum in body.items():
+                    wanted[str(room).lower()] = int(seqnum)
+            else:
+                for arg in request.args.get(b"rooms", []):
+                    for token in arg.decode("utf-8").split(","):
+                        room, seqnum = token.split(":")
+                        wanted[room.strip().lower()] = int(seqnum)
+        except Exception as exp:
+            log.msg(f"Bad rooms request: {request.uri} {exp}")
+            return None
+        if not wanted or len(wanted) > self.MAX_ROOMS:
+            log.msg(f"Bad rooms request: {request.uri} {len(wanted)} rooms")
+            return None
+        return wanted
+
+    def render(self, request):
+        """Build the response in one pass over the requested rooms."""
+        wanted = self.parse_rooms(request)
+        if wanted is None:
+            return self.wrap(request, json.dumps("ERROR"))
+        chatlog = self.iembot.chatlog
+        parts = []
+        for room, seqnum in wanted.items():
+            if room not in chatlog:
+                res = json.dumps("ERROR")
+            else:
+                res = messages_json(chatlog[room].since(seqnum))
+            parts.append(f"{json.dumps(room)}: {res}")
+        return self.wrap(request, '{"rooms": {' + ", ".join(parts) + "}}")
 
 
 class ReloadChannel(resource.Resource):
@@ -215,9 +589,30 @@ class StatusChannel(resource.Resource):
             "threadpool.waiters": len(tp.waiters),
             "threadpool.working": len(tp.working),
         }
+        res.update(self.iembot.outbound.stats())
+        res.update(self.iembot.pending.stats())
+        res.update(self.iembot.twitter.stats())
+        res.update(self.iembot.webhooks.stats())
+        res.update(self.iembot.products.stats())
+        res.update(self.iembot.chatlog.stats())
+        res.update(self.iembot.history.stats())
         return json.dumps(res).encode("utf-8")
 
 
+class HealthChannel(resource.Resource):
+    """respond to /health requests with the circuit breaker states"""
+
+    def __init__(self, iembot):
+        """Constructor"""
+        resource.Resource.__init__(self)
+        self.iembot = iembot
+
+    def render(self, request):
+        """Answer the call."""
+        request.setHeader("Content-type", "application/json")
+        return json.dumps(self.iembot.health.snapshot()).encode("utf-8")
+
+
 class JSONRootResource(resource.Resource):
     """answer /iembot-json/ requests"""
 
@@ -225,5 +620,9 @@ class JSONRootResource(resource.Resource):
         """Constructor"""
         resource.Resource.__init__(self)
         self.putChild(b"room", RoomChannel(iembot))
+        self.putChild(b"rooms", RoomsChannel(iembot))
+        self.putChild(b"wait", WaitChannel(iembot))
+        self.putChild(b"stream", StreamChannel(iembot))
         self.putChild(b"reload", ReloadChannel(iembot))
         self.putChild(b"status", StatusChannel(iembot))
+        self.putChild(b"health", HealthChannel(iembot))
@@ -0,0 +1,49 @@
+"""Fakes shared by the tests of our HTTP clients."""
+
+from twisted.internet import defer
+from twisted.web.http_headers import Headers
+
+
+class FakeResponse:
+    """A canned response."""
+
+    def __init__(self, body=b"", code=200, headers=None):
+        """Constructor"""
+        self.code = code
+        self.headers = Headers(headers or {"x-rate-limit-remaining": ["9"]})
+        self.body = body
+
+
+class FakeAgent:
+    """Records requests, answering them with canned responses.
+
+    Each request is recorded as (method, uri, headers, deferred).  Without
+    canned responses the deferred is left for the test to fire, as it is
+    for a None response, which is a request that is never answered.
+    """
+
+    def __init__(self, responses=None):
+        """Constructor
+
+        Args:
+          responses (list, optional): FakeResponse, body bytes or None.
+        """
+        self.responses = None
+        if responses is not None:
+            self.responses = [
+                resp
+                if resp is None or isinstance(resp, FakeResponse)
+                else FakeResponse(resp)
+                for resp in responses
+            ]
+        self.requests = []
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        """Fake a request."""
+        df = defer.Deferred()
+        self.requests.append((method, uri, headers, df))
+        if self.responses is not None:
+            resp = self.responses.pop(0)
+            if resp is not None:
+                df.callback(resp)
+        return df
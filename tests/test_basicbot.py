@@ -3,6 +3,9 @@
 from unittest.mock import Mock
 
 from iembot.basicbot import basicbot
+from iembot.outbound import OutboundScheduler
+from twisted.internet.task import Clock
+from twisted.words.protocols.jabber import jid
 
 
 def test_authd_api():
@@ -12,3 +15,40 @@ def test_authd_api():
     xs = Mock()
     bot.connected(xs)
     bot.authd()
+
+
+def _written(xs):
+    """Return the serialized stanzas written to a stream."""
+    return [
+        c[0][0] for c in xs.send.call_args_list if isinstance(c[0][0], bytes)
+    ]
+
+
+def test_reconnect_holds_stanzas():
+    """Test that queued room stanzas wait for the rooms to be rejoined."""
+    bot = basicbot(None, Mock(), xml_log_path="/tmp/")
+    clock = Clock()
+    bot.outbound = OutboundScheduler(bot.write_stanza, clock, room_burst=1)
+    bot.myjid = jid.JID("iembot@localhost/twisted_words")
+    bot.conference = "conference.localhost"
+    bot.config["bot.xmppdomain"] = "localhost"
+    bot.rooms["dmxchat"] = {"joined": False, "occupants": {}}
+    xs = Mock()
+    bot.connected(xs)
+    bot.authd()
+    bot.rooms["dmxchat"]["joined"] = True
+    for i in range(3):
+        bot.send_groupchat("dmxchat", f"Hello {i}")
+    assert len(_written(xs)) == 1
+    bot.disconnected()
+    assert bot.outbound.depth == 0
+    assert len(bot.pending.flush("dmxchat")) == 2
+    # A new stream is not written to until it is authenticated
+    xs2 = Mock()
+    bot.connected(xs2)
+    bot.send_privatechat("me", "Hi")
+    clock.advance(1)
+    assert _written(xs2) == []
+    bot.authd()
+    clock.advance(1)
+    assert len(_written(xs2)) == 1
@@ -0,0 +1,58 @@
+"""Test our caches."""
+
+from iembot.cache import LRUCache, SingleFlight
+from twisted.internet import defer
+
+
+def test_lru():
+    """Test that the least recently used item is evicted."""
+    cache = LRUCache(2)
+    cache["a"] = 1
+    cache["b"] = 2
+    assert cache.get("a") == 1
+    cache["c"] = 3
+    assert "b" not in cache
+    assert len(cache) == 2
+    assert cache.get("b", 0) == 0
+    assert cache.pop("a") == 1
+
+
+def test_lru_bytes():
+    """Test that the cache is bounded by the size of its values."""
+    cache = LRUCache(10, maxbytes=10)
+    cache["a"] = b"12345"
+    cache["b"] = b"1234"
+    cache["a"] = b"123456"
+    assert "b" in cache
+    assert cache.nbytes == 10
+    cache["c"] = b"12"
+    assert "b" not in cache
+    assert cache.nbytes == 8
+    cache["d"] = b"x" * 11
+    assert "d" not in cache
+    cache.pop("a")
+    assert cache.nbytes == 2
+
+
+def test_single_flight():
+    """Test that concurrent lookups share one call."""
+    flight = SingleFlight()
+    calls = []
+
+    def lookup(key):
+        """Fake lookup."""
+        calls.append(defer.Deferred())
+        return calls[-1]
+
+    results = []
+    for _ in range(3):
+        flight.run("a", lookup, "a").addCallback(results.append)
+    assert len(calls) == 1
+    assert "a" in flight
+    calls[0].callback(b"data")
+    assert results == [b"data"] * 3
+    assert len(flight) == 0
+    failures = []
+    flight.run("a", lookup, "a").addErrback(failures.append)
+    calls[1].errback(ValueError("nope"))
+    assert len(failures) == 1
@@ -0,0 +1,187 @@
+"""Test the chatlog storage."""
+
+from iembot.basicbot import ROOM_LOG_ENTRY
+from iembot.chatlog import ChatLog, ChatLogEntry, RoomLog
+from iembot.journal import ChatLogJournal
+
+
+def _entry(seqnum):
+    """Generate an entry."""
+    return ChatLogEntry(
+        seqnum, "20230101000000", "log", "iembot", "", "text", "txtlog"
+    )
+
+
+def test_roomlog_ring():
+    """Test that the ring buffer evicts the oldest entries."""
+    roomlog = RoomLog(3)
+    assert roomlog.newest_seqnum() is None
+    assert roomlog.since(0) == []
+    evicted = [roomlog.append(_entry(i)) for i in range(1, 6)]
+    assert [e.seqnum for e in evicted if e is not None] == [1, 2]
+    assert len(roomlog) == 3
+    assert [e.seqnum for e in roomlog] == [5, 4, 3]
+    assert roomlog[0].seqnum == 5
+    assert roomlog[-1].seqnum == 3
+    assert [e.seqnum for e in roomlog[::-1]] == [3, 4, 5]
+    assert roomlog.newest_seqnum() == 5
+
+
+def test_roomlog_since():
+    """Test the seqnum lookup."""
+    roomlog = RoomLog(10)
+    for i in range(2, 40, 2):
+        roomlog.append(_entry(i))
+    assert [e.seqnum for e in roomlog.since(0)] == list(range(20, 40, 2))
+    assert [e.seqnum for e in roomlog.since(33)] == [34, 36, 38]
+    assert [e.seqnum for e in roomlog.since(34)] == [36, 38]
+    assert roomlog.since(38) == []
+
+
+def test_chatlog_legacy_load():
+    """Test that we can load legacy namedtuple entries."""
+    chatlog = ChatLog(depth=2)
+    legacy = [
+        ROOM_LOG_ENTRY(i, "20230101000000", "a", "b", "", "c", "d")
+        for i in [3, 2, 1]
+    ]
+    chatlog.load("dmxchat", legacy)
+    assert "dmxchat" in chatlog
+    assert [e.seqnum for e in chatlog["dmxchat"]] == [3, 2]
+    assert chatlog.newest_seqnum() == 3
+    assert isinstance(chatlog.snapshot()["dmxchat"][0], ChatLogEntry)
+
+
+def test_journal_replay(tmp_path):
+    """Test that the journal can be replayed and compacted."""
+    journal = ChatLogJournal(str(tmp_path / "chatlog.journal"))
+    chatlog = ChatLog(depth=2)
+    for i in range(1, 5):
+        entry = _entry(i)
+        chatlog.append("dmxchat", entry)
+        journal.append("dmxchat", entry)
+    journal.flush()
+    with open(journal.path, "a", encoding="utf-8") as fh:
+        fh.write('{"room": "dmxchat", "seq')
+    chatlog2 = ChatLog(depth=2)
+    assert journal.replay(chatlog2) == 4
+    assert [e.seqnum for e in chatlog2["dmxchat"]] == [4, 3]
+    # Replaying again should not duplicate anything
+    assert journal.replay(chatlog2) == 0
+    # Compaction, run inline
+    written = journal._write_snapshot(
+        f"{journal.path}.tmp", chatlog.snapshot()
+    )
+    journal._compacting = []
+    journal._swap(written, f"{journal.path}.tmp")
+    with open(journal.path, encoding="utf-8") as fh:
+        assert len(fh.readlines()) == 2
+
+
+def test_chatlog_update(tmp_path):
+    """Test that an entry can be updated in place and journaled."""
+    journal = ChatLogJournal(str(tmp_path / "chatlog.journal"))
+    chatlog = ChatLog(depth=2)
+    entries = [_entry(i) for i in range(1, 4)]
+    for entry in entries:
+        chatlog.append("dmxchat", entry)
+        journal.append("dmxchat", entry)
+    assert chatlog.update("dmxchat", entries[2], product_text="Updated")
+    assert chatlog["dmxchat"].revision == 1
+    assert entries[2].product_text == "Updated"
+    # No longer held, so nothing to update
+    assert not chatlog.update("dmxchat", entries[0], product_text="Gone")
+    assert not chatlog.update("nochat", entries[2], product_text="Gone")
+    journal.append("dmxchat", entries[2])
+    journal.flush()
+    chatlog2 = ChatLog(depth=2)
+    assert journal.replay(chatlog2) == 3
+    assert chatlog2["dmxchat"][0].product_text == "Updated"
+
+
+def test_shared_text(tmp_path):
+    """Test that product text is held and journaled once."""
+    journal = ChatLogJournal(str(tmp_path / "chatlog.journal"))
+    chatlog = ChatLog(depth=2)
+    text = "The product text " * 100
+    for seqnum, room in enumerate(["dmxchat", "dsmchat", "botstalk"], 1):
+        entry = ChatLogEntry(
+            seqnum,
+            "20230101000000",
+            "log",
+            "iembot",
+            "ABC",
+            chatlog.share("ABC", text),
+            "txtlog",
+        )
+        chatlog.append(room, entry)
+        journal.append(room, entry)
+    shared = chatlog.texts["ABC"]
+    assert shared.refs == 3
+    assert chatlog["dsmchat"][0].product_text == text
+    assert chatlog.stats()["chatlog.texts_bytes"] < len(text)
+    journal.flush()
+    with open(journal.path, encoding="utf-8") as fh:
+        assert fh.read().count("The product text") == 100
+    chatlog2 = ChatLog(depth=2)
+    assert journal.replay(chatlog2) == 3
+    assert chatlog2.texts["ABC"].refs == 3
+    assert chatlog2["botstalk"][0].shared_text is chatlog2.texts["ABC"]
+    assert chatlog2["botstalk"][0].product_text == text
+    # Evicting the entries releases the text
+    for seqnum in range(4, 6):
+        chatlog.append("dmxchat", _entry(seqnum))
+    assert shared.refs == 2
+    assert chatlog.update("dsmchat", chatlog["dsmchat"][0], product_text="")
+    assert chatlog.update("botstalk", chatlog["botstalk"][0], product_text="")
+    assert "ABC" not in chatlog.texts
+
+
+def test_room_depth():
+    """Test that rooms retain their configured depth."""
+    chatlog = ChatLog(depth=4)
+    chatlog.set_depth("botstalk", 6)
+    for seqnum in range(1, 11):
+        chatlog.append("botstalk", _entry(seqnum))
+        chatlog.append("dmxchat", _entry(seqnum + 100))
+    assert len(chatlog["botstalk"]) == 6
+    assert len(chatlog["dmxchat"]) == 4
+    nbytes = chatlog["botstalk"].nbytes
+    chatlog.set_depth("botstalk", 3)
+    assert [e.seqnum for e in chatlog["botstalk"]] == [10, 9, 8]
+    assert chatlog["botstalk"].nbytes == nbytes // 2
+    assert [e.seqnum for e in chatlog["botstalk"].since(8)] == [9, 10]
+    chatlog.append("botstalk", _entry(11))
+    assert [e.seqnum for e in chatlog["botstalk"]] == [11, 10, 9]
+    chatlog.set_depth("dmxchat", 20)
+    chatlog.append("dmxchat", _entry(111))
+    assert len(chatlog["dmxchat"]) == 5
+    chatlog.set_depth("dmxchat", None)
+    assert chatlog["dmxchat"].capacity == 4
+
+
+def test_enforce_budget():
+    """Test that the rooms read least recently are trimmed first."""
+    chatlog = ChatLog(depth=20)
+    for seqnum in range(1, 21):
+        for room in ["dmxchat", "dsmchat", "botstalk"]:
+            chatlog.append(room, _entry(seqnum))
+    assert chatlog.enforce_budget() == 0
+    chatlog.maxbytes = chatlog.nbytes - 1
+    chatlog["dsmchat"].last_read = 200
+    chatlog["botstalk"].last_read = 100
+    chatlog["dmxchat"].last_read = 0
+    # Trimming dmxchat is enough
+    assert chatlog.enforce_budget() == 15
+    assert [len(rl) for _rm, rl in chatlog.items()] == [5, 20, 20]
+    # Then botstalk, which was read before dsmchat
+    chatlog.maxbytes = chatlog.nbytes - 1
+    assert chatlog.enforce_budget() == 15
+    assert [len(rl) for _rm, rl in chatlog.items()] == [5, 20, 5]
+    # Last-Modified of the trimmed rooms moves on
+    assert [rl.updated > 0 for _rm, rl in chatlog.items()] == [
+        True,
+        False,
+        True,
+    ]
+    assert chatlog.stats()["chatlog.budget_evicted"] == 30
@@ -0,0 +1,49 @@
+"""Test the circuit breakers."""
+
+from iembot.health import CLOSED, HALF_OPEN, OPEN, HealthRegistry
+from twisted.internet.task import Clock
+
+
+def test_breaker():
+    """Test that a breaker opens, probes and recovers."""
+    clock = Clock()
+    health = HealthRegistry(clock, threshold=2, probe_interval=10)
+    assert health.allow("a")
+    health.success("a", 1.0)
+    health.failure("a", "boom")
+    assert health.get("a").state == CLOSED
+    health.failure("a", "boom")
+    assert health.get("a").state == OPEN
+    assert not health.allow("a")
+    clock.advance(10)
+    assert health.allow("a")
+    assert health.get("a").state == HALF_OPEN
+    # Only one probe at a time
+    assert not health.allow("a")
+    health.failure("a", "still boom")
+    clock.advance(10)
+    assert not health.allow("a")
+    clock.advance(10)
+    assert health.allow("a")
+    health.success("a", 3.0)
+    assert health.allow("a")
+    snap = health.snapshot()
+    assert snap["counts"] == {"closed": 1, "open": 0, "half-open": 0}
+    assert snap["short_circuited"] == 3
+    assert abs(snap["breakers"]["a"]["latency"] - 1.4) < 1e-9
+    assert snap["breakers"]["a"]["failures"] == 3
+
+
+def test_inconclusive():
+    """Test that an inconclusive probe reopens without backing off."""
+    clock = Clock()
+    health = HealthRegistry(clock, threshold=1, probe_interval=10)
+    health.inconclusive("a")
+    assert health.get("a") is None
+    health.failure("a")
+    clock.advance(10)
+    assert health.allow("a")
+    health.inconclusive("a")
+    assert health.get("a").state == OPEN
+    assert health.get("a").next_probe == 10
+    assert health.allow("a")
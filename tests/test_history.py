@@ -0,0 +1,79 @@
+"""Test the on-disk chatlog history."""
+
+from iembot import history
+from iembot.chatlog import ChatLog, ChatLogEntry
+from iembot.products import PENDING_TEXT
+from twisted.internet import defer
+
+
+def _sync(monkeypatch):
+    """Run the database work inline."""
+    monkeypatch.setattr(history.threads, "deferToThread", defer.maybeDeferred)
+
+
+def _entry(chatlog, seqnum, product_id=""):
+    """Generate an entry."""
+    text = "private"
+    if product_id:
+        text = chatlog.share(product_id, f"Text of {product_id}")
+    return ChatLogEntry(
+        seqnum, "20230101000000", "log", "iembot", product_id, text, "txt"
+    )
+
+
+def test_spill_and_page(tmp_path, monkeypatch):
+    """Test that evicted entries can be paged through."""
+    _sync(monkeypatch)
+    store = history.ChatLogHistory(str(tmp_path / "history.db"))
+    chatlog = ChatLog(depth=3)
+    chatlog.spill = store.add
+    for seqnum in range(1, 11):
+        product_id = "ABC" if seqnum % 2 else ""
+        chatlog.append("dmxchat", _entry(chatlog, seqnum, product_id))
+        chatlog.append("dsmchat", _entry(chatlog, seqnum + 100))
+    assert store.stats()["history.pending"] == 14
+    pages = []
+    # Pending entries are found before they are written
+    store.before("dmxchat", 8, 2).addCallback(pages.append)
+    assert [e.seqnum for e in pages[-1]] == [6, 7]
+    store.flush()
+    assert store.stats()["history.spilled"] == 14
+    store.before("dmxchat", 8, 5).addCallback(pages.append)
+    assert [e.seqnum for e in pages[-1]] == [3, 4, 5, 6, 7]
+    assert pages[-1][0].product_text == "Text of ABC"
+    assert pages[-1][1].product_text == "private"
+    # Spilling the same entries again is harmless
+    store.add("dmxchat", pages[-1])
+    store.flush()
+    store.before("dmxchat", 100, 500).addCallback(pages.append)
+    assert [e.seqnum for e in pages[-1]] == list(range(1, 8))
+    store.prune("20230101000001")
+    store.before("dmxchat", 100, 500).addCallback(pages.append)
+    assert pages[-1] == []
+
+
+def _placeholder():
+    """An entry still waiting on its text."""
+    return ChatLogEntry(
+        1, "20230101000000", "log", "iembot", "ABC", PENDING_TEXT, "txt"
+    )
+
+
+def test_late_text(tmp_path, monkeypatch):
+    """Test that text arriving after the entry was spilled replaces it."""
+    _sync(monkeypatch)
+    store = history.ChatLogHistory(str(tmp_path / "history.db"))
+    chatlog = ChatLog()
+    entry = _placeholder()
+    store.add("dmxchat", [entry])
+    store.flush()
+    entry.product_text = chatlog.share("ABC", "Text of ABC")
+    store.add("dmxchat", [entry])
+    store.flush()
+    # Replaying the entry from the journal does not bring back the
+    # placeholder
+    store.add("dmxchat", [_placeholder()])
+    store.flush()
+    pages = []
+    store.before("dmxchat", 2, 1).addCallback(pages.append)
+    assert pages[0][0].product_text == "Text of ABC"
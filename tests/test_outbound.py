@@ -0,0 +1,172 @@
+"""Test outbound stanza handling."""
+
+from iembot.outbound import (
+    LOW,
+    URGENT,
+    OutboundScheduler,
+    PendingQueue,
+    StanzaTemplate,
+    stanza_priority,
+)
+from twisted.internet.task import Clock
+from twisted.words.xish.domish import Element
+
+
+def test_template():
+    """Test that the rendered template matches a serialization."""
+    elem = Element(("jabber:client", "message"))
+    elem["to"] = "botstalk@conference.localhost"
+    elem["type"] = "groupchat"
+    elem.addElement("body", None, "Hello to='x' & <World>")
+    template = StanzaTemplate(elem)
+    assert elem["to"] == "botstalk@conference.localhost"
+    for to in ["dmxchat@conference.localhost", "a'b&c@conference.localhost"]:
+        elem["to"] = to
+        assert template.render(to) == elem.toXml().encode("utf-8")
+
+
+def test_scheduler():
+    """Test that per-room and global limits are enforced."""
+    clock = Clock()
+    sent = []
+    sched = OutboundScheduler(
+        sent.append, clock, room_rate=1, room_burst=2, bytes_per_second=100
+    )
+    for i in range(4):
+        assert sched.enqueue("dmxchat", f"d{i}")
+    sched.enqueue("botstalk", "b0")
+    # First two dmxchat go out immediately, the rest is queued
+    assert sent == [b"d0", b"d1"]
+    assert sched.depth == 3
+    clock.advance(0)
+    assert sent == [b"d0", b"d1", b"b0"]
+    clock.advance(1)
+    assert sent[-1] == b"d2"
+    clock.advance(1)
+    assert sent[-1] == b"d3"
+    assert sched.stats()["outbound.depth"] == 0
+    # A large stanza waits for a full byte budget and then exhausts it
+    sched.enqueue("svrchat", "x" * 150)
+    assert sent[-1] == b"d3"
+    clock.advance(0.05)
+    assert sent[-1] == b"x" * 150
+    sched.enqueue("svrchat", "y")
+    clock.advance(0.4)
+    assert sent[-1] == b"x" * 150
+    clock.advance(0.2)
+    assert sent[-1] == b"y"
+
+
+def _product(product_id, channels="DMX"):
+    """Build a product message element."""
+    elem = Element(("jabber:client", "message"))
+    elem["type"] = "groupchat"
+    elem.addElement("body", None, product_id)
+    x = elem.addElement(("nwschat:nwsbot", "x"))
+    x["product_id"] = product_id
+    x["channels"] = channels
+    return elem
+
+
+def test_stanza_priority():
+    """Test the classification of messages."""
+    assert stanza_priority(_product("202307101200-KDMX-WFUS53-TORDMX")) == 0
+    assert (
+        stanza_priority(_product("202307101200-KDMX-FXUS63-AFDDMX-AAA")) == 1
+    )
+    assert stanza_priority(_product("", "SVRDMX,IAC169")) == 0
+    assert stanza_priority(Element(("jabber:client", "message"))) == 2
+
+
+def test_priority_lanes():
+    """Test that urgent stanzas jump the queue without starving others."""
+    clock = Clock()
+    sent = []
+    sched = OutboundScheduler(
+        sent.append, clock, room_burst=1000, starvation_limit=2
+    )
+    sched.bytes_per_second = 1
+    sched.enqueue("a", "x")
+    for i in range(3):
+        sched.enqueue("a", f"l{i}", LOW)
+    for i in range(5):
+        sched.enqueue("b", f"u{i}", URGENT)
+    stats = sched.stats()
+    assert stats["outbound.urgent.depth"] == 5
+    assert stats["outbound.low.depth"] == 3
+    sched.bytes_per_second = 1000
+    clock.advance(1)
+    assert sent == [
+        b"x",
+        b"u0",
+        b"u1",
+        b"l0",
+        b"u2",
+        b"u3",
+        b"l1",
+        b"u4",
+        b"l2",
+    ]
+    assert sched.stats()["outbound.urgent.sent"] == 5
+
+
+def test_pending_queue():
+    """Test that held stanzas are bounded, expire and flush in order."""
+    clock = Clock()
+    pending = PendingQueue(clock, maxlen=3, expire=60)
+    pending.add("dmxchat", b"a", LOW)
+    pending.add("lotchat", b"e", LOW)
+    clock.advance(30)
+    for stanza in [b"b", b"c", b"d"]:
+        pending.add("dmxchat", stanza, URGENT)
+    assert len(pending) == 4
+    assert pending.stats()["pending.dropped"] == 1
+    clock.advance(40)
+    pending.expire_stale()
+    assert "lotchat" not in pending
+    assert "dmxchat" in pending
+    clock.advance(30)
+    pending.add("dmxchat", b"f", LOW)
+    assert pending.flush("dmxchat") == [(b"f", LOW)]
+    assert pending.flush("dmxchat") == []
+    assert pending.stats()["pending.expired"] == 3
+
+
+def test_pause_and_take():
+    """Test that nothing is written while paused."""
+    clock = Clock()
+    sent = []
+    sched = OutboundScheduler(sent.append, clock, room_burst=1)
+    sched.enqueue("dmxchat", "a")
+    sched.enqueue("dmxchat", "b", LOW)
+    sched.pause()
+    sched.enqueue("me@localhost", "c")
+    sched.enqueue("dmxchat", "d", URGENT)
+    clock.advance(10)
+    assert sent == [b"a"]
+    held = sched.take(lambda key: "@" not in key)
+    assert held == [("dmxchat", b"d", URGENT), ("dmxchat", b"b", LOW)]
+    assert sched.depth == 1
+    sched.resume()
+    clock.advance(0)
+    assert sent == [b"a", b"c"]
+    assert sched.depth == 0
+
+
+def test_expire_buckets():
+    """Test that idle destinations do not keep their buckets."""
+    clock = Clock()
+    sent = []
+    sched = OutboundScheduler(sent.append, clock, room_rate=1, room_burst=2)
+    for key in ["a", "b", "b", "b"]:
+        sched.enqueue(key, "x")
+    sched.expire_buckets()
+    # b still has a stanza queued and a has not refilled
+    assert sched.stats()["outbound.buckets"] == 2
+    clock.advance(2)
+    sched.expire_buckets()
+    assert sched.stats()["outbound.buckets"] == 1
+    clock.advance(1)
+    sched.expire_buckets()
+    assert sched.stats()["outbound.buckets"] == 0
+    assert len(sent) == 4
@@ -0,0 +1,121 @@
+"""Test product text lookups."""
+
+import base64
+import zlib
+
+from iembot.products import ProductTextCache, pop_inline_text
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.words.xish.domish import elementStream
+
+
+class FakeMemcache:
+    """Serves the keys it has been given."""
+
+    def __init__(self):
+        """Constructor"""
+        self.data = {}
+        self.requests = []
+
+    def getMultiple(self, keys):
+        """Fake a multi-key get."""
+        self.requests.append(sorted(keys))
+        return defer.succeed({k: (0, self.data.get(k)) for k in keys})
+
+
+def test_sweeper():
+    """Test that pending products are looked up together."""
+    clock = Clock()
+    memcache = FakeMemcache()
+    products = ProductTextCache(memcache, clock, intervals=(0, 1, 5))
+    results = []
+    for _ in range(300):
+        products.get("ABC").addCallback(results.append)
+    products.get("DEF").addCallback(results.append)
+    # Nothing is looked up until the reactor turns
+    assert memcache.requests == []
+    clock.advance(0)
+    assert memcache.requests == [[b"ABC", b"DEF"]]
+    assert results == []
+    memcache.data[b"ABC"] = b"The text"
+    clock.advance(1)
+    assert memcache.requests[-1] == [b"ABC", b"DEF"]
+    assert results == ["The text"] * 300
+    assert products.cached("ABC") == "The text"
+    products.get("ABC").addCallback(results.append)
+    assert len(memcache.requests) == 2
+    # A product arriving now is not held back by DEF's longer interval
+    products.get("GHI").addCallback(results.append)
+    clock.advance(0)
+    assert memcache.requests[-1] == [b"GHI"]
+    stats = products.stats()
+    assert stats["products.hits"] == 2
+    assert stats["products.coalesced"] == 299
+    assert stats["products.pending"] == 2
+    # DEF gives up after the last interval
+    clock.pump([1, 4])
+    assert memcache.requests[-2:] == [[b"GHI"], [b"DEF"]]
+    assert results[-1] is None
+    assert products.stats()["products.misses"] == 1
+    assert products.stats()["products.pending"] == 1
+
+
+def test_missing():
+    """Test that a product given up on is not looked for again soon."""
+    clock = Clock()
+    memcache = FakeMemcache()
+    products = ProductTextCache(
+        memcache, clock, intervals=(0, 1), missing_ttl=60
+    )
+    results = []
+    products.get("ABC").addCallback(results.append)
+    clock.pump([0, 1])
+    assert results == [None]
+    assert products.cached("ABC") == ""
+    products.get("ABC").addCallback(results.append)
+    clock.advance(0)
+    assert results == [None, None]
+    assert len(memcache.requests) == 2
+    clock.advance(60)
+    assert products.cached("ABC") is None
+    products.put("DEF", "The text")
+    assert products.cached("DEF") == "The text"
+
+
+def test_put():
+    """Test that seeded text needs no lookup."""
+    products = ProductTextCache(None, Clock())
+    results = []
+    products.get("ABC").addCallback(results.append)
+    products.put("ABC", "The text")
+    products.get("ABC").addCallback(results.append)
+    assert results == [None, "The text"]
+
+
+def _parse(xml):
+    """Parse a stanza."""
+    res = []
+    stream = elementStream()
+    stream.DocumentStartEvent = lambda root: None
+    stream.ElementEvent = res.append
+    stream.parse(b"<stream>" + xml.encode("utf-8"))
+    return res[0]
+
+
+def test_inline_text():
+    """Test that inline product text is decoded and stripped."""
+    text = base64.b64encode(zlib.compress(b"The text")).decode("ascii")
+    elem = _parse(
+        "<message><body>Hi</body><x xmlns='nwschat:nwsbot' "
+        f"product_id='ABC'><product_text encoding='zlib+base64'>{text}"
+        "</product_text></x></message>"
+    )
+    assert pop_inline_text(elem.x) == "The text"
+    assert "product_text" not in elem.toXml()
+    assert pop_inline_text(elem.x) is None
+    elem = _parse(
+        "<message><x xmlns='nwschat:nwsbot'><product_text "
+        "encoding='zlib+base64'>garbage</product_text></x></message>"
+    )
+    assert pop_inline_text(elem.x) is None
+    assert "product_text" not in elem.toXml()
@@ -0,0 +1,48 @@
+"""Test the channel routing."""
+
+from iembot.routing import RoutingTable, valid_channel
+
+
+def test_fanout():
+    """Test that fanout is deduplicated and invalidated."""
+    rt = RoutingTable()
+    assert rt.add("DMX", "dmxchat")
+    assert rt.add("DMX", "botstalk")
+    assert not rt.add("DMX", "dmxchat")
+    assert rt.add("SVRDMX", "dmxchat")
+    assert rt.add("SVRDMX", "svrchat")
+    assert rt.fanout("DMX,SVRDMX") == ("dmxchat", "botstalk", "svrchat")
+    assert rt.fanout(["SVRDMX", "XXX"]) == ("dmxchat", "svrchat")
+    assert rt.channels_for("dmxchat") == ["DMX", "SVRDMX"]
+    assert rt.remove("SVRDMX", "svrchat")
+    assert not rt.remove("SVRDMX", "svrchat")
+    assert rt.fanout("DMX,SVRDMX") == ("dmxchat", "botstalk")
+    assert rt.channels_for("svrchat") == []
+    assert rt.get("XXX") == ()
+    assert "DMX" in rt
+
+
+def test_wildcard():
+    """Test prefix subscriptions."""
+    rt = RoutingTable()
+    rt.add("SVR*", "svrchat")
+    rt.add("SVRDMX", "dmxchat")
+    rt.add("IAC*", "iowachat")
+    rt.add("IAC169", "amschat")
+    assert rt.fanout("SVRDMX") == ("dmxchat", "svrchat")
+    assert rt.fanout("TORDMX,IAC169,IAZ001") == ("amschat", "iowachat")
+    assert rt.fanout("SV") == ()
+    assert rt.get("SVR*") == ("svrchat",)
+    assert rt.remove("SVR*", "svrchat")
+    assert rt.fanout("SVRDMX") == ("dmxchat",)
+    assert not rt._trie.children.get("S")
+    rt.add("*", "botstalk")
+    assert rt.fanout("ABC") == ("botstalk",)
+
+
+def test_valid_channel():
+    """Test that a wildcard needs a prefix and must end the channel."""
+    assert valid_channel("SVR")
+    assert valid_channel("SVR*")
+    assert not valid_channel("*")
+    assert not valid_channel("S*R")
@@ -0,0 +1,248 @@
+"""Test the twitter client."""
+
+import time
+
+from conftest import FakeAgent, FakeResponse
+from iembot.twitterclient import (
+    OAuth1Signer,
+    TwitterClient,
+    TwitterError,
+    parse_response,
+    status_error,
+)
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+
+def test_signature():
+    """Test against the example in Twitter's documentation."""
+    signer = OAuth1Signer(
+        "xvz1evFS4wEEPTGEFPHBog",
+        "kAcSOqF21Fu85e7zjz7ZN2U4ZRhfV3WpwPAoE3Z7kBw",
+        "370773112-GmHxMAgYyLbNEtIKZeRNFsMKPR9EyMZeS9weJAEb",
+        "LswwdoUaIvS8ltyTt5jkRh4J50vUPVVHtR2YPi5kE",
+    )
+    signature, _ = signer.sign(
+        "post",
+        "https://api.twitter.com/1.1/statuses/update.json",
+        [
+            ("include_entities", "true"),
+            ("status", "Hello Ladies + Gentlemen, a signed OAuth request!"),
+        ],
+        "kYjzVBB8Y0ZFabxSWbWovY3uYSQ2pTgmZeNu2VS4cg",
+        1318622958,
+    )
+    assert signature == "hCtSmYh+iHYCEqBWrE7C7hYmtUk="
+    header = signer.authorization("POST", "https://example.com", ts=1)
+    assert 'oauth_timestamp="1"' in header
+    assert "oauth_signature=" in header
+
+
+def test_parse_response():
+    """Test that errors are raised."""
+    assert parse_response(b'{"data": {"id": "1"}}')["data"]["id"] == "1"
+    for body in [b'{"errors": [{"code": 187}]}', b"<html>"]:
+        try:
+            parse_response(body)
+            raise AssertionError("Should have raised")
+        except TwitterError:
+            pass
+
+
+def test_status_error():
+    """Test that non-2xx responses carry their status and detail."""
+    exp = status_error(
+        401,
+        b'{"title": "Unauthorized", "detail": "Unauthorized", "status": 401}',
+    )
+    assert exp.args[0] == [{"status": 401, "message": "HTTP 401 Unauthorized"}]
+    exp = status_error(403, b'{"errors": [{"code": 187, "message": "Dup"}]}')
+    assert exp.args[0][0]["code"] == 187
+    assert exp.args[0][0]["status"] == 403
+    exp = status_error(400, b'{"error": "media type unrecognized."}')
+    assert str(exp).startswith("media type unrecognized")
+    assert "502" in str(status_error(502, b"<html>"))
+
+
+def _client(monkeypatch, responses):
+    """Build a client using canned responses."""
+    monkeypatch.setattr(
+        "iembot.twitterclient.readBody", lambda resp: defer.succeed(resp.body)
+    )
+    clock = Clock()
+    agent = FakeAgent(responses)
+    client = TwitterClient(clock, agent=agent)
+    client.set_consumer("key", "secret")
+    return clock, agent, client
+
+
+def test_tweet(monkeypatch):
+    """Test posting a tweet and the retry of a failure."""
+    clock, agent, client = _client(
+        monkeypatch,
+        [b'{"data": {"id": "1"}}', b"<html>", b'{"data": {"id": "2"}}'],
+    )
+    results = []
+    client.tweet(1, "token", "secret", "Hello").addCallback(results.append)
+    assert results == [{"data": {"id": "1"}}]
+    assert client.signer(1, "token", "secret") is client.signer(1, "token", "")
+    client.tweet(1, "token", "secret", "Hello").addCallback(results.append)
+    assert len(results) == 1
+    clock.advance(10)
+    assert results[-1] == {"data": {"id": "2"}}
+    assert (
+        agent.requests[0][2]
+        .getRawHeaders("Authorization")[0]
+        .startswith("OAuth ")
+    )
+    assert client.stats()["twitter.retries"] == 1
+
+
+def test_revoked_token(monkeypatch):
+    """Test that a v2 client error fails the tweet without retries."""
+    body = (
+        b'{"title": "Unauthorized", "detail": "Unauthorized", "status": 401}'
+    )
+    _clock, agent, client = _client(
+        monkeypatch, [FakeResponse(body, 401), b'{"data": {"id": "2"}}']
+    )
+    errors = []
+    client.tweet(1, "t", "s", "Hi").addErrback(errors.append)
+    assert errors[0].check(TwitterError)
+    assert "HTTP 401" in str(errors[0].value)
+    stats = client.stats()
+    assert stats["twitter.sent"] == 0
+    assert stats["twitter.retries"] == 0
+    assert client.health.get("twitter:1") is None
+    assert len(agent.requests) == 1
+
+
+def test_duplicate(monkeypatch):
+    """Test that a v2 duplicate tweet is let go quietly."""
+    body = (
+        b'{"title": "Forbidden", "status": 403, "detail": "You are not '
+        b'allowed to create a Tweet with duplicate content."}'
+    )
+    _clock, agent, client = _client(
+        monkeypatch, [FakeResponse(body, 403), FakeResponse(body, 403)]
+    )
+    results = []
+    for _ in range(2):
+        client.tweet(1, "t", "s", "Hi").addCallback(results.append)
+    assert results == [None, None]
+    assert len(agent.requests) == 2
+    assert client.health.get("twitter:1").total_failures == 0
+
+
+def test_timeout(monkeypatch):
+    """Test that a request that never answers does not stall the queue."""
+    clock, agent, client = _client(
+        monkeypatch, [None, b'{"data": {"id": "2"}}']
+    )
+    results = []
+    client.tweet(1, "t", "s", "Hi").addCallback(results.append)
+    assert results == []
+    clock.advance(client.timeout)
+    assert client.stats()["twitter.retries"] == 1
+    clock.advance(10)
+    assert results == [{"data": {"id": "2"}}]
+    assert len(agent.requests) == 2
+
+
+def test_rate_limit(monkeypatch):
+    """Test that a user's queue waits for the reset and drops stale."""
+    reset = str(int(time.time()) + 600)
+    clock, agent, client = _client(
+        monkeypatch,
+        [
+            FakeResponse(
+                b'{"data": {"id": "1"}}',
+                headers={
+                    "x-rate-limit-remaining": ["0"],
+                    "x-rate-limit-reset": [reset],
+                },
+            ),
+            FakeResponse(b"{}", 429, headers={"x-rate-limit-reset": [reset]}),
+        ],
+    )
+    results = []
+    for text in ["a", "b"]:
+        client.tweet(1, "t", "s", text).addCallback(results.append)
+    client.tweet(2, "t", "s", "c").addCallback(results.append)
+    # user 2 is not held up by user 1, but gets rate limited itself
+    assert results == [{"data": {"id": "1"}}]
+    assert len(agent.requests) == 2
+    assert client.stats()["twitter.rate_limited"] == 2
+    clock.advance(590)
+    assert len(agent.requests) == 2
+    client.max_age = 60
+    clock.advance(20)
+    # The tweets waited out the reset and are now too old to bother with
+    assert results == [{"data": {"id": "1"}}, None, None]
+    assert len(agent.requests) == 2
+    assert client.stats()["twitter.dropped"] == 2
+
+
+def test_media_shared(monkeypatch):
+    """Test that media is downloaded once for many accounts."""
+    clock, agent, client = _client(
+        monkeypatch,
+        [
+            b"PNG",
+            b'{"media_id_string": "5"}',
+            b'{"data": {"id": "1"}}',
+            b'{"media_id_string": "6"}',
+            b'{"data": {"id": "2"}}',
+        ],
+    )
+    for user_id in [1, 2]:
+        client.tweet(user_id, "t", "s", "Hi", media="http://localhost/a.png")
+    methods = [req[0] for req in agent.requests]
+    assert methods == [b"GET", b"POST", b"POST", b"POST", b"POST"]
+    stats = client.stats()
+    assert stats["twitter.media_downloads"] == 1
+    assert stats["twitter.media_hits"] == 1
+    assert stats["twitter.sent"] == 2
+
+
+def test_media_fetch_failed(monkeypatch):
+    """Test that media that cannot be fetched does not fail the account."""
+    clock, agent, client = _client(
+        monkeypatch, [FakeResponse(b"", 404), b'{"data": {"id": "1"}}']
+    )
+    results = []
+    client.tweet(
+        1, "t", "s", "Hi", media="http://localhost/a.png"
+    ).addCallback(results.append)
+    assert results == [{"data": {"id": "1"}}]
+    assert [req[0] for req in agent.requests] == [b"GET", b"POST"]
+    assert client.health.get("twitter:1").total_failures == 0
+    assert client.stats()["twitter.retries"] == 0
+
+
+def test_probe_settles(monkeypatch):
+    """Test that a probe ending in a duplicate or a 429 settles the breaker."""
+    clock, agent, client = _client(
+        monkeypatch,
+        [
+            FakeResponse(b'{"errors": [{"code": 187}]}', 403),
+            FakeResponse(b"{}", 429),
+            b'{"data": {"id": "2"}}',
+        ],
+    )
+    for user_id in [1, 2]:
+        for _ in range(5):
+            client.health.failure(f"twitter:{user_id}")
+    clock.advance(60)
+    results = []
+    for user_id in [1, 2]:
+        client.tweet(user_id, "t", "s", "Hi").addCallback(results.append)
+    # The duplicate shows the account is fine
+    assert results == [None]
+    assert client.health.get("twitter:1").state == "closed"
+    # The rate limited probe is tried again once the limit resets
+    assert client.health.get("twitter:2").state == "open"
+    clock.advance(client.backoff_max)
+    assert results == [None, {"data": {"id": "2"}}]
+    assert client.health.get("twitter:2").state == "closed"
+    assert len(agent.requests) == 3
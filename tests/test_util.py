@@ -9,16 +9,18 @@ import iembot.util as botutil
 import psycopg2
 from iembot.basicbot import basicbot
 from iembot.iemchatbot import JabberClient
+from iembot.journal import ChatLogJournal
+from iembot.routing import RoutingTable
+from iembot.twitterclient import TwitterError
 from psycopg2.extras import RealDictCursor
 from twisted.python.failure import Failure
 from twisted.words.xish.domish import Element
-from twitter.error import TwitterError
 
 
 def test_load_chatlog():
-    """Test our pickling fun."""
+    """Test our journaling fun."""
     bot = JabberClient(None, None, xml_log_path="/tmp")
-    bot.PICKLEFILE = tempfile.mkstemp()[1]
+    bot.journal = ChatLogJournal(tempfile.mkstemp()[1])
     bot.save_chatlog()
     botutil.load_chatlog(bot)
     assert bot.seqnum == 0
@@ -45,6 +47,8 @@ def test_error_conversion():
     )
     assert botutil.twittererror_exp_to_code(err) == 185
     assert botutil.twittererror_exp_to_code(Failure(err)) == 185
+    err = TwitterError([{"code": 187, "message": "Status is a duplicate."}])
+    assert botutil.twittererror_exp_to_code(Failure(err)) == 187
 
 
 def test_load_chatrooms_fromdb():
@@ -58,6 +62,42 @@ def test_load_chatrooms_fromdb():
     assert bot
 
 
+def test_channels_room_add_del():
+    """Test subscribing and unsubscribing a room."""
+    bot = mock.Mock()
+    bot.name = "iembot"
+    bot.routingtable = RoutingTable()
+    txn = mock.Mock()
+    txn.rowcount = 0
+    botutil.channels_room_add(txn, bot, "dmxchat", "abc, def")
+    assert bot.routingtable.channels_for("dmxchat") == ["ABC", "DEF"]
+    botutil.channels_room_add(txn, bot, "dmxchat", "ABC")
+    assert "already subscribed" in bot.send_groupchat.call_args_list[-2][0][1]
+    botutil.channels_room_del(txn, bot, "dmxchat", "ABC,XYZ")
+    assert bot.routingtable.channels_for("dmxchat") == ["DEF"]
+    assert "Unknown channel" in bot.send_groupchat.call_args_list[-2][0][1]
+    botutil.channels_room_del(txn, bot, "lotchat", "DEF")
+    assert "not subscribed" in bot.send_groupchat.call_args_list[-2][0][1]
+    assert bot.routingtable.get("DEF") == ("dmxchat",)
+    botutil.channels_room_add(txn, bot, "dmxchat", "*")
+    assert "after a prefix" in bot.send_groupchat.call_args_list[-2][0][1]
+    assert "*" not in bot.routingtable
+
+
+def test_load_twitter_from_db():
+    """Test that a bare wildcard subscription is ignored."""
+    txn = mock.Mock()
+    txn.fetchall.side_effect = [
+        [{"user_id": 1, "channel": "*"}, {"user_id": 2, "channel": "SVR*"}],
+        [],
+    ]
+    bot = mock.Mock()
+    bot.name = "iembot"
+    botutil.load_twitter_from_db(txn, bot)
+    assert bot.tw_routingtable.fanout("SVRDMX") == (2,)
+    assert bot.tw_routingtable.fanout("AFDDMX") == ()
+
+
 def test_daily_timestamp():
     """Does the daily timestamp algo return a deferred."""
     bot = basicbot(None, None, xml_log_path="/tmp")
@@ -0,0 +1,154 @@
+"""Test webhook delivery."""
+from unittest import mock
+
+from conftest import FakeAgent, FakeResponse
+from iembot.util import load_webhooks_from_db
+from iembot.webhooks import (
+    BatchConfig,
+    WebhookDispatcher,
+    batch_payload,
+    route,
+)
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.words.xish.domish import Element
+
+
+def test_dispatcher(monkeypatch):
+    """Test concurrency limits, retries and timeouts."""
+    monkeypatch.setattr(
+        "iembot.webhooks.readBody", lambda resp: defer.succeed(b"")
+    )
+    clock = Clock()
+    agent = FakeAgent()
+    hooks = WebhookDispatcher(
+        clock, agent, per_host=1, max_queue=2, response_timeout=30
+    )
+    assert hooks.deliver("http://fast/", b"{}")
+    for i in range(3):
+        assert hooks.deliver(f"http://slow/{i}", b"{}")
+    assert not hooks.deliver("http://slow/3", b"{}")
+    # one in flight to each host
+    assert len(agent.requests) == 2
+    assert hooks.stats()["webhooks.depth"] == 2
+    clock.advance(1)
+    agent.requests[0][3].callback(FakeResponse(code=204))
+    agent.requests[1][3].callback(FakeResponse(code=503))
+    assert agent.requests[2][1] == b"http://slow/1"
+    # slow/0 is requeued after 5s and slow/1 times out after 30s
+    clock.advance(30)
+    assert agent.requests[3][1] == b"http://slow/2"
+    stats = hooks.stats()
+    assert stats["webhooks.delivered"] == 1
+    assert stats["webhooks.latency.max"] == 1
+    assert stats["webhooks.retried"] == 2
+    assert stats["webhooks.dropped"] == 1
+    # client errors are not retried
+    agent.requests[3][3].callback(FakeResponse(code=404))
+    assert hooks.stats()["webhooks.failed"] == 1
+    assert agent.requests[4][1] == b"http://slow/0"
+
+
+def test_batching(monkeypatch):
+    """Test that messages to a batching webhook are coalesced."""
+    monkeypatch.setattr(
+        "iembot.webhooks.readBody", lambda resp: defer.succeed(b"")
+    )
+    clock = Clock()
+    agent = FakeAgent()
+    hooks = WebhookDispatcher(clock, agent)
+    hooks.set_batching({"http://b/": BatchConfig(window=5, size=3)})
+    bot = mock.Mock()
+    bot.webhooks = hooks
+    bot.webhooks_routingtable.fanout.return_value = ("http://a/", "http://b/")
+    for i in range(4):
+        elem = Element(("jabber:client", "message"))
+        elem.addElement("body", None, f"msg{i}")
+        route(bot, "XXX", elem)
+    # a is sent each message, b once for the first three
+    assert [req[1] for req in agent.requests].count(b"http://b/") == 1
+    assert len(agent.requests) == 5
+    clock.advance(5)
+    assert len(agent.requests) == 6
+    assert hooks.stats()["webhooks.batched"] == 4
+    assert batch_payload("array", [{"text": "a"}]) == b'[{"text": "a"}]'
+    assert batch_payload("text", [{"text": "a"}, {"text": "b"}]) == (
+        b'{"text": "a\\nb"}'
+    )
+
+
+def test_load_webhooks_from_db():
+    """Test that batching columns are optional."""
+    txn = mock.Mock()
+    txn.fetchall.return_value = [
+        {"channel": "A", "url": "http://a/"},
+        {"channel": "*", "url": "http://a/"},
+        {"channel": "B", "url": "http://b/", "batch_size": 10},
+        {"channel": "C", "url": "http://b/", "batch_size": None},
+        {
+            "channel": "A",
+            "url": "http://c/",
+            "batch_window_seconds": 60,
+            "batch_format": "text",
+        },
+    ]
+    bot = mock.Mock()
+    bot.name = "iembot"
+    bot.webhooks = WebhookDispatcher(Clock(), FakeAgent())
+    load_webhooks_from_db(txn, bot)
+    assert bot.webhooks_routingtable.fanout("A") == ("http://a/", "http://c/")
+    assert bot.webhooks_routingtable.fanout("D") == ()
+    assert "http://a/" not in bot.webhooks.batching
+    assert bot.webhooks.batching["http://b/"] == BatchConfig(10, 10)
+    assert bot.webhooks.batching["http://c/"].fmt == "text"
+
+
+def test_circuit_breaker(monkeypatch):
+    """Test that a dead webhook is short circuited."""
+    monkeypatch.setattr(
+        "iembot.webhooks.readBody", lambda resp: defer.succeed(b"")
+    )
+    clock = Clock()
+    agent = FakeAgent()
+    hooks = WebhookDispatcher(clock, agent, max_attempts=1)
+    for _ in range(5):
+        assert hooks.deliver("http://dead/", b"{}")
+        agent.requests[-1][3].callback(FakeResponse(code=404))
+    assert not hooks.deliver("http://dead/", b"{}")
+    assert len(agent.requests) == 5
+    assert hooks.stats()["webhooks.short_circuited"] == 1
+    assert hooks.health.snapshot()["counts"]["open"] == 1
+
+
+def test_bad_url():
+    """Test that a url we cannot request is dropped up front."""
+    clock = Clock()
+    agent = FakeAgent()
+    hooks = WebhookDispatcher(clock, agent)
+    assert not hooks.deliver("http://bad/é", b"{}")
+    assert agent.requests == []
+    assert hooks.stats()["webhooks.dropped"] == 1
+    assert hooks.stats()["webhooks.depth"] == 0
+    assert hooks.deliver("http://good/", b"{}")
+    assert len(agent.requests) == 1
+
+
+def test_retry_short_circuited(monkeypatch):
+    """Test that a retry is not sent once the circuit has opened."""
+    monkeypatch.setattr(
+        "iembot.webhooks.readBody", lambda resp: defer.succeed(b"")
+    )
+    clock = Clock()
+    agent = FakeAgent()
+    hooks = WebhookDispatcher(clock, agent)
+    assert hooks.deliver("http://flaky/", b"{}")
+    agent.requests[0][3].callback(FakeResponse(code=503))
+    assert hooks.stats()["webhooks.retried"] == 1
+    # Other deliveries open the circuit while the retry waits
+    for _ in range(4):
+        hooks.health.failure("webhook:http://flaky/")
+    clock.advance(5)
+    assert len(agent.requests) == 1
+    stats = hooks.stats()
+    assert stats["webhooks.short_circuited"] == 1
+    assert stats["webhooks.failed"] == 1
@@ -1,7 +1,14 @@
 """Try to test the webservices."""
+import gzip
+import json
 
-from iembot import webservices
+from iembot import history, webservices
 from iembot.basicbot import basicbot
+from iembot.chatlog import ChatLogEntry
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.web import server
+from twisted.web.test.requesthelper import DummyChannel, DummyRequest
 
 
 def test_status():
@@ -16,3 +23,166 @@ def test_api():
     bot = basicbot("iembot", None, xml_log_path="/tmp")
     res = webservices.wfo_rss(bot, "dmxchat")
     assert res is not None
+
+
+def test_messages_json():
+    """Test the assembly of the room JSON response."""
+    entry = ChatLogEntry(
+        10, "20230102030405", "<p>Hi</p>", "iembot", "PID", "text", "Hi"
+    )
+    res = json.loads(webservices.messages_json([entry, entry]))
+    assert len(res["messages"]) == 2
+    assert res["messages"][0]["ts"] == "2023-01-02 03:04:05"
+    assert res["messages"][0]["message"] == "<p>Hi</p>"
+    assert webservices.messages_json([]) == json.dumps({"messages": []})
+
+
+def test_wait_and_stream():
+    """Test that parked requests get answered when an entry is logged."""
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    bot.rooms["dmxchat"] = {}
+    req = DummyRequest([b""])
+    req.uri = b"/iembot-json/wait/dmxchat"
+    req.args = {b"seqnum": [b"0"]}
+    assert webservices.WaitChannel(bot).render(req) == server.NOT_DONE_YET
+    sreq = DummyRequest([b""])
+    sreq.uri = b"/iembot-json/stream/dmxchat"
+    sreq.args = {b"seqnum": [b"0"]}
+    stream = webservices.StreamChannel(bot)
+    assert stream.render(sreq) == server.NOT_DONE_YET
+    entry = ChatLogEntry(
+        1, "20230102030405", "<p>Hi</p>", "iembot", "", "text", "Hi"
+    )
+    bot.chatlog.append("dmxchat", entry)
+    assert req.finished
+    res = json.loads(b"".join(req.written))
+    assert res["messages"][0]["seqnum"] == 1
+    assert sreq.written[-1].startswith(b"id: 1\n")
+    sreq.processingFailed(Failure(Exception("gone")))
+    assert bot.chatlog.listener_count() == 0
+    assert not stream.keepalive.running
+
+
+def test_rooms():
+    """Test the batched multi-room service."""
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    for i, room in enumerate(["dmxchat", "dmxchat", "botstalk"], start=1):
+        bot.chatlog.append(
+            room, ChatLogEntry(i, "20230102030405", "a", "b", "", "c", "d")
+        )
+    req = DummyRequest([b""])
+    req.args = {b"rooms": [b"dmxchat:1,botstalk:0,xxxchat:0"]}
+    res = json.loads(webservices.RoomsChannel(bot).render(req))
+    assert [m["seqnum"] for m in res["rooms"]["dmxchat"]["messages"]] == [2]
+    assert len(res["rooms"]["botstalk"]["messages"]) == 1
+    assert res["rooms"]["xxxchat"] == "ERROR"
+    req.args = {b"rooms": [b"dmxchat"]}
+    assert json.loads(webservices.RoomsChannel(bot).render(req)) == "ERROR"
+
+
+def test_rss_items_cached():
+    """Test that RSS items are rendered once and spliced into the feed."""
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    entry = ChatLogEntry(
+        1, "20230102030405", "a", "b", "", "text", "Hi https://x.com"
+    )
+    bot.chatlog.append("dmxchat", entry)
+    xml = webservices.wfo_rss(bot, "dmxchat")
+    assert entry.rss_item is not None
+    assert xml.count(entry.rss_item) == 1
+    assert xml.endswith(webservices.RSS_TAIL)
+    assert webservices.wfo_rss(bot, "dmxchat") is xml
+    assert webservices.wfo_rss(bot, "xxxchat") == ""
+    assert "xxxchat" not in webservices.XML_CACHE
+
+
+def test_conditional_json():
+    """Test that we send a 304 when the client has the current response."""
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    for i in range(1, 30):
+        bot.chatlog.append(
+            "dmxchat",
+            ChatLogEntry(i, "20230102030405", "a" * 100, "b", "", "c", "d"),
+        )
+    channel = webservices.RoomChannel(bot)
+
+    def _request(headers):
+        """Build a request."""
+        req = server.Request(DummyChannel(), False)
+        req.method = b"GET"
+        req.uri = b"/iembot-json/room/dmxchat?seqnum=0"
+        req.args = {b"seqnum": [b"0"]}
+        for key, value in headers.items():
+            req.requestHeaders.setRawHeaders(key, [value])
+        return req
+
+    req = _request({b"Accept-Encoding": b"gzip, deflate"})
+    body = channel.render(req)
+    assert req.responseHeaders.getRawHeaders(b"content-encoding") == [b"gzip"]
+    assert len(json.loads(gzip.decompress(body))["messages"]) == 29
+    etag = req.etag
+    assert etag.endswith(b'-gzip"')
+    req = _request({b"If-None-Match": etag, b"Accept-Encoding": b"gzip"})
+    assert channel.render(req) == b""
+    assert req.code == 304
+    # The identity body is a different entity
+    req = _request({b"If-None-Match": etag})
+    assert len(json.loads(channel.render(req))["messages"]) == 29
+    assert req.etag != etag
+    req = _request({b"If-Modified-Since": b"Mon, 02 Jan 2023 03:04:05 GMT"})
+    assert channel.render(req) == b""
+    assert req.code == 304
+
+
+def test_empty_room():
+    """Test that a room with an empty log is answered."""
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    bot.chatlog.load("dmxchat", [])
+    req = server.Request(DummyChannel(), False)
+    req.method = b"GET"
+    req.uri = b"/iembot-json/room/dmxchat?seqnum=0"
+    req.args = {b"seqnum": [b"0"]}
+    body = webservices.RoomChannel(bot).render(req)
+    assert json.loads(body) == {"messages": []}
+    assert req.responseHeaders.getRawHeaders(b"last-modified") is None
+    xml = webservices.wfo_rss(bot, "dmxchat")
+    assert xml.endswith(webservices.RSS_TAIL)
+
+
+def test_cache_footprint():
+    """Test that the response caches are bounded by their bytes."""
+    cached = webservices.CachedResponse(None, b"a" * 2048, b'"x"', None)
+    assert cached.footprint() == 4096
+    assert webservices.JSON_CACHE.maxbytes is not None
+    assert webservices.JSON_CACHE.sizeof(cached) == 4096
+
+
+def test_room_history(tmp_path, monkeypatch):
+    """Test paging through a room's older messages."""
+    bot = basicbot("iembot", None, xml_log_path="/tmp")
+    monkeypatch.setattr(history.threads, "deferToThread", defer.maybeDeferred)
+    bot.history = history.ChatLogHistory(str(tmp_path / "history.db"))
+    bot.chatlog.spill = bot.history.add
+    bot.chatlog.set_depth("dmxchat", 5)
+    for i in range(1, 21):
+        bot.chatlog.append(
+            "dmxchat",
+            ChatLogEntry(i, "20230102030405", "a", "b", "", "c", "d"),
+        )
+    bot.history.flush()
+    channel = webservices.RoomChannel(bot)
+    req = DummyRequest([b""])
+    req.uri = b"/iembot-json/room/dmxchat"
+    # Served from memory alone
+    req.args = {b"before": [b"20"], b"limit": [b"3"]}
+    res = json.loads(channel.render(req))
+    assert [m["seqnum"] for m in res["messages"]] == [17, 18, 19]
+    # Spanning memory and disk
+    req = DummyRequest([b""])
+    req.uri = b"/iembot-json/room/dmxchat"
+    req.args = {b"before": [b"18"]}
+    assert channel.render(req) == server.NOT_DONE_YET
+    res = json.loads(b"".join(req.written))
+    assert [m["seqnum"] for m in res["messages"]] == list(range(1, 18))
+    req.args = {b"before": [b"x"]}
+    assert json.loads(channel.render(req)) == "ERROR"